@@ -0,0 +1,190 @@
+"""
+Benchmark character chunking vs CLIP-token-window chunking.
+
+Reports, per strategy:
+  - chunking + tokenization time (character chunks are tokenized again at
+    embedding time; token chunks are pre-tokenized)
+  - share of chunk tokens that fall outside the 77-token CLIP window
+  - retrieval hit rate: sentences sampled from the document are used as
+    queries, a hit means a top-k chunk contains the sentence
+
+Run:
+    python benchmark_chunking.py "N8N Recruitment.pdf" --queries 100 --k 5
+    python benchmark_chunking.py doc.pdf --no-retrieval   # timing only, no CLIP weights
+"""
+import argparse
+import random
+import re
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import fitz
+import numpy as np
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from token_chunker import (
+    CLIP_MAX_TOKENS, CLIP_MODEL_NAME, TokenWindowChunker, get_clip_tokenizer, pool_windows
+)
+
+
+def load_text(file_path: str) -> str:
+    if Path(file_path).suffix.lower() == ".pdf":
+        doc = fitz.open(file_path)
+        text = "\n".join(page.get_text() for page in doc)
+        doc.close()
+        return text
+    with open(file_path, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+# ============ CHUNKING STRATEGIES ============
+def char_chunks(text: str, tokenizer, chunk_size: int, chunk_overlap: int) -> Dict:
+    started = time.perf_counter()
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        separators=["\n\n", "\n", ".", " "],
+        add_start_index=True,
+    )
+    documents = splitter.create_documents([text])
+    chunk_time = time.perf_counter() - started
+
+    # What the embedding stage does for character chunks: tokenize, then truncate
+    started = time.perf_counter()
+    texts = [d.page_content for d in documents]
+    full = tokenizer(texts, verbose=False)["input_ids"] if texts else []
+    windows = [ids[:CLIP_MAX_TOKENS - 1] + [tokenizer.eos_token_id] for ids in full]
+    token_time = time.perf_counter() - started
+
+    total = sum(len(ids) - 2 for ids in full)
+    kept = sum(min(len(ids) - 2, CLIP_MAX_TOKENS - 2) for ids in full)
+    return {
+        "spans": [
+            (d.metadata["start_index"], d.metadata["start_index"] + len(d.page_content))
+            for d in documents
+        ],
+        "windows": windows,
+        "window_counts": [1] * len(windows),
+        "chunk_time": chunk_time,
+        "token_time": token_time,
+        "tokens_total": total,
+        "tokens_dropped": total - kept,
+    }
+
+
+def token_chunks(text: str, tokenizer, windows_per_chunk: int, overlap_tokens: int) -> Dict:
+    started = time.perf_counter()
+    chunker = TokenWindowChunker(
+        tokenizer, overlap_tokens=overlap_tokens, windows_per_chunk=windows_per_chunk
+    )
+    chunks = chunker.split(text)
+    chunk_time = time.perf_counter() - started
+
+    total = sum(chunk["n_tokens"] for chunk in chunks)
+    return {
+        "spans": [(chunk["start"], chunk["end"]) for chunk in chunks],
+        "windows": [w for chunk in chunks for w in chunk["windows"]],
+        "window_counts": [len(chunk["windows"]) for chunk in chunks],
+        "chunk_time": chunk_time,
+        "token_time": 0.0,  # tokenized once, inside chunking
+        "tokens_total": total,
+        "tokens_dropped": 0,
+    }
+
+
+# ============ RETRIEVAL ============
+def sample_queries(text: str, n: int, seed: int = 0) -> List[tuple]:
+    """(sentence, start, end) for sentences of 6-40 words"""
+    sentences = [
+        (m.group().strip(), m.start(), m.end())
+        for m in re.finditer(r"[^.!?\n]+[.!?]", text)
+        if 6 <= len(m.group().split()) <= 40
+    ]
+    random.Random(seed).shuffle(sentences)
+    return sentences[:n]
+
+
+class ClipTextEncoder:
+    """CLIP text tower only; the benchmark does not need BLIP or the image tower"""
+
+    def __init__(self):
+        import torch
+        from transformers import CLIPModel
+
+        self.torch = torch
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.model = CLIPModel.from_pretrained(CLIP_MODEL_NAME).to(self.device)
+        self.tokenizer = get_clip_tokenizer()
+
+    def encode_windows(self, windows: List[List[int]], batch_size: int = 64) -> np.ndarray:
+        vectors = []
+        for i in range(0, len(windows), batch_size):
+            inputs = self.tokenizer.pad(
+                {"input_ids": windows[i:i + batch_size]}, return_tensors="pt"
+            ).to(self.device)
+            with self.torch.no_grad():
+                vectors.append(self.model.get_text_features(**inputs).cpu().numpy())
+        return np.concatenate(vectors, axis=0)
+
+    def encode_texts(self, texts: List[str]) -> np.ndarray:
+        ids = self.tokenizer(texts, truncation=True, max_length=CLIP_MAX_TOKENS)["input_ids"]
+        return self.encode_windows(ids)
+
+
+def hit_rate(encoder: ClipTextEncoder, result: Dict, queries: List[tuple], k: int) -> float:
+    vectors = pool_windows(encoder.encode_windows(result["windows"]), result["window_counts"])
+    query_vectors = encoder.encode_texts([q for q, _, _ in queries])
+    distances = ((query_vectors[:, None, :] - vectors[None, :, :]) ** 2).sum(axis=2)
+    top_k = np.argsort(distances, axis=1)[:, :k]
+
+    spans = result["spans"]
+    hits = 0
+    for (_, start, end), candidates in zip(queries, top_k):
+        if any(spans[c][0] <= start and end <= spans[c][1] + 1 for c in candidates):
+            hits += 1
+    return hits / max(len(queries), 1)
+
+
+# ============ ENTRY POINT ============
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Character vs CLIP-token chunking benchmark")
+    parser.add_argument("files", nargs="+", help="PDF or TXT files")
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument("--chunk-overlap", type=int, default=50)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--no-retrieval", action="store_true", help="timing only")
+    args = parser.parse_args()
+
+    tokenizer = get_clip_tokenizer()
+    encoder = None if args.no_retrieval else ClipTextEncoder()
+    window = CLIP_MAX_TOKENS - 2
+    overlap = round(window * args.chunk_overlap / args.chunk_size)
+
+    for file_path in args.files:
+        text = load_text(file_path)
+        if not text.strip():
+            print(f"[SKIP] {Path(file_path).name}: no text layer")
+            continue
+        strategies = {
+            f"chars ({args.chunk_size})": char_chunks(
+                text, tokenizer, args.chunk_size, args.chunk_overlap
+            ),
+            "tokens (1 window)": token_chunks(text, tokenizer, 1, overlap),
+            "tokens (2 windows, pooled)": token_chunks(text, tokenizer, 2, overlap * 2),
+        }
+        queries = sample_queries(text, args.queries)
+
+        print("=" * 78)
+        print(f"{Path(file_path).name}: {len(text)} chars, {len(queries)} queries")
+        print(f"{'strategy':<28}{'chunks':>7}{'chunk ms':>10}{'tok ms':>9}"
+              f"{'dropped':>10}{f'hit@{args.k}':>10}")
+        for name, result in strategies.items():
+            dropped = result["tokens_dropped"] / max(result["tokens_total"], 1)
+            hits = "-" if encoder is None or not queries else \
+                f"{hit_rate(encoder, result, queries, args.k):.1%}"
+            print(f"{name:<28}{len(result['spans']):>7}"
+                  f"{result['chunk_time'] * 1000:>10.1f}{result['token_time'] * 1000:>9.1f}"
+                  f"{dropped:>10.1%}{hits:>10}")
+    print("=" * 78)
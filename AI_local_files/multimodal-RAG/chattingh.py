@@ -1,9 +1,15 @@
 import fitz
+import io
 import os
+import re
 import uuid
 import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait as futures_wait
 from pathlib import Path
-from typing import List, Union, Dict, TypedDict, Annotated
+from typing import List, Optional, Sequence, Set, Tuple, Union, Dict, Iterator, TypedDict, Annotated
 from datetime import datetime
 
 import torch
@@ -16,7 +22,6 @@ from transformers import BlipProcessor, BlipForConditionalGeneration
 import pytesseract
 
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import FAISS
 from langchain_core.documents import Document
 from langchain_groq import ChatGroq
 from langchain_core.prompts import PromptTemplate
@@ -25,9 +30,27 @@ from langchain_core.output_parsers import StrOutputParser
 from langgraph.graph import StateGraph, END
 from typing_extensions import TypedDict
 
+from dedup import NearDuplicateCollapser, find_session_duplicates, prune_session_duplicates
+from embedding_scheduler import EmbeddingScheduler
+from token_chunker import (
+    CLIP_EMBEDDING_DIM, CLIP_MAX_TOKENS, CLIP_MODEL_NAME, TokenWindowChunker, get_clip_tokenizer,
+    pool_windows,
+)
+from document_summary import DocumentSummaryStore, is_whole_document_question
+from lexical_index import anchor_terms, is_keyword_query, reciprocal_rank_fusion, tokenize
+from vector_index import DEFAULT_SECTION_SIZE, IndexSegment, IndexSnapshot, RetrievalFilter
+from document_store import SharedDocument, SharedDocumentStore, file_content_hash
+from image_store import ImageStore, image_content_hash
+from ingest_journal import IngestJournal, batch_digest
+from ingest_estimator import IngestThroughput, QuotaExceededError, SessionQuota, plan_ingestion, sum_usage
+
 load_dotenv()
 
 
+# Image enrichment modes for process_files
+IMAGE_MODES = ("sync", "background", "lazy")
+
+
 # ============ STATE DEFINITION ============
 class GraphState(TypedDict):
     """State that flows through the LangGraph workflow"""
@@ -41,15 +64,67 @@ class GraphState(TypedDict):
     rewritten_query: str
     answer: str
     session_id: str
+    snapshot: IndexSnapshot  # Index version pinned for this query
+    filters: Optional[RetrievalFilter]  # Restrict retrieval to documents/types/pages
+    summaries: List[Dict]  # Precomputed summaries answering a whole-document question
+    history_tokens: Dict  # Prompt history size vs. the last 4 raw messages
+    pending_image_documents: int  # Documents whose images were still being enriched at retrieval
 
 
 # ============ MEMORY MANAGER ============
+# Rough LLM token count (Llama-family tokenizers average ~4 characters per token)
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: str) -> int:
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def clip_to_tokens(text: str, tokens: int) -> str:
+    max_chars = max(tokens, 0) * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    return text[:max(max_chars - 3, 0)].rstrip() + "..."
+
+
+CONVERSATION_SUMMARY_PROMPT = PromptTemplate(
+    input_variables=["summary", "messages"],
+    template="""Update the running summary of a conversation between a user and an AI
+assistant about their documents with the new messages below. Keep the topics,
+documents, names and figures the user may refer back to. At most 120 words.
+
+Current summary:
+{summary}
+
+New messages:
+{messages}
+
+Updated summary:""",
+)
+
+
 class MemoryManager:
-    """SQLite-based short-term memory with trimming"""
+    """
+    SQLite-based short-term memory with trimming.
+    
+    Prompts get the latest exchange verbatim plus a rolling summary of older
+    turns, capped at history_token_budget. The summary is refreshed in the
+    background after each answer (schedule_refresh), so no request waits on it.
+    """
+    
+    # Background summary refreshes of all sessions share one small pool
+    _refresh_executor = None
+    _refresh_executor_lock = threading.Lock()
     
-    def __init__(self, db_path="chat_memory.db", max_messages=20):
+    def __init__(self, db_path="chat_memory.db", max_messages=20, history_token_budget=600,
+                 recent_messages=2):
         self.db_path = db_path
         self.max_messages = max_messages
+        self.history_token_budget = history_token_budget
+        self.recent_messages = recent_messages  # Latest exchange, always kept verbatim
+        self.summaries_enabled = os.getenv("RAG_MEMORY_SUMMARY", "1") != "0"
+        self._refreshing = set()
+        self._refresh_lock = threading.Lock()
         self.init_db()
     
     def init_db(self):
@@ -64,6 +139,14 @@ class MemoryManager:
                 timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
             )
         """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS conversation_summaries (
+                session_id TEXT PRIMARY KEY,
+                summary TEXT,
+                covered_id INTEGER,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
         conn.commit()
         conn.close()
     
@@ -123,14 +206,295 @@ class MemoryManager:
         
         return [{"role": row[0], "content": row[1]} for row in reversed(rows)]
     
+    def _messages_after(self, session_id: str, after_id: int) -> List[Tuple[int, str, str]]:
+        """(id, role, content) in order, newer than after_id"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT id, role, content FROM chat_history
+            WHERE session_id = ? AND id > ?
+            ORDER BY id
+        """, (session_id, after_id))
+        rows = cursor.fetchall()
+        conn.close()
+        return rows
+    
+    def get_summary(self, session_id: str) -> Tuple[str, int]:
+        """(rolling summary, id of the last message folded into it)"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT summary, covered_id FROM conversation_summaries WHERE session_id = ?",
+            (session_id,)
+        )
+        row = cursor.fetchone()
+        conn.close()
+        return (row[0], row[1]) if row else ("", 0)
+    
+    def get_prompt_history(self, session_id: str) -> Dict:
+        """
+        History text for router/rewriter/generator prompts, within the token
+        budget: latest exchange first, then the rolling summary, then any
+        older messages the summary does not cover yet (newest first).
+        Also reports what the last 4 raw messages would have cost.
+        """
+        raw = self.get_history(session_id, limit=4)
+        raw_tokens = estimate_tokens("\n".join(f"{m['role']}: {m['content']}" for m in raw))
+        
+        summary, covered_id = self.get_summary(session_id) if self.summaries_enabled else ("", 0)
+        if self.summaries_enabled:
+            pending = self._messages_after(session_id, covered_id)
+        else:
+            pending = [(0, m["role"], m["content"]) for m in raw]
+        
+        budget = self.history_token_budget
+        recent = pending[-self.recent_messages:] if self.recent_messages else []
+        older = pending[:len(pending) - len(recent)]
+        lines = {}
+        # Each message of the latest exchange gets at most an equal share of the budget
+        share = budget // max(len(recent), 1)
+        for position, (_, role, content) in enumerate(recent):
+            line = f"{role}: {clip_to_tokens(content, share - 2)}"
+            lines[len(older) + position] = line
+            budget -= estimate_tokens(line) + 1
+        
+        summary_line = ""
+        if summary and budget > 8:
+            summary_line = f"Summary of earlier conversation: {clip_to_tokens(summary, budget - 8)}"
+            budget -= estimate_tokens(summary_line) + 1
+        
+        for position in range(len(older) - 1, -1, -1):
+            _, role, content = older[position]
+            line = f"{role}: {content}"
+            if estimate_tokens(line) + 1 > budget:
+                break
+            lines[position] = line
+            budget -= estimate_tokens(line) + 1
+        
+        text = "\n".join(([summary_line] if summary_line else []) +
+                         [lines[position] for position in sorted(lines)])
+        tokens = estimate_tokens(text)
+        return {
+            "text": text,
+            "tokens": tokens,
+            "raw_tokens": raw_tokens,
+            "saved_tokens": max(raw_tokens - tokens, 0),
+            "summary_used": bool(summary_line),
+        }
+    
+    def schedule_refresh(self, session_id: str, llm) -> bool:
+        """Fold messages older than the latest exchange into the summary, in the background"""
+        if not self.summaries_enabled:
+            return False
+        with self._refresh_lock:
+            if session_id in self._refreshing:
+                return False
+            self._refreshing.add(session_id)
+        self._executor().submit(self._refresh, session_id, llm)
+        return True
+    
+    @classmethod
+    def _executor(cls) -> ThreadPoolExecutor:
+        if cls._refresh_executor is None:
+            with cls._refresh_executor_lock:
+                if cls._refresh_executor is None:
+                    cls._refresh_executor = ThreadPoolExecutor(
+                        max_workers=int(os.getenv("RAG_MEMORY_SUMMARY_WORKERS", "2")),
+                        thread_name_prefix="memory-summary",
+                    )
+        return cls._refresh_executor
+    
+    def _refresh(self, session_id: str, llm):
+        try:
+            summary, covered_id = self.get_summary(session_id)
+            pending = self._messages_after(session_id, covered_id)
+            to_fold = pending[:len(pending) - self.recent_messages]
+            if not to_fold:
+                return
+            messages = "\n".join(
+                f"{role}: {clip_to_tokens(content, self.history_token_budget)}"
+                for _, role, content in to_fold
+            )
+            chain = CONVERSATION_SUMMARY_PROMPT | llm | StrOutputParser()
+            updated = chain.invoke({"summary": summary or "(none)", "messages": messages}).strip()
+            self._save_summary(session_id, updated, to_fold[-1][0])
+        except Exception as e:
+            print(f"[WARNING] Conversation summary refresh failed for {session_id}: {e}")
+        finally:
+            with self._refresh_lock:
+                self._refreshing.discard(session_id)
+    
+    def _save_summary(self, session_id: str, summary: str, covered_id: int):
+        conn = sqlite3.connect(self.db_path)
+        # Never move the covered position backwards
+        conn.execute("""
+            INSERT INTO conversation_summaries (session_id, summary, covered_id, updated_at)
+            VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(session_id) DO UPDATE SET
+                summary = excluded.summary,
+                covered_id = excluded.covered_id,
+                updated_at = excluded.updated_at
+            WHERE excluded.covered_id > conversation_summaries.covered_id
+        """, (session_id, summary, covered_id))
+        conn.commit()
+        conn.close()
+    
+    def count_messages(self, session_id: str) -> int:
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM chat_history WHERE session_id = ?", (session_id,))
+        count = cursor.fetchone()[0]
+        conn.close()
+        return count
+    
     def clear_session(self, session_id: str):
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
         cursor.execute("DELETE FROM chat_history WHERE session_id = ?", (session_id,))
+        cursor.execute("DELETE FROM conversation_summaries WHERE session_id = ?", (session_id,))
         conn.commit()
         conn.close()
 
 
+# ============ SHARED MODELS ============
+class SharedModelHub:
+    """
+    Process-wide CLIP/BLIP weights shared by every session.
+    CLIP text encoding goes through a micro-batching scheduler so concurrent
+    sessions share forward passes instead of competing for the same cores.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def get(cls) -> "SharedModelHub":
+        """Return the process-wide hub, loading models on first use"""
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
+
+    def __init__(self):
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+
+        # -------- CLIP (OpenAI) --------
+        self.clip_model = CLIPModel.from_pretrained(CLIP_MODEL_NAME).to(self.device)
+        self.clip_processor = CLIPProcessor.from_pretrained(CLIP_MODEL_NAME)
+
+        # -------- BLIP for Image Captioning --------
+        print("[INFO] Loading BLIP model for image captioning...")
+        self.blip_processor = BlipProcessor.from_pretrained(
+            "Salesforce/blip-image-captioning-base"
+        )
+        self.blip_model = BlipForConditionalGeneration.from_pretrained(
+            "Salesforce/blip-image-captioning-base"
+        ).to(self.device)
+        print("[SUCCESS] BLIP model loaded")
+
+        # -------- Batching Schedulers --------
+        max_wait_ms = float(os.getenv("RAG_EMBED_MAX_WAIT_MS", "5"))
+        self.text_scheduler = EmbeddingScheduler(
+            self._encode_text_batch,
+            max_batch_size=int(os.getenv("RAG_EMBED_MAX_BATCH", "64")),
+            max_wait_ms=max_wait_ms,
+            name="clip-text",
+        )
+        self.image_scheduler = EmbeddingScheduler(
+            self._encode_image_batch,
+            max_batch_size=int(os.getenv("RAG_IMAGE_MAX_BATCH", "16")),
+            max_wait_ms=max_wait_ms,
+            name="clip-image",
+        )
+        self.caption_scheduler = EmbeddingScheduler(
+            self._caption_batch,
+            max_batch_size=int(os.getenv("RAG_CAPTION_MAX_BATCH", "8")),
+            max_wait_ms=max_wait_ms,
+            name="blip-caption",
+        )
+
+    def _encode_text_batch(self, items: List[Union[str, List[int]]]) -> np.ndarray:
+        """
+        Single CLIP forward pass over a coalesced batch. Items are raw texts
+        or pre-tokenized windows (BOS + ids + EOS) from the token chunker;
+        only the raw texts are tokenized here.
+        """
+        tokenizer = self.clip_processor.tokenizer
+        texts = [i for i, item in enumerate(items) if isinstance(item, str)]
+        input_ids = list(items)
+        if texts:
+            encoded = tokenizer(
+                [items[i] for i in texts], truncation=True, max_length=CLIP_MAX_TOKENS
+            )["input_ids"]
+            for i, ids in zip(texts, encoded):
+                input_ids[i] = ids
+        inputs = tokenizer.pad(
+            {"input_ids": [list(ids)[:CLIP_MAX_TOKENS] for ids in input_ids]},
+            return_tensors="pt",
+        ).to(self.device)
+        with torch.no_grad():
+            emb = self.clip_model.get_text_features(**inputs)
+        return emb.cpu().numpy()
+
+    def _encode_image_batch(self, images: List[Image.Image]) -> np.ndarray:
+        """Single CLIP forward pass over a batch of RGB images"""
+        inputs = self.clip_processor(
+            images=images, return_tensors="pt"
+        ).to(self.device)
+        with torch.no_grad():
+            emb = self.clip_model.get_image_features(**inputs)
+        return emb.cpu().numpy()
+
+    def _caption_batch(self, images: List[Image.Image]) -> np.ndarray:
+        """Batched BLIP captioning; returns a 1-D object array of captions"""
+        inputs = self.blip_processor(images=images, return_tensors="pt").to(self.device)
+        with torch.no_grad():
+            out = self.blip_model.generate(**inputs, max_length=50)
+        captions = self.blip_processor.batch_decode(out, skip_special_tokens=True)
+        return np.array(captions, dtype=object)
+
+    def embed_texts(self, texts: List[str]) -> np.ndarray:
+        """Embed texts through the shared scheduler (blocks until done)"""
+        return self.text_scheduler.embed(texts)
+
+    def embed_token_ids(self, windows: List[List[int]]) -> np.ndarray:
+        """Embed pre-tokenized windows; shares batches with embed_texts"""
+        return self.text_scheduler.embed(windows)
+
+    def embed_images(self, images: List[Image.Image]) -> np.ndarray:
+        """CLIP image features for RGB images, batched across sessions"""
+        return self.image_scheduler.embed(images)
+
+    def caption_images(self, images: List[Image.Image]) -> List[str]:
+        """BLIP captions for RGB images, batched across sessions"""
+        return [str(c) for c in self.caption_scheduler.embed(images)]
+
+    def ocr_images(self, images: List[Image.Image]) -> List[str]:
+        """PyTesseract OCR; runs in the caller's thread since tesseract is a subprocess"""
+        return [pytesseract.image_to_string(image).strip() for image in images]
+
+    def get_stats(self) -> Dict:
+        return {
+            "backend": "in-process",
+            "clip_text": self.text_scheduler.get_stats(),
+            "clip_image": self.image_scheduler.get_stats(),
+            "blip_caption": self.caption_scheduler.get_stats(),
+        }
+
+
+def get_model_hub():
+    """
+    Models used by the pipeline: the machine-wide model server when
+    RAG_MODEL_SERVER_SOCKET is set, otherwise the in-process SharedModelHub
+    """
+    socket_path = os.getenv("RAG_MODEL_SERVER_SOCKET")
+    if socket_path:
+        from model_server import ModelServerClient
+        return ModelServerClient.get(socket_path)
+    return SharedModelHub.get()
+
+
 # ============ ENHANCED AGENTIC RAG PIPELINE ============
 class AgenticRAGPipeline:
     """
@@ -138,9 +502,31 @@ class AgenticRAGPipeline:
     Smart routing decides which content type to use per query
     """
 
-    def __init__(self, chunk_size=500, chunk_overlap=50, session_id=None):
+    def __init__(self, chunk_size=500, chunk_overlap=50, session_id=None, image_mode=None):
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
+        self.splitter = RecursiveCharacterTextSplitter(
+            chunk_size=self.chunk_size,
+            chunk_overlap=self.chunk_overlap,
+            separators=["\n\n", "\n", ".", " "],
+        )
+        # "tokens": chunks measured with the CLIP tokenizer and sized to its 77-token
+        # window, pre-tokenized for embedding. "chars": legacy character chunks.
+        self.chunking = os.getenv("RAG_CHUNKING", "tokens")
+        self.token_chunker = None
+        if self.chunking == "tokens":
+            windows = int(os.getenv("RAG_CHUNK_WINDOWS", "1"))
+            self.token_chunker = TokenWindowChunker(
+                get_clip_tokenizer(),
+                overlap_tokens=round((CLIP_MAX_TOKENS - 2) * windows * chunk_overlap / chunk_size),
+                windows_per_chunk=windows,
+            )
+        # Scanned pages (no text layer) are rendered and OCR'd into the text pipeline
+        self.ocr_dpi = int(os.getenv("RAG_OCR_DPI", "300"))
+        self.ocr_max_pixels = int(os.getenv("RAG_OCR_MAX_PIXELS", "4000"))
+        self.ocr_workers = int(os.getenv("RAG_OCR_WORKERS", str(min(4, os.cpu_count() or 1))))
+        # Chunks embedded per call while streaming a document
+        self.text_batch_size = int(os.getenv("RAG_TEXT_BATCH", "64"))
         
         if session_id is None:
             self.session_id = self.generate_session_id()
@@ -148,33 +534,64 @@ class AgenticRAGPipeline:
         else:
             self.session_id = session_id
         
-        # NEW: Separate vector stores for text and images
-        self.text_vector_store = None
-        self.image_vector_store = None
-        self.text_retriever = None
-        self.image_retriever = None
+        # Separate text and image stores, held in an immutable versioned snapshot.
+        # Ingestion swaps in a new snapshot; queries read whichever one they started with.
+        self.snapshot = IndexSnapshot()
+        self._write_lock = threading.Lock()
+        self._snapshot_lock = threading.Lock()
+        self.image_mode = image_mode or os.getenv("RAG_IMAGE_MODE", "sync")
+        self.retrieval_kwargs = {"k": 5, "fetch_k": 15, "lambda_mult": 0.7}
+        # Coarse-to-fine retrieval: above this many chunks, search the nearest sections only
+        self.section_size = int(os.getenv("RAG_SECTION_SIZE", str(DEFAULT_SECTION_SIZE)))
+        self.top_sections = int(os.getenv("RAG_TOP_SECTIONS", "6"))
+        self.hierarchical_min_chunks = int(os.getenv("RAG_HIERARCHICAL_MIN_CHUNKS", "2000"))
+        # BM25 over every segment: keyword fast path + reciprocal-rank fusion with vectors
+        self.lexical_enabled = os.getenv("RAG_LEXICAL", "1") != "0"
+        self.rrf_k = int(os.getenv("RAG_RRF_K", "60"))
+        # Share of a question's terms that must be anchors (figures, acronyms) to skip embedding
+        self.lexical_anchor_ratio = float(os.getenv("RAG_LEXICAL_ANCHOR_RATIO", "0.5"))
+        # CLIP image vectors of extracted images, searched cross-modally with the question
+        self.visual_index = os.getenv("RAG_VISUAL_INDEX", "1") != "0"
         
-        self.processed_files = []
-        self.memory = MemoryManager(max_messages=20)
-
-        # -------- CLIP (OpenAI) --------
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.clip_model = CLIPModel.from_pretrained(
-            "openai/clip-vit-base-patch32"
-        ).to(self.device)
-        self.clip_processor = CLIPProcessor.from_pretrained(
-            "openai/clip-vit-base-patch32"
+        # Content-addressed documents shared with other sessions (doc_hash -> SharedDocument)
+        self.document_store = SharedDocumentStore.get()
+        self.attached_documents: Dict[str, SharedDocument] = {}
+        # Original upload filename of each attached document, as this session named it
+        self.document_names: Dict[str, str] = {}
+        # Cross-document near-duplicate mask, recomputed only when the text segments change
+        self._session_dedup = ({}, {})
+        self._session_dedup_key = ()
+        self.image_store = ImageStore.get()
+        self.image_batch_size = int(os.getenv("RAG_IMAGE_BATCH", "8"))
+        # Prompt history: latest exchange + rolling summary, capped at RAG_HISTORY_TOKENS
+        self.memory = MemoryManager(
+            max_messages=20, history_token_budget=int(os.getenv("RAG_HISTORY_TOKENS", "600"))
         )
+        # Listing counters, maintained at write time so session listings read no disk or index
+        self._counters_lock = threading.Lock()
+        created_at = time.time()
+        self.counters = {
+            "messages": self.memory.count_messages(self.session_id),
+            "documents": 0,
+            "text_chunks": 0,
+            "image_chunks": 0,
+            "images": 0,
+            "created_at": created_at,
+            "last_active_at": created_at,
+        }
 
-        # -------- BLIP for Image Captioning --------
-        print("[INFO] Loading BLIP model for image captioning...")
-        self.blip_processor = BlipProcessor.from_pretrained(
-            "Salesforce/blip-image-captioning-base"
-        )
-        self.blip_model = BlipForConditionalGeneration.from_pretrained(
-            "Salesforce/blip-image-captioning-base"
-        ).to(self.device)
-        print("[SUCCESS] BLIP model loaded")
+        # Pre-scan of each attached document (doc_hash -> scan); session usage is their sum
+        self.document_scans: Dict[str, Dict] = {}
+        # Documents a session recreated after a restart held before it, but could not reattach
+        self.missing_documents: List[Dict] = []
+        self.quota = SessionQuota()
+        self.throughput = IngestThroughput.get()
+        # Checkpoints of finished OCR pages and embedded batches, replayed after a crash
+        self.journal = IngestJournal.get()
+
+        # -------- CLIP + BLIP + OCR (shared across sessions/workers) --------
+        self.models = get_model_hub()
+        self.embedding_dim = CLIP_EMBEDDING_DIM
 
         # -------- LLM Components --------
         self.router_llm = ChatGroq(
@@ -189,6 +606,16 @@ class AgenticRAGPipeline:
         self.generator_llm = ChatGroq(
             model_name="llama-3.3-70b-versatile", temperature=0.2
         )
+        # Small model for background map-reduce summaries and summary answers
+        self.summary_llm = ChatGroq(
+            model_name=os.getenv("RAG_SUMMARY_MODEL", "llama-3.1-8b-instant"), temperature=0.2
+        )
+        self.summary_store = DocumentSummaryStore.get()
+        self.summaries_enabled = os.getenv("RAG_SUMMARIES", "1") != "0"
+        # ask_batch: parallel generator calls per batch
+        self.batch_concurrency = int(os.getenv("RAG_BATCH_CONCURRENCY", "4"))
+        # Lazy images: how long the question that triggers enrichment waits for it
+        self.lazy_image_wait = float(os.getenv("RAG_LAZY_IMAGE_WAIT", "20"))
 
         # -------- BUILD LANGGRAPH WORKFLOW --------
         self.workflow = self.build_graph()
@@ -211,101 +638,334 @@ class AgenticRAGPipeline:
         return f"session_files_{file_hash}"
 
     # ---------- TEXT PARSING ----------
-    def parse_pdf(self, file_path: str) -> str:
+    @staticmethod
+    def page_needs_ocr(page, text: Optional[str] = None, min_chars: int = 20) -> bool:
+        """
+        A page with (almost) no text layer but some raster content is a scan;
+        pass the page's already-extracted text to avoid reading it twice
+        """
+        if text is None:
+            text = page.get_text()
+        if len(text.strip()) >= min_chars:
+            return False
+        return bool(page.get_images())
+
+    def render_page(self, page) -> Image.Image:
+        """Grayscale render at RAG_OCR_DPI, capped so huge pages don't explode memory"""
+        zoom = self.ocr_dpi / 72
+        longest = max(page.rect.width, page.rect.height) * zoom
+        if longest > self.ocr_max_pixels:
+            zoom *= self.ocr_max_pixels / longest
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY, alpha=False)
+        return Image.frombytes("L", (pix.width, pix.height), pix.samples)
+
+    def iter_pdf_pages(
+        self,
+        file_path: str,
+        ocr_pages: Set[int] = None,
+        ingest_key: str = None,
+        resumed: Optional[Dict[str, int]] = None,
+    ) -> Iterator[Tuple[int, str]]:
+        """
+        Yield (page_number, text) one page at a time; page numbers are 1-based.
+        Pages without a text layer are rendered and OCR'd on a small worker
+        pool while later pages are read; pages with text are never rendered.
+        Pages whose text came from OCR are added to ocr_pages. With an
+        ingest_key, OCR results are journaled and replayed on resume (counted
+        in resumed["ocr_pages"]).
+        """
+        journaled = {}
+        if ingest_key:
+            journaled = {
+                page: payload.decode("utf-8")
+                for page, (_, payload) in self.journal.load_checkpoints(ingest_key, "ocr_page").items()
+            }
+            if resumed is not None:
+                resumed["ocr_pages"] += len(journaled)
+
         doc = fitz.open(file_path)
-        text = "".join(page.get_text() for page in doc)
-        doc.close()
+        pending = deque()  # (page_number, text or Future) in page order
+        try:
+            with ThreadPoolExecutor(max_workers=self.ocr_workers,
+                                    thread_name_prefix="page-ocr") as pool:
+                for page in doc:
+                    page_number = page.number + 1
+                    if page_number in journaled:
+                        done = Future()
+                        done.set_result(journaled[page_number])
+                        pending.append((page_number, done))
+                    else:
+                        text = page.get_text()
+                        if self.page_needs_ocr(page, text):
+                            # Render here (fitz is not thread-safe), OCR in the pool
+                            image = self.render_page(page)
+                            pending.append((page_number, pool.submit(
+                                self._ocr_page, image, page_number, ingest_key
+                            )))
+                        else:
+                            pending.append((page_number, text))
+
+                    # Bound the read-ahead so rendered pages don't pile up in memory
+                    while pending and (not isinstance(pending[0][1], Future)
+                                       or pending[0][1].done()
+                                       or len(pending) > self.ocr_workers * 2):
+                        yield self._resolve_page(pending.popleft(), ocr_pages)
+                while pending:
+                    yield self._resolve_page(pending.popleft(), ocr_pages)
+        finally:
+            doc.close()
+
+    def _ocr_page(self, image: Image.Image, page_number: int = None, ingest_key: str = None) -> str:
+        started = time.perf_counter()
+        text = self.models.ocr_images([image])[0]
+        self.throughput.record("page_ocr", 1, time.perf_counter() - started)
+        if ingest_key:
+            self.journal.save_checkpoint(ingest_key, "ocr_page", page_number, "", text.encode("utf-8"))
         return text
 
+    @staticmethod
+    def _resolve_page(item: tuple, ocr_pages: Set[int] = None) -> Tuple[int, str]:
+        page_number, text = item
+        if isinstance(text, Future):
+            try:
+                text = text.result()
+            except Exception as e:
+                print(f"[WARNING] OCR failed for page {page_number}: {e}")
+                text = ""
+            if text.strip() and ocr_pages is not None:
+                ocr_pages.add(page_number)
+        return page_number, text
+
+    def iter_txt_blocks(self, file_path: str, block_chars: int = 64 * 1024) -> Iterator[str]:
+        """Yield a text file in ~block_chars pieces, cut at line boundaries"""
+        with open(file_path, "r", encoding="utf-8") as f:
+            block = []
+            size = 0
+            for line in f:
+                block.append(line)
+                size += len(line)
+                if size >= block_chars:
+                    yield "".join(block)
+                    block = []
+                    size = 0
+            if block:
+                yield "".join(block)
+
+    def parse_pdf(self, file_path: str) -> str:
+        return "".join(text for _, text in self.iter_pdf_pages(file_path))
+
     def parse_txt(self, file_path: str) -> str:
         with open(file_path, "r", encoding="utf-8") as f:
             return f.read()
 
     def chunk_text(self, text: str) -> List[str]:
-        splitter = RecursiveCharacterTextSplitter(
-            chunk_size=self.chunk_size,
-            chunk_overlap=self.chunk_overlap,
-            separators=["\n\n", "\n", ".", " "],
-        )
-        return splitter.split_text(text)
+        if self.token_chunker is not None:
+            return [chunk["text"] for chunk in self.token_chunker.split(text)]
+        return self.splitter.split_text(text)
+
+    def split_chunks(self, text: str) -> List[Dict]:
+        """Chunks of one page as {"text", "n_tokens"?, "windows"?}"""
+        if self.token_chunker is not None:
+            return self.token_chunker.split(text)
+        return [{"text": piece} for piece in self.splitter.split_text(text)]
+
+    def _is_fragment(self, chunk: Dict) -> bool:
+        if self.token_chunker is not None:
+            return chunk["n_tokens"] < self.token_chunker.chunk_tokens // 4
+        return len(chunk["text"]) < self.chunk_size // 4
+
+    def iter_chunks(self, file_path: str, ocr_pages: Set[int] = None, ingest_key: str = None,
+                    resumed: Optional[Dict[str, int]] = None) -> Iterator[Dict]:
+        """
+        Stream {"text", "page", "page_end"} chunks (plus pre-tokenized
+        "windows" in token mode) from a PDF (page by page) or TXT (block by
+        block) without materializing the whole document. A short trailing
+        piece of a page is carried into the next one instead of becoming a
+        fragment chunk; such chunks span page..page_end.
+        """
+        if Path(file_path).suffix.lower() == ".pdf":
+            pages = self.iter_pdf_pages(file_path, ocr_pages, ingest_key, resumed)
+        else:
+            pages = ((None, block) for block in self.iter_txt_blocks(file_path))
+
+        carry, carry_page = "", None
+        for page, text in pages:
+            if not text.strip():
+                continue
+            start_page = carry_page if carry else page
+            pieces = self.split_chunks(carry + text)
+            carry, carry_page = "", None
+
+            if pieces and self._is_fragment(pieces[-1]):
+                carry, carry_page = pieces.pop()["text"] + "\n", page
+
+            for i, piece in enumerate(pieces):
+                piece["page"] = start_page if i == 0 else page
+                piece["page_end"] = page
+                yield piece
+
+        if carry.strip():
+            for piece in self.split_chunks(carry.strip()):
+                piece["page"] = piece["page_end"] = carry_page
+                yield piece
 
     # ---------- IMAGE EXTRACTION ----------
-    def extract_images_from_pdf(
-        self, file_path: str, output_dir="extracted_images"
-    ) -> List[str]:
-        session_dir = os.path.join(output_dir, self.session_id)
-        os.makedirs(session_dir, exist_ok=True)
-        
+    def iter_pdf_images(self, file_path: str, owner: str, scanned_pages: Set[int] = None) -> Iterator[Dict]:
+        """
+        Yield each distinct image of a PDF as an in-memory record built from
+        the bytes `doc.extract_image` returns. Blobs are handed to the image
+        store for an asynchronous write (needed only for serving); nothing
+        downstream reopens the file. Repeated images are yielded once.
+        Full-page scans on scanned_pages were already read by page OCR and
+        are skipped.
+        """
         doc = fitz.open(file_path)
-        image_paths = []
+        seen = set()
+
+        try:
+            for page in doc:
+                scanned = scanned_pages is not None and page.number + 1 in scanned_pages
+                for img in page.get_images(full=True):
+                    xref = img[0]
+                    if scanned and self._covers_page(page, xref):
+                        continue
+                    base = doc.extract_image(xref)
+                    img_bytes = base["image"]
+                    image_hash = image_content_hash(img_bytes)
+                    if image_hash in seen:
+                        continue
+                    seen.add(image_hash)
+
+                    path = self.image_store.put(
+                        img_bytes, base["ext"], owner,
+                        image_hash=image_hash, write_async=True
+                    )
+                    yield {
+                        "image_hash": image_hash,
+                        "ext": base["ext"],
+                        "path": path,
+                        "bytes": img_bytes,
+                        "page": page.number + 1,
+                    }
+        finally:
+            doc.close()
 
-        for page in doc:
-            for img in page.get_images(full=True):
-                xref = img[0]
-                base = doc.extract_image(xref)
-                img_bytes = base["image"]
-                ext = base["ext"]
-                name = f"{uuid.uuid4()}.{ext}"
-                path = os.path.join(session_dir, name)
+    @staticmethod
+    def _covers_page(page, xref: int, min_fraction: float = 0.8) -> bool:
+        page_area = abs(page.rect) or 1.0
+        return any(abs(rect) / page_area >= min_fraction for rect in page.get_image_rects(xref))
 
-                with open(path, "wb") as f:
-                    f.write(img_bytes)
+    def extract_images_from_pdf(self, file_path: str, owner: str) -> List[str]:
+        """Store each distinct image once in the content-addressed store; returns paths"""
+        return [record["path"] for record in self.iter_pdf_images(file_path, owner)]
 
-                image_paths.append(path)
+    @staticmethod
+    def decode_image(img_bytes: bytes) -> Dict:
+        """
+        Decode once and convert once. The RGB buffer is shared by OCR,
+        BLIP and CLIP so the JPEG/PNG is never decoded twice.
+        """
+        image = Image.open(io.BytesIO(img_bytes))
+        format_type = image.format
+        width, height = image.size
+        rgb = image if image.mode == "RGB" else image.convert("RGB")
+        rgb.load()
+        return {"rgb": rgb, "width": width, "height": height, "format": format_type}
 
-        doc.close()
-        return image_paths
+    @staticmethod
+    def _as_image(image: Union[str, Image.Image]) -> Image.Image:
+        return Image.open(image) if isinstance(image, str) else image
 
     # ---------- OCR WITH PYTESSERACT ----------
-    def perform_ocr(self, image_path: str) -> str:
-        """Extract text from image using PyTesseract OCR"""
+    def perform_ocr(self, image: Union[str, Image.Image]) -> str:
+        """Extract text from image (path or decoded PIL image) using PyTesseract OCR"""
         try:
-            image = Image.open(image_path)
-            ocr_text = pytesseract.image_to_string(image)
-            return ocr_text.strip()
+            return self.models.ocr_images([self._as_image(image)])[0]
         except Exception as e:
-            print(f"[WARNING] OCR failed for {image_path}: {e}")
+            print(f"[WARNING] OCR failed: {e}")
             return ""
 
     # ---------- IMAGE CAPTIONING WITH BLIP ----------
-    def generate_image_caption(self, image_path: str) -> str:
+    def generate_image_caption(self, image: Union[str, Image.Image]) -> str:
         """Generate a descriptive caption for an image using BLIP"""
         try:
-            image = Image.open(image_path).convert("RGB")
-            inputs = self.blip_processor(image, return_tensors="pt").to(self.device)
-            
-            with torch.no_grad():
-                out = self.blip_model.generate(**inputs, max_length=50)
-            
-            caption = self.blip_processor.decode(out[0], skip_special_tokens=True)
-            return caption
+            return self.models.caption_images([self._as_image(image).convert("RGB")])[0]
         except Exception as e:
-            print(f"[WARNING] Caption generation failed for {image_path}: {e}")
+            print(f"[WARNING] Caption generation failed: {e}")
             return "Image description unavailable"
 
-    # ---------- COMPREHENSIVE IMAGE PROCESSING ----------
-    def process_image_multimodal(self, image_path: str, source_file: str) -> Dict[str, str]:
-        """Process a single image with OCR, captioning, and metadata"""
-        print(f"[INFO] Processing image: {os.path.basename(image_path)}")
-        
-        ocr_text = self.perform_ocr(image_path)
-        caption = self.generate_image_caption(image_path)
-        
+    def generate_image_captions(self, images: List[Image.Image]) -> List[str]:
+        """Batched BLIP captions for already-decoded RGB images"""
         try:
-            img = Image.open(image_path)
-            width, height = img.size
-            format_type = img.format
-            metadata = f"Format: {format_type}, Size: {width}x{height}"
-        except:
-            metadata = "Metadata unavailable"
-        
-        return {
-            "ocr_text": ocr_text,
-            "caption": caption,
-            "metadata": metadata,
-            "image_path": image_path,
-            "source": source_file
-        }
+            return self.models.caption_images(images)
+        except Exception as e:
+            print(f"[WARNING] Batch caption generation failed ({e}); retrying one by one")
+            return [self.generate_image_caption(image) for image in images]
+
+    # ---------- COMPREHENSIVE IMAGE PROCESSING ----------
+    def process_images_multimodal(self, records: List[Dict], source_file: str) -> List[Dict]:
+        """
+        OCR, caption and metadata for a batch of extracted image records.
+        Cached results are reused by content hash; misses are decoded once
+        from memory and captioned in one BLIP batch.
+        """
+        results = [None] * len(records)
+        misses = []
+
+        for i, record in enumerate(records):
+            cached = self.image_store.get_cached(record["image_hash"])
+            if cached is not None:
+                print(f"[INFO] Cached image enrichment: {os.path.basename(record['path'])}")
+                results[i] = cached
+            else:
+                misses.append(i)
+
+        decoded = {}
+        for i in misses:
+            try:
+                decoded[i] = self.decode_image(records[i]["bytes"])
+                # Kept on the record for CLIP image encoding of the same batch
+                records[i]["rgb"] = decoded[i]["rgb"]
+            except Exception as e:
+                print(f"[WARNING] Could not decode image {os.path.basename(records[i]['path'])}: {e}")
+
+        ready = [i for i in misses if i in decoded]
+        captions = self.generate_image_captions([decoded[i]["rgb"] for i in ready]) if ready else []
+
+        for i, caption in zip(ready, captions):
+            record, info = records[i], decoded[i]
+            print(f"[INFO] Processing image: {os.path.basename(record['path'])}")
+            ocr_text = self.perform_ocr(info["rgb"])
+            self.image_store.save_enrichment(
+                record["image_hash"], record["ext"],
+                info["width"], info["height"], info["format"], ocr_text, caption
+            )
+            results[i] = {
+                "ocr_text": ocr_text,
+                "caption": caption,
+                "width": info["width"],
+                "height": info["height"],
+                "format": info["format"],
+            }
+
+        image_data = []
+        for record, result in zip(records, results):
+            result = result or {"ocr_text": "", "caption": "", "width": None}
+            if result.get("width") is not None:
+                metadata = f"Format: {result['format']}, Size: {result['width']}x{result['height']}"
+            else:
+                metadata = "Metadata unavailable"
+            image_data.append({
+                "ocr_text": result["ocr_text"],
+                "caption": result["caption"],
+                "metadata": metadata,
+                "image_path": record["path"],
+                "source": source_file,
+                "page": record.get("page"),
+                "width": result.get("width"),
+                "height": result.get("height")
+            })
+        return image_data
 
     # ---------- CREATE RICH MULTIMODAL CONTENT ----------
     def create_multimodal_content(self, image_data: Dict[str, str]) -> str:
@@ -325,203 +985,692 @@ class AgenticRAGPipeline:
     # ---------- CLIP EMBEDDINGS ----------
     def embed_text(self, text: str) -> np.ndarray:
         """Embed text with CLIP, handling max token length"""
-        inputs = self.clip_processor(
-            text=[text], 
-            return_tensors="pt", 
-            padding=True,
-            truncation=True,
-            max_length=77
-        ).to(self.device)
-        with torch.no_grad():
-            emb = self.clip_model.get_text_features(**inputs)
-        return emb.cpu().numpy()[0]
+        return self.models.embed_texts([text])[0]
 
-    def embed_image(self, image_path: str) -> np.ndarray:
-        image = Image.open(image_path).convert("RGB")
-        inputs = self.clip_processor(
-            images=image, return_tensors="pt"
-        ).to(self.device)
-        with torch.no_grad():
-            emb = self.clip_model.get_image_features(**inputs)
-        return emb.cpu().numpy()[0]
+    def embed_texts(self, texts: List[str]) -> np.ndarray:
+        """Embed many texts at once; coalesced with other sessions' requests"""
+        if not texts:
+            return np.zeros((0, self.embedding_dim), dtype=np.float32)
+        return self.models.embed_texts(texts)
+
+    def embed_chunks(self, chunks: List[Dict]) -> np.ndarray:
+        """
+        One vector per chunk. Token-mode chunks carry their model windows, so
+        they skip re-tokenization; multi-window chunks are mean-pooled.
+        """
+        if not chunks or "windows" not in chunks[0]:
+            return self.embed_texts([chunk["text"] for chunk in chunks])
+        windows = [window for chunk in chunks for window in chunk["windows"]]
+        vectors = self.models.embed_token_ids(windows)
+        return pool_windows(vectors, [len(chunk["windows"]) for chunk in chunks])
+
+    def embed_image(self, image: Union[str, Image.Image]) -> np.ndarray:
+        """CLIP image features; pass the decoded RGB buffer to avoid reopening the file"""
+        return self.models.embed_images([self._as_image(image).convert("RGB")])[0]
+
+    @staticmethod
+    def _batched(iterable, size: int) -> Iterator[List]:
+        batch = []
+        for item in iterable:
+            batch.append(item)
+            if len(batch) >= size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
 
     # ---------- ENHANCED FILE PROCESSING WITH SEPARATE STORES ----------
-    def process_files(self, file_paths: List[str]) -> Dict[str, int]:
+    @property
+    def processed_files(self) -> List[str]:
+        return [self.document_names.get(h, h) for h in list(self.attached_documents)]
+
+    def document_list(self) -> List[Dict]:
+        """{doc_hash, filename} of attached documents, in attach order"""
+        return [
+            {"doc_hash": h, "filename": self.document_names.get(h, h)}
+            for h in list(self.attached_documents)
+        ]
+
+    def process_files(
+        self,
+        file_paths: List[str],
+        image_mode: str = None,
+        filenames: Optional[List[str]] = None,
+    ) -> Dict[str, int]:
         """
         Process files into SEPARATE text and image vector stores
         Returns counts of text and image chunks processed
-        """
-        text_documents = []
-        text_embeddings = []
-        image_documents = []
-        image_embeddings = []
 
-        for file_path in file_paths:
-            if file_path not in self.processed_files:
-                self.processed_files.append(file_path)
-            
-            ext = Path(file_path).suffix.lower()
+        Concurrent uploads to one session are serialized by the writer lock;
+        queries keep reading the last committed snapshot meanwhile.
+        Files already ingested by any session are attached, not reprocessed.
 
-            if ext == ".pdf":
-                # ========== TEXT EXTRACTION (PRIORITY 1) ==========
-                print(f"\n[TEXT] Extracting text from: {os.path.basename(file_path)}")
-                text = self.parse_pdf(file_path)
-                
-                if text.strip():  # Only process if there's actual text
-                    chunks = self.chunk_text(text)
-                    print(f"   -> Found {len(chunks)} text chunks")
-
-                    for chunk in chunks:
-                        text_documents.append(
-                            Document(
-                                page_content=chunk,
-                                metadata={
-                                    "type": "text", 
-                                    "source": file_path,
-                                    "session_id": self.session_id
-                                },
-                            )
-                        )
-                        text_embeddings.append(self.embed_text(chunk))
-                else:
-                    print(f"   -> No text found in PDF")
+        image_mode:
+        - "sync": return only after every image is OCR'd and captioned
+        - "background": commit text immediately, enrich images in a background queue
+        - "lazy": defer image enrichment until a question is routed to IMAGE/BOTH
 
-                # ========== IMAGE EXTRACTION (PRIORITY 2) ==========
-                print(f"\n[IMAGE] Extracting images from: {os.path.basename(file_path)}")
-                image_paths = self.extract_images_from_pdf(file_path)
-                print(f"   -> Found {len(image_paths)} images")
-                
-                for img_path in image_paths:
-                    image_data = self.process_image_multimodal(img_path, file_path)
-                    multimodal_content = self.create_multimodal_content(image_data)
-                    
-                    # Store in IMAGE vector store
-                    image_documents.append(
-                        Document(
-                            page_content=multimodal_content,
-                            metadata={
-                                "type": "image",
-                                "image_path": img_path,
-                                "source": file_path,
-                                "session_id": self.session_id,
-                                "has_ocr": bool(image_data["ocr_text"]),
-                                "has_caption": bool(image_data["caption"])
-                            },
-                        )
-                    )
-                    # Use TEXT embedding for OCR/caption searchability
-                    image_embeddings.append(self.embed_text(multimodal_content))
-                    
-                    print(f"   [OK] {os.path.basename(img_path)} "
-                          f"(OCR: {bool(image_data['ocr_text'])}, "
-                          f"Caption: {bool(image_data['caption'])})")
-
-            elif ext == ".txt":
-                text = self.parse_txt(file_path)
-                chunks = self.chunk_text(text)
-
-                for chunk in chunks:
-                    text_documents.append(
-                        Document(
-                            page_content=chunk,
-                            metadata={
-                                "type": "text", 
-                                "source": file_path,
-                                "session_id": self.session_id
-                            },
-                        )
-                    )
-                    text_embeddings.append(self.embed_text(chunk))
+        Files are pre-scanned first; QuotaExceededError is raised before any
+        expensive work if they would push the session past its quota.
 
-        # ========== CREATE SEPARATE VECTOR STORES ==========
-        try:
-            from langchain_core.embeddings import Embeddings
-        except ImportError:
-            from langchain.embeddings.base import Embeddings
+        filenames: original upload names (file_paths are usually temp files);
+        documents are cited and can be removed/replaced under these names.
+        """
+        image_mode = image_mode or self.image_mode
+        if image_mode not in IMAGE_MODES:
+            raise ValueError(f"Unknown image_mode '{image_mode}'. Use one of {IMAGE_MODES}")
         
-        class CLIPEmbeddings(Embeddings):
-            def __init__(self, parent):
-                self.parent = parent
-            
-            def embed_documents(self, texts):
-                return [self.parent.embed_text(text) for text in texts]
-            
-            def embed_query(self, text):
-                return self.parent.embed_text(text)
+        with self._write_lock:
+            plan = self.estimate_files(file_paths, image_mode)
+            if not plan["allowed"]:
+                raise QuotaExceededError(plan["violations"])
+            names = dict(zip(file_paths, filenames or []))
+            for entry in plan["files"]:
+                entry["filename"] = names.get(entry["path"]) or os.path.basename(entry["path"])
+            return self._process_files_locked(plan, image_mode)
+
+    def estimate_files(self, file_paths: List[str], image_mode: str = None) -> Dict:
+        """Pre-scan files and estimate ingestion time against this session's quota"""
+        file_paths = [p for p in file_paths if Path(p).suffix.lower() in (".pdf", ".txt")]
+        return plan_ingestion(
+            file_paths,
+            image_mode or self.image_mode,
+            attached=dict(self.document_scans),
+            quota=self.quota,
+            ocr_workers=self.ocr_workers,
+        )
+
+    def usage(self) -> Dict:
+        return sum_usage(list(self.document_scans.values()))
+
+    def _process_files_locked(self, plan: Dict, image_mode: str) -> Dict[str, int]:
+        text_chunks = 0
+        image_chunks = 0
+        reused = 0
+        resumed = {"ocr_pages": 0, "text_batch": 0, "image_batch": 0}
+
+        for entry in plan["files"]:
+            file_path, doc_hash, filename = entry["path"], entry["doc_hash"], entry["filename"]
+            if doc_hash in self.attached_documents:
+                print(f"\n[SKIP] {filename} already attached to this session")
+                continue
+
+            document, was_shared = self.document_store.attach(
+                doc_hash,
+                self.session_id,
+                lambda: self._ingest_document(file_path, doc_hash, image_mode, filename),
+            )
+            if was_shared:
+                reused += 1
+                print(f"\n[SHARED] Attached already-ingested document: {filename} "
+                      f"(refcount: {document.refcount})")
+
+            document.add_listener(self.session_id, self._on_document_updated)
+            self.attached_documents[doc_hash] = document
+            self.document_scans[doc_hash] = entry["scan"]
+            self.document_names[doc_hash] = filename
+
+            # A shared document may still be waiting for its image phase
+            if document.images_pending and image_mode != "lazy":
+                future = self.document_store.schedule_images(document)
+                if image_mode == "sync" and future is not None:
+                    future.result()
+            if not was_shared:
+                for kind, count in document.resumed.items():
+                    resumed[kind] += count
+
+            # Text is queryable as soon as each document is embedded
+            self._commit_snapshot()
+            self.schedule_summary(document)
+
+            text_chunks += document.count("text")
+            image_chunks += document.count("image")
+
+        # The whole upload is committed; a crash from here on no longer needs its checkpoints.
+        # Images enriched in the background clear theirs when that phase finishes.
+        for entry in plan["files"]:
+            document = self.attached_documents.get(entry["doc_hash"])
+            kinds = ("ocr_page", "text_batch")
+            if document is None or not document.images_pending:
+                kinds += ("image_batch",)
+            self.journal.clear_checkpoints(self.ingest_key(entry["doc_hash"]), kinds)
+
+        pending = self.pending_image_documents()
         
-        clip_embeddings = CLIPEmbeddings(self)
+        print(f"\n{'='*60}")
+        print(f"[SUCCESS] Processed documents for session: {self.session_id}")
+        print(f"   - TEXT chunks: {text_chunks}")
+        print(f"   - IMAGE chunks: {image_chunks}")
+        print(f"   - TOTAL: {text_chunks + image_chunks}")
+        print(f"   - Reused shared documents: {reused}")
+        print(f"   - Documents with pending image work: {pending} ({image_mode})")
+        print(f"   - Snapshot version: {self.snapshot.version}")
+        print(f"   - Estimated ingestion time: {plan['estimate']['total_seconds']}s")
+        if any(resumed.values()):
+            print(f"   - Resumed from checkpoints: {resumed}")
+        print(f"{'='*60}\n")
 
-        # Create/update TEXT vector store
-        if text_documents:
-            text_vectors = np.vstack(text_embeddings)
-            text_pairs = [
-                (doc.page_content, vector) 
-                for doc, vector in zip(text_documents, text_vectors)
+        return {
+            "text_chunks": text_chunks,
+            "image_chunks": image_chunks,
+            "total": text_chunks + image_chunks,
+            "reused_documents": reused,
+            "pending_image_documents": pending,
+            "image_mode": image_mode,
+            "estimated_seconds": plan["estimate"]["total_seconds"],
+            "resumed_from_checkpoint": resumed
+        }
+
+    def _commit_snapshot(self, removed_segments: Sequence[IndexSegment] = ()):
+        """
+        Swap in a new snapshot built from the attached documents' current
+        segments; removed_segments lets a pure removal prune the duplicate mask
+        instead of recomputing it
+        """
+        with self._snapshot_lock:
+            segments = [
+                segment
+                for document in list(self.attached_documents.values())
+                for segment in list(document.segments)
             ]
-            
-            if self.text_vector_store is None:
-                self.text_vector_store = FAISS.from_embeddings(
-                    text_pairs, clip_embeddings
+            text_segments = [s for s in segments if s.store_type == "text"]
+            dedup_key = tuple(text_segments)
+            if dedup_key != self._session_dedup_key:
+                pruned = None
+                removed = set(removed_segments)
+                if removed and dedup_key == tuple(
+                    s for s in self._session_dedup_key if s not in removed
+                ):
+                    pruned = prune_session_duplicates(*self._session_dedup, removed)
+                self._session_dedup = pruned or find_session_duplicates(text_segments)
+                self._session_dedup_key = dedup_key
+            suppressed, duplicate_sources = self._session_dedup
+
+            # One reference assignment: readers see the old or the new snapshot, never a partial one
+            self.snapshot = IndexSnapshot.from_segments(
+                self.snapshot.version + 1, segments, suppressed, duplicate_sources
+            )
+            self._update_counters(
+                documents=len(self.attached_documents),
+                text_chunks=self.snapshot.count("text"),
+                image_chunks=self.snapshot.count("image"),
+                images=self.count_images(),
+            )
+
+    def _update_counters(self, messages_added: int = 0, **values):
+        with self._counters_lock:
+            self.counters.update(values)
+            if messages_added:
+                # Mirrors MemoryManager trimming to the last max_messages
+                self.counters["messages"] = min(
+                    self.counters["messages"] + messages_added, self.memory.max_messages
                 )
-                for i, doc in enumerate(text_documents):
-                    self.text_vector_store.docstore._dict[
-                        self.text_vector_store.index_to_docstore_id[i]
-                    ] = doc
-            else:
-                self.text_vector_store.add_embeddings(text_pairs)
-                current_index = len(self.text_vector_store.index_to_docstore_id)
-                for i, doc in enumerate(text_documents):
-                    self.text_vector_store.docstore._dict[
-                        self.text_vector_store.index_to_docstore_id[current_index + i]
-                    ] = doc
-            
-            self.text_retriever = self.text_vector_store.as_retriever(
-                search_type="mmr",
-                search_kwargs={"k": 5, "fetch_k": 15, "lambda_mult": 0.7}
+            self.counters["last_active_at"] = time.time()
+
+    def listing_info(self) -> Dict:
+        """Session counters for listings; reads no disk, history or vector index"""
+        with self._counters_lock:
+            info = dict(self.counters)
+        info["files"] = self.processed_files
+        return info
+
+    def schedule_summary(self, document: SharedDocument) -> bool:
+        """Queue a background map-reduce summary of a document (once per content hash)"""
+        if not self.summaries_enabled:
+            return False
+
+        def document_texts() -> List[str]:
+            # Text chunks in document order; image-only documents fall back to OCR/captions
+            for store_type in ("text", "image"):
+                texts = [
+                    d.page_content
+                    for segment in list(document.segments) if segment.store_type == store_type
+                    for d in segment.documents
+                ]
+                if texts:
+                    return texts
+            return []
+
+        return self.summary_store.schedule(
+            document.doc_hash,
+            self.document_names.get(document.doc_hash, document.filename),
+            document_texts,
+            self.summary_llm,
+        )
+
+    def _summary_targets(self, question: str, filters: Optional[RetrievalFilter]) -> List[str]:
+        """Documents a whole-document question is about: filtered, named in it, or all"""
+        if filters is not None and filters.doc_hashes is not None:
+            return [h for h in self.attached_documents if h in filters.doc_hashes]
+        lowered = question.lower()
+        named = [
+            doc_hash for doc_hash, name in self.document_names.items()
+            if doc_hash in self.attached_documents and (
+                name.lower() in lowered
+                or (len(Path(name).stem) >= 3 and Path(name).stem.lower() in lowered)
             )
+        ]
+        return named or list(self.attached_documents)
 
-        # Create/update IMAGE vector store
-        if image_documents:
-            image_vectors = np.vstack(image_embeddings)
-            image_pairs = [
-                (doc.page_content, vector) 
-                for doc, vector in zip(image_documents, image_vectors)
-            ]
-            
-            if self.image_vector_store is None:
-                self.image_vector_store = FAISS.from_embeddings(
-                    image_pairs, clip_embeddings
+    def _on_document_updated(self, document: SharedDocument):
+        """Image phase of an attached document finished: publish its segment"""
+        if document.doc_hash in self.attached_documents:
+            self._commit_snapshot()
+            print(f"[INFO] Image enrichment committed for {document.filename} "
+                  f"in session {self.session_id} (snapshot v{self.snapshot.version})")
+
+    def trigger_lazy_images(self, wait: float = 0.0) -> int:
+        """
+        Start deferred image enrichment for this session's documents and wait
+        up to `wait` seconds for it and for enrichment already in flight;
+        returns how many documents had image work to wait for
+        """
+        futures = []
+        started = 0
+        for document in list(self.attached_documents.values()):
+            if not document.images_pending:
+                continue
+            if document.image_status == "lazy":
+                started += 1
+            future = self.document_store.schedule_images(document)
+            if future is not None:
+                futures.append(future)
+        if started:
+            print(f"[INFO] Started lazy image enrichment for {started} document(s)")
+        if futures and wait > 0:
+            futures_wait(futures, timeout=wait)
+        return len(futures)
+
+    def pending_image_documents(self) -> int:
+        return sum(1 for d in list(self.attached_documents.values()) if d.images_pending)
+
+    def _ingest_document(self, file_path: str, doc_hash: str, image_mode: str = "sync",
+                         filename: Optional[str] = None) -> SharedDocument:
+        """
+        Text phase of one file into its own (shareable) text segment. The
+        image phase runs inline for "sync", otherwise it is registered on
+        the document against a spooled copy of the upload.
+        """
+        ext = Path(file_path).suffix.lower()
+        source = filename or os.path.basename(file_path)
+
+        # ========== TEXT EXTRACTION (PRIORITY 1) ==========
+        # Pages stream through chunking -> near-duplicate suppression -> embedding
+        # in fixed-size batches, so memory does not grow with the page count.
+        print(f"\n[TEXT] Extracting text from: {source}")
+        collapser = NearDuplicateCollapser()
+        kept_chunks = []
+        text_vectors = []
+        chunk_count = 0
+        text_bytes = 0
+        ocr_pages = set()
+        ingest_key = self.ingest_key(doc_hash)
+        journaled = self.journal.load_vectors(ingest_key, "text_batch")
+        # Checkpointed units replayed for this document (text now, images when enriched)
+        resumed = {"ocr_pages": 0, "text_batch": 0, "image_batch": 0}
+        started = time.perf_counter()
+
+        def accepted_chunks():
+            nonlocal chunk_count, text_bytes
+            for chunk in self.iter_chunks(file_path, ocr_pages, ingest_key, resumed):
+                metadata = {"type": "text", "source": source, "doc_hash": doc_hash,
+                            "chunk_index": chunk_count}
+                if chunk["page"] is not None:
+                    metadata["page"] = chunk["page"]
+                    metadata["page_end"] = chunk["page_end"]
+                    if chunk["page"] in ocr_pages:
+                        metadata["text_source"] = "ocr"
+                chunk_count += 1
+                text_bytes += len(chunk["text"].encode("utf-8"))
+                # Repeated headers/footers/disclaimers collapse into one chunk before embedding
+                if collapser.add(chunk["text"], metadata):
+                    yield chunk
+
+        for index, batch in enumerate(self._batched(accepted_chunks(), self.text_batch_size)):
+            texts = [chunk["text"] for chunk in batch]
+            text_vectors.append(self._checkpointed_vectors(
+                ingest_key, "text_batch", index, texts, journaled,
+                lambda: self.embed_chunks(batch), resumed
+            ))
+            kept_chunks.extend(texts)
+
+        if ocr_pages:
+            print(f"   -> Recovered text from {len(ocr_pages)} scanned page(s) with OCR")
+        else:
+            # OCR waits would skew the text rate; those pages are measured per page
+            self.throughput.record("text", text_bytes, time.perf_counter() - started)
+        if chunk_count:
+            print(f"   -> Found {chunk_count} text chunks")
+        elif ext == ".pdf":
+            print(f"   -> No text found in PDF")
+        collapsed = collapser.collapsed
+        if collapsed:
+            print(f"   -> Collapsed {collapsed} near-duplicate chunks "
+                  f"({len(kept_chunks)} embedded)")
+
+        text_documents = [
+            Document(page_content=chunk, metadata=metadata)
+            for chunk, metadata in zip(kept_chunks, collapser.metadatas)
+        ]
+
+        # ========== BUILD SEGMENTS OFF TO THE SIDE ==========
+        segments = []
+        if text_documents:
+            segments.append(
+                IndexSegment(
+                    "text", text_documents, np.vstack(text_vectors), collapser.signatures,
+                    section_size=self.section_size,
+                )
+            )
+
+        document = SharedDocument(doc_hash, source, segments, collapsed_chunks=collapsed,
+                                  resumed=resumed)
+
+        if ext == ".pdf":
+            if image_mode == "sync":
+                document.set_image_job(
+                    lambda: self._ingest_images(file_path, doc_hash, source, ocr_pages, resumed)
                 )
-                for i, doc in enumerate(image_documents):
-                    self.image_vector_store.docstore._dict[
-                        self.image_vector_store.index_to_docstore_id[i]
-                    ] = doc
+                document.run_image_job()
             else:
-                self.image_vector_store.add_embeddings(image_pairs)
-                current_index = len(self.image_vector_store.index_to_docstore_id)
-                for i, doc in enumerate(image_documents):
-                    self.image_vector_store.docstore._dict[
-                        self.image_vector_store.index_to_docstore_id[current_index + i]
-                    ] = doc
-            
-            self.image_retriever = self.image_vector_store.as_retriever(
-                search_type="mmr",
-                search_kwargs={"k": 5, "fetch_k": 15, "lambda_mult": 0.7}
+                spool_path = self.document_store.spool_file(file_path, doc_hash)
+                document.set_image_job(
+                    lambda: self._ingest_images(spool_path, doc_hash, source, ocr_pages, resumed,
+                                                clear_journal=True),
+                    status="lazy" if image_mode == "lazy" else "pending",
+                    spool_path=spool_path,
+                )
+                print(f"   -> Image enrichment deferred ({image_mode})")
+
+        return document
+
+    def _ingest_images(self, file_path: str, doc_hash: str, source: str, scanned_pages: Set[int] = None,
+                       resumed: Optional[Dict[str, int]] = None, clear_journal: bool = False):
+        """
+        Image phase: extract, OCR, caption and embed; returns (segments, images)
+        where images are the document's image manifest entries (for serving).
+        Captions/OCR go to the "image" store as text vectors, the pixels to the
+        "visual" store as CLIP image vectors, both over the same documents.
+        """
+        image_documents = []
+        images = []
+        visual_documents = []
+        visual_vectors = []
+
+        # ========== IMAGE EXTRACTION (PRIORITY 2) ==========
+        print(f"\n[IMAGE] Extracting images from: {os.path.basename(source)}")
+        started = time.perf_counter()
+        ingest_key = self.ingest_key(doc_hash)
+        journaled = self.journal.load_vectors(ingest_key, "image_batch")
+        image_vectors = []
+        # Decoded buffers live only for one batch, bounding memory on image-heavy PDFs
+        records = self.iter_pdf_images(file_path, owner=doc_hash, scanned_pages=scanned_pages)
+        for index, batch in enumerate(self._batched(records, self.image_batch_size)):
+            image_contents = []
+            enriched = self.process_images_multimodal(batch, source)
+            visual = self._visual_vectors(batch) if self.visual_index else {}
+            for record, image_data in zip(batch, enriched):
+                img_path = image_data["image_path"]
+                images.append({
+                    "image_hash": record["image_hash"],
+                    "ext": record["ext"],
+                    "path": img_path,
+                    "bytes": len(record["bytes"]),
+                    "page": record.get("page"),
+                    "width": image_data["width"],
+                    "height": image_data["height"],
+                })
+                multimodal_content = self.create_multimodal_content(image_data)
+                
+                # Store in IMAGE vector store
+                image_documents.append(
+                    Document(
+                        page_content=multimodal_content,
+                        metadata={
+                            "type": "image",
+                            "image_path": img_path,
+                            "source": source,
+                            "doc_hash": doc_hash,
+                            "has_ocr": bool(image_data["ocr_text"]),
+                            "has_caption": bool(image_data["caption"])
+                        },
+                    )
+                )
+                if image_data.get("page") is not None:
+                    image_documents[-1].metadata["page"] = image_data["page"]
+                image_contents.append(multimodal_content)
+                if record["image_hash"] in visual:
+                    visual_documents.append(image_documents[-1])
+                    visual_vectors.append(visual[record["image_hash"]])
+                
+                print(f"   [OK] {os.path.basename(img_path)} "
+                      f"(OCR: {bool(image_data['ocr_text'])}, "
+                      f"Caption: {bool(image_data['caption'])})")
+
+            # Use TEXT embedding for OCR/caption searchability
+            if image_contents:
+                image_vectors.append(self._checkpointed_vectors(
+                    ingest_key, "image_batch", index, image_contents, journaled,
+                    lambda: self.embed_texts(image_contents), resumed
+                ))
+        print(f"   -> Found {len(images)} images")
+        if clear_journal:
+            # Deferred phase, after its upload committed: nothing will resume it
+            self.journal.clear_checkpoints(ingest_key, ("image_batch",))
+
+        if not image_documents:
+            return [], images
+
+        self.throughput.record("image", len(image_documents), time.perf_counter() - started)
+        segments = [IndexSegment(
+            "image", image_documents, np.vstack(image_vectors), section_size=self.section_size
+        )]
+        if visual_documents:
+            segments.append(IndexSegment(
+                "visual", visual_documents, np.vstack(visual_vectors), section_size=self.section_size
+            ))
+        return segments, images
+
+    def _visual_vectors(self, records: List[Dict]) -> Dict[str, np.ndarray]:
+        """
+        Unit-length CLIP image vectors by image hash. Cached per hash in the
+        image store; misses are encoded in one batch, reusing the RGB buffer
+        decoded for captioning when there is one.
+        """
+        vectors = self.image_store.get_vectors([r["image_hash"] for r in records], CLIP_MODEL_NAME)
+        hashes, images = [], []
+        for record in records:
+            if record["image_hash"] in vectors or record["image_hash"] in hashes:
+                continue
+            try:
+                rgb = record.get("rgb") or self.decode_image(record["bytes"])["rgb"]
+            except Exception as e:
+                print(f"[WARNING] No visual vector for {os.path.basename(record['path'])}: {e}")
+                continue
+            hashes.append(record["image_hash"])
+            images.append(rgb)
+
+        if images:
+            embedded = np.asarray(self.models.embed_images(images), dtype=np.float32)
+            embedded /= np.linalg.norm(embedded, axis=1, keepdims=True).clip(min=1e-12)
+            fresh = dict(zip(hashes, embedded))
+            self.image_store.save_vectors(fresh, CLIP_MODEL_NAME)
+            vectors.update(fresh)
+        return vectors
+
+    # ---------- CHECKPOINTS ----------
+    def ingest_key(self, doc_hash: str) -> str:
+        """Journal key: the same bytes chunked differently must not share checkpoints"""
+        if self.token_chunker is not None:
+            config = (f"tokens:{self.token_chunker.windows_per_chunk}"
+                      f":{self.token_chunker.overlap_tokens}")
+        else:
+            config = f"chars:{self.chunk_size}:{self.chunk_overlap}"
+        return f"{doc_hash}:{config}:{self.text_batch_size}"
+
+    def _checkpointed_vectors(self, ingest_key: str, kind: str, index: int, texts: List[str],
+                              journaled: Dict, compute,
+                              resumed: Optional[Dict[str, int]] = None) -> np.ndarray:
+        """Replay a journaled batch if its contents match (counted in resumed), else compute and journal it"""
+        cached = journaled.get(index)
+        if cached is not None and cached[0] == batch_digest(texts):
+            if resumed is not None:
+                resumed[kind] += 1
+            return cached[1]
+        vectors = compute()
+        self.journal.save_vectors(ingest_key, kind, index, texts, vectors)
+        return vectors
+
+    # ---------- PER-DOCUMENT UPDATES ----------
+    def resolve_document(self, identifier: str) -> str:
+        """doc_hash of an attached document given its content hash (or a prefix) or filename"""
+        if identifier in self.attached_documents:
+            return identifier
+        matches = [h for h, name in self.document_names.items() if name == identifier]
+        if not matches and len(identifier) >= 8:
+            matches = [h for h in self.attached_documents if h.startswith(identifier)]
+        if not matches:
+            raise KeyError(f"No document '{identifier}' in session {self.session_id}")
+        if len(matches) > 1:
+            raise ValueError(
+                f"'{identifier}' matches {len(matches)} documents; use the content hash"
             )
-        
-        print(f"\n{'='*60}")
-        print(f"[SUCCESS] Processed documents for session: {self.session_id}")
-        print(f"   - TEXT chunks: {len(text_documents)}")
-        print(f"   - IMAGE chunks: {len(image_documents)}")
-        print(f"   - TOTAL: {len(text_documents) + len(image_documents)}")
-        print(f"{'='*60}\n")
+        return matches[0]
+
+    def _detach_locked(self, doc_hash: str) -> Tuple[SharedDocument, Dict, str]:
+        """Take a document out of this session's maps; the snapshot still shows it"""
+        return (
+            self.attached_documents.pop(doc_hash),
+            self.document_scans.pop(doc_hash, None),
+            self.document_names.pop(doc_hash, doc_hash),
+        )
+
+    def _reattach_locked(self, document: SharedDocument, scan: Optional[Dict], filename: str):
+        self.attached_documents[document.doc_hash] = document
+        if scan is not None:
+            self.document_scans[document.doc_hash] = scan
+        self.document_names[document.doc_hash] = filename
+
+    def discard_checkpoints(self, file_paths: List[str]):
+        """Drop the journal checkpoints of files whose job ended without committing"""
+        for file_path in file_paths:
+            if os.path.exists(file_path):
+                self.journal.clear_checkpoints(self.ingest_key(file_content_hash(file_path)))
 
+    def _release_detached(self, document: SharedDocument) -> bool:
+        """Drop this session's reference after the snapshot no longer shows the document"""
+        freed = self.document_store.detach(document.doc_hash, self.session_id)
+        if freed:
+            self.journal.clear_checkpoints(self.ingest_key(document.doc_hash))
+        return freed
+
+    def remove_document(self, identifier: str) -> Dict:
+        """
+        Remove one document from the session. Its segments are dropped from
+        the next snapshot; nothing else is re-embedded or re-indexed.
+        """
+        with self._write_lock:
+            doc_hash = self.resolve_document(identifier)
+            document, _, filename = self._detach_locked(doc_hash)
+            self._commit_snapshot(removed_segments=document.segments)
+            freed = self._release_detached(document)
+
+        print(f"[INFO] Removed {filename} from session {self.session_id} "
+              f"(snapshot v{self.snapshot.version}, freed: {freed})")
         return {
-            "text_chunks": len(text_documents),
-            "image_chunks": len(image_documents),
-            "total": len(text_documents) + len(image_documents)
+            "doc_hash": doc_hash,
+            "filename": filename,
+            "text_chunks": document.count("text"),
+            "image_chunks": document.count("image"),
+            "freed": freed,
+            "index_version": self.snapshot.version,
         }
 
+    def replace_document(
+        self,
+        identifier: str,
+        file_path: str,
+        filename: Optional[str] = None,
+        image_mode: str = None,
+    ) -> Dict:
+        """
+        Swap one document for a revised file. Only the new file is ingested;
+        queries see the old version until the new one is committed, and the
+        old one is kept if ingestion fails.
+        """
+        image_mode = image_mode or self.image_mode
+        if image_mode not in IMAGE_MODES:
+            raise ValueError(f"Unknown image_mode '{image_mode}'. Use one of {IMAGE_MODES}")
+
+        with self._write_lock:
+            old_hash = self.resolve_document(identifier)
+            old_document, old_scan, old_name = self._detach_locked(old_hash)
+            filename = filename or old_name
+            try:
+                # Quota is checked as if the old version were already gone
+                plan = self.estimate_files([file_path], image_mode)
+                if not plan["files"]:
+                    raise ValueError(f"Unsupported file type: {filename}")
+                new_hash = plan["files"][0]["doc_hash"]
+                if new_hash in self.attached_documents:
+                    # It would be skipped as already attached, and the old version lost
+                    raise ValueError(
+                        f"The revised file is already attached to this session as "
+                        f"'{self.document_names.get(new_hash, new_hash)}'"
+                    )
+                unchanged = new_hash == old_hash
+                if not unchanged:
+                    if not plan["allowed"]:
+                        raise QuotaExceededError(plan["violations"])
+                    plan["files"][0]["filename"] = filename
+                    stats = self._process_files_locked(plan, image_mode)
+            except Exception:
+                self._reattach_locked(old_document, old_scan, old_name)
+                self._commit_snapshot()
+                raise
+            if unchanged:
+                self._reattach_locked(old_document, old_scan, filename)
+                return {"status": "unchanged", "doc_hash": old_hash, "filename": filename}
+            freed = self._release_detached(old_document)
+
+        stats.update({
+            "status": "replaced",
+            "doc_hash": plan["files"][0]["doc_hash"],
+            "filename": filename,
+            "replaced": {"doc_hash": old_hash, "filename": old_name, "freed": freed},
+        })
+        return stats
+
+    def release_documents(self):
+        """Detach every document from this session; shared artifacts are freed at refcount 0"""
+        with self._write_lock:
+            for doc_hash in list(self.attached_documents):
+                self.document_store.detach(doc_hash, self.session_id)
+            self.attached_documents.clear()
+            self.document_scans.clear()
+            self.document_names.clear()
+            self._commit_snapshot()
+
+    def count_images(self) -> int:
+        """Extracted images across the documents attached to this session"""
+        return sum(len(d.images) for d in list(self.attached_documents.values()))
+
+    def image_manifest(self) -> List[Dict]:
+        """Manifest entries of this session's images, with their document's hash and name"""
+        return [
+            {**entry, "doc_hash": doc_hash, "source": self.document_names.get(doc_hash, document.filename)}
+            for doc_hash, document in list(self.attached_documents.items())
+            for entry in list(document.images.values())
+        ]
+
+    def find_image(self, image_hash: str) -> Optional[Dict]:
+        """Manifest entry of an image of an attached document, else None"""
+        for document in list(self.attached_documents.values()):
+            entry = document.images.get(image_hash)
+            if entry is not None:
+                return entry
+        return None
+
     # ========== LANGGRAPH NODES ==========
     
     def my_ai_assistant_node(self, state: GraphState) -> GraphState:
@@ -531,10 +1680,23 @@ class AgenticRAGPipeline:
         """
         print("\n[My_AI_Assistant] Routing query...")
         
-        history = self.memory.get_history(state["session_id"], limit=4)
-        history_text = "\n".join(
-            f"{msg['role']}: {msg['content']}" for msg in history
-        )
+        history = self.memory.get_prompt_history(state["session_id"])
+        history_text = history["text"]
+        state["history_tokens"] = {
+            key: history[key] for key in ("tokens", "raw_tokens", "saved_tokens", "summary_used")
+        }
+        print(f"   -> History: {history['tokens']} tokens "
+              f"(last 4 raw messages: {history['raw_tokens']})")
+
+        # Whole-document questions are answered from precomputed summaries
+        summaries = self._ready_summaries(state)
+        if summaries:
+            state["needs_retrieval"] = True
+            state["content_type"] = "summary"
+            state["chat_history"] = history_text
+            state["summaries"] = summaries
+            print(f"   -> Whole-document question: answering from {len(summaries)} summary(ies)")
+            return state
         
         # First: Check if retrieval is needed
         prompt = PromptTemplate(
@@ -593,6 +1755,13 @@ Decision:"""
                 state["content_type"] = "image"
             else:
                 state["content_type"] = "both"
+            
+            # Lazy ingestion: first visual question kicks off image enrichment
+            if state["content_type"] in ("image", "both"):
+                if self.trigger_lazy_images(wait=self.lazy_image_wait):
+                    # Re-pin so this question sees the images committed while it waited
+                    state["snapshot"] = self.snapshot
+                state["pending_image_documents"] = self.pending_image_documents()
         else:
             state["content_type"] = "none"
         
@@ -601,53 +1770,235 @@ Decision:"""
         
         return state
     
+    def _ready_summaries(self, state: GraphState) -> List[Dict]:
+        """Stored summaries for a whole-document question; empty means route normally"""
+        if not self.summaries_enabled:
+            return []
+        names = set()
+        for doc_hash in list(self.attached_documents):
+            name = self.document_names.get(doc_hash, "")
+            names.update(n for n in (name, Path(name).stem) if len(n) >= 3)
+        if not is_whole_document_question(state["question"], names):
+            return []
+        filters = state.get("filters")
+        if filters is not None and filters.restricts_content:
+            # Summaries cover whole documents; a page or type filter needs retrieval
+            return []
+        targets = self._summary_targets(state["question"], filters)
+        summaries = [self.summary_store.lookup(doc_hash) for doc_hash in targets]
+        if not targets or any(s is None or s["status"] != "ready" for s in summaries):
+            print("   -> Whole-document question, but summaries are not ready; using retrieval")
+            return []
+        for summary in summaries:
+            summary["filename"] = self.document_names.get(summary["doc_hash"], summary["filename"])
+        return summaries
+
+    def summary_answer_node(self, state: GraphState) -> GraphState:
+        """
+        Node 5: Summary_Answer
+        One small prompt over the precomputed document summaries
+        """
+        print("\n[Summary_Answer] Answering from document summaries...")
+        chain, inputs = self._summary_chain(state)
+        state["answer"] = chain.invoke(inputs).strip()
+        print("   -> Answer generated")
+        return state
+
+    def _summary_chain(self, state: GraphState):
+        """(chain, inputs) answering from the summaries; also sets the summary documents"""
+        summaries = state["summaries"]
+        context = "\n\n".join(f"Document: {s['filename']}\n{s['summary']}" for s in summaries)
+
+        prompt = PromptTemplate(
+            input_variables=["summaries", "history", "question"],
+            template="""You are a helpful AI assistant. Answer using these document summaries.
+
+Chat History:
+{history}
+
+Summaries:
+{summaries}
+
+Question: {question}
+
+Answer:"""
+        )
+        chain = prompt | self.summary_llm | StrOutputParser()
+        state["documents"] = [
+            Document(
+                page_content=s["summary"],
+                metadata={"type": "summary", "source": s["filename"], "doc_hash": s["doc_hash"]}
+            )
+            for s in summaries
+        ]
+        return chain, {
+            "summaries": context,
+            "history": state["chat_history"],
+            "question": state["question"]
+        }
+
     def vector_retriever_node(self, state: GraphState) -> GraphState:
         """
         Node 2: Vector_Retriever
         Retrieves from TEXT or IMAGE stores based on content_type
         """
-        print(f"\n[Vector_Retriever] Retrieving {state['content_type']} content...")
+        print(f"\n[Vector_Retriever] Retrieving {state['content_type']} content "
+              f"(snapshot v{state['snapshot'].version})...")
         
         state["text_documents"] = []
         state["image_documents"] = []
         state["documents"] = []
         
-        content_type = state["content_type"]
-        
-        # Retrieve from TEXT store
-        if content_type in ["text", "both"] and self.text_retriever:
-            print("   -> Searching TEXT store...")
-            text_docs = self.text_retriever.invoke(state["question"])
-            state["text_documents"] = text_docs
-            print(f"   -> Found {len(text_docs)} text chunks")
-        
-        # Retrieve from IMAGE store
-        if content_type in ["image", "both"] and self.image_retriever:
-            print("   -> Searching IMAGE store...")
-            image_docs = self.image_retriever.invoke(state["question"])
-            state["image_documents"] = image_docs
-            print(f"   -> Found {len(image_docs)} image chunks")
-        
-        # Combine based on content type
-        if content_type == "text":
-            state["documents"] = state["text_documents"][:5]
-        elif content_type == "image":
-            state["documents"] = state["image_documents"][:5]
-        else:  # both
-            # Interleave text and image for balanced context
-            combined = []
-            max_len = max(len(state["text_documents"]), len(state["image_documents"]))
-            for i in range(max_len):
-                if i < len(state["text_documents"]):
-                    combined.append(state["text_documents"][i])
-                if i < len(state["image_documents"]):
-                    combined.append(state["image_documents"][i])
-            state["documents"] = combined[:7]
+        snapshot = state["snapshot"]
+        filters = state.get("filters")
+        content_type = self._filtered_content_type(state["content_type"], filters)
+        state["content_type"] = content_type
+        if filters is not None:
+            print(f"   -> Filters: {filters.to_dict()}")
+        stores = self._stores_for(snapshot, content_type)
+
+        # Keyword questions ("CAC on slide 7") are answered from BM25 without embedding
+        found = self._lexical_fast_path(snapshot, stores, state["question"], filters)
+        if found is None:
+            query_vector = self.embed_text(state["question"])
+            terms = tokenize(state["question"]) if self.lexical_enabled else []
+            found = {}
+            for store_type in stores:
+                print(f"   -> Searching {store_type.upper()} store"
+                      f"{self._search_scope(snapshot, store_type)}...")
+                kwargs = self._search_kwargs(snapshot, store_type)
+                if terms:
+                    found[store_type] = snapshot.hybrid_search(
+                        store_type, query_vector, terms, filters=filters,
+                        rrf_k=self.rrf_k, **kwargs
+                    )
+                else:
+                    found[store_type] = snapshot.mmr_search(
+                        store_type, query_vector, filters=filters, **kwargs
+                    )
+            if "image" in found and snapshot.has("visual"):
+                found["image"] = self._fuse_visual(snapshot, query_vector, found["image"], filters)
+
+        state["text_documents"] = found.get("text", [])
+        state["image_documents"] = found.get("image", [])
+        for store_type, docs in found.items():
+            print(f"   -> Found {len(docs)} {store_type} chunks")
+        state["documents"] = self._combine_documents(
+            content_type, state["text_documents"], state["image_documents"]
+        )
         
         print(f"   -> TOTAL retrieved: {len(state['documents'])} chunks")
         
         return state
+
+    @staticmethod
+    def _filtered_content_type(content_type: str, filters: Optional[RetrievalFilter]) -> str:
+        """An explicit type filter overrides the content router"""
+        if filters is None or not filters.types:
+            return content_type
+        wanted = {"text": {"text"}, "image": {"image"}}.get(content_type, {"text", "image"})
+        wanted = (wanted & filters.types) or set(filters.types)
+        return "both" if len(wanted) > 1 else next(iter(wanted))
+
+    @staticmethod
+    def _stores_for(snapshot: IndexSnapshot, content_type: str) -> List[str]:
+        return [
+            store_type for store_type in ("text", "image")
+            if content_type in (store_type, "both") and snapshot.has(store_type)
+        ]
+
+    @staticmethod
+    def _combine_documents(
+        content_type: str, text_documents: List[Document], image_documents: List[Document]
+    ) -> List[Document]:
+        """Context for the generator, by content type"""
+        if content_type == "text":
+            return text_documents[:5]
+        if content_type == "image":
+            return image_documents[:5]
+        # Both: interleave text and image for balanced context
+        combined = []
+        for i in range(max(len(text_documents), len(image_documents))):
+            if i < len(text_documents):
+                combined.append(text_documents[i])
+            if i < len(image_documents):
+                combined.append(image_documents[i])
+        return combined[:7]
     
+    def _lexical_fast_path(
+        self,
+        snapshot: IndexSnapshot,
+        stores: List[str],
+        question: str,
+        filters: Optional[RetrievalFilter],
+    ) -> Optional[Dict[str, List[Document]]]:
+        """
+        BM25-only results when the question is keyword-dominant and some
+        chunk contains every anchor term (numbers, acronyms, quoted phrases);
+        None means fall back to embedding + fusion
+        """
+        if not self.lexical_enabled or not is_keyword_query(
+            question, min_anchor_ratio=self.lexical_anchor_ratio
+        ):
+            return None
+        anchors = frozenset(anchor_terms(question))
+        terms = tokenize(question)
+        k = self.retrieval_kwargs["k"]
+        hits = {
+            store_type: snapshot.lexical_search(store_type, terms, k, filters, anchors)
+            for store_type in stores
+        }
+        if not any(covers for store_hits in hits.values() for *_, covers in store_hits):
+            return None
+        print(f"   -> Lexical fast path on {sorted(anchors)} (embedding skipped)")
+        return {
+            store_type: snapshot.lexical_documents(store_hits)
+            for store_type, store_hits in hits.items()
+        }
+
+    def _fuse_visual(
+        self,
+        snapshot: IndexSnapshot,
+        query_vector: np.ndarray,
+        caption_docs: List[Document],
+        filters: Optional[RetrievalFilter],
+    ) -> List[Document]:
+        """
+        Cross-modal pass: the same CLIP text encoding of the question against
+        the CLIP image vectors, fused with the caption/OCR ranking (RRF)
+        """
+        print(f"   -> Searching VISUAL store{self._search_scope(snapshot, 'visual')}...")
+        query = query_vector / max(float(np.linalg.norm(query_vector)), 1e-12)
+        visual_docs = snapshot.mmr_search(
+            "visual", query, filters=filters, **self._search_kwargs(snapshot, "visual")
+        )
+        return self._fuse_image_rankings(caption_docs, visual_docs)
+
+    def _fuse_image_rankings(
+        self, caption_docs: List[Document], visual_docs: List[Document]
+    ) -> List[Document]:
+        by_path = {}
+        rankings = []
+        for docs in (caption_docs, visual_docs):
+            rankings.append([doc.metadata["image_path"] for doc in docs])
+            for doc in docs:
+                by_path.setdefault(doc.metadata["image_path"], doc)
+        fused = reciprocal_rank_fusion(rankings, self.rrf_k)
+        print(f"   -> Fused {len(caption_docs)} caption and {len(visual_docs)} visual matches")
+        return [by_path[path] for path in fused[:self.retrieval_kwargs["k"]]]
+
+    def _search_kwargs(self, snapshot: IndexSnapshot, store_type: str) -> Dict:
+        """MMR settings; large stores go coarse-to-fine through their nearest sections"""
+        kwargs = dict(self.retrieval_kwargs)
+        if snapshot.count(store_type) >= self.hierarchical_min_chunks:
+            kwargs["top_sections"] = self.top_sections
+        return kwargs
+
+    def _search_scope(self, snapshot: IndexSnapshot, store_type: str) -> str:
+        if snapshot.count(store_type) < self.hierarchical_min_chunks:
+            return ""
+        return f" (top {self.top_sections} of {snapshot.section_count(store_type)} sections)"
+
     def query_rewriter_node(self, state: GraphState) -> GraphState:
         """Node 3: Query_Rewriter"""
         print("\n[Query_Rewriter] Rewriting query...")
@@ -692,6 +2043,15 @@ Rewritten Question:"""
         """Node 4: Output_Generator"""
         print("\n[Output_Generator] Generating answer...")
         
+        chain, inputs = self._generator_chain(state)
+        state["answer"] = chain.invoke(inputs).strip()
+        
+        print("   -> Answer generated")
+        
+        return state
+
+    def _generator_chain(self, state: GraphState):
+        """(chain, inputs) for the answer: grounded in the documents, or direct"""
         if state["needs_retrieval"] and state["documents"]:
             context = "\n\n".join(d.page_content for d in state["documents"])
             
@@ -720,13 +2080,13 @@ Answer:"""
             )
             
             chain = prompt | self.generator_llm | StrOutputParser()
-            answer = chain.invoke({
+            return chain, {
                 "context": context,
                 "history": state["chat_history"],
                 "question": state["question"],
                 "rewritten": state["rewritten_query"],
                 "content_type": state["content_type"]
-            })
+            }
         else:
             prompt = PromptTemplate(
                 input_variables=["history", "question"],
@@ -741,22 +2101,19 @@ Answer:"""
             )
             
             chain = prompt | self.generator_llm | StrOutputParser()
-            answer = chain.invoke({
+            return chain, {
                 "history": state["chat_history"],
                 "question": state["question"]
-            })
-        
-        state["answer"] = answer.strip()
-        
-        print("   -> Answer generated")
-        
-        return state
+            }
     
     # ========== ROUTING LOGIC ==========
     
     def route_after_assistant(self, state: GraphState) -> str:
-        """Decide whether to retrieve or go directly to generator"""
-        if state["needs_retrieval"] and (self.text_retriever or self.image_retriever):
+        """Decide whether to retrieve, answer from summaries or go directly to generator"""
+        if state.get("summaries"):
+            return "summary"
+        snapshot = state["snapshot"]
+        if state["needs_retrieval"] and (snapshot.has("text") or snapshot.has("image")):
             return "retriever"
         else:
             return "generator"
@@ -771,6 +2128,7 @@ Answer:"""
         workflow.add_node("retriever", self.vector_retriever_node)
         workflow.add_node("rewriter", self.query_rewriter_node)
         workflow.add_node("generator", self.output_generator_node)
+        workflow.add_node("summary", self.summary_answer_node)
         
         workflow.set_entry_point("assistant")
         
@@ -779,25 +2137,88 @@ Answer:"""
             self.route_after_assistant,
             {
                 "retriever": "retriever",
-                "generator": "generator"
+                "generator": "generator",
+                "summary": "summary"
             }
         )
         
         workflow.add_edge("retriever", "rewriter")
         workflow.add_edge("rewriter", "generator")
         workflow.add_edge("generator", END)
+        workflow.add_edge("summary", END)
         
         return workflow.compile()
     
     # ========== MAIN INTERFACE ==========
     
-    def ask(self, question: str) -> dict:
-        """Execute the LangGraph workflow"""
+    def build_filter(
+        self,
+        sources: Optional[List[str]] = None,
+        types: Optional[List[str]] = None,
+        page_from: Optional[int] = None,
+        page_to: Optional[int] = None,
+    ) -> Optional[RetrievalFilter]:
+        """
+        Retrieval filter from user-facing terms: sources are filenames or
+        doc hashes of attached documents (KeyError if unknown). Pages are
+        1-based and inclusive.
+        """
+        if not sources and not types and page_from is None and page_to is None:
+            return None
+        doc_hashes = [self.resolve_document(source) for source in sources] if sources else None
+        return RetrievalFilter(doc_hashes, types, page_from, page_to)
+
+    def ask(self, question: str, filters: Optional[RetrievalFilter] = None) -> dict:
+        """Execute the LangGraph workflow; filters restrict retrieval (see build_filter)"""
         print("\n" + "="*60)
         print("Starting Enhanced Agentic RAG Workflow")
         print("="*60)
         
-        initial_state = GraphState(
+        final_state = self.workflow.invoke(self._initial_state(question, filters))
+        self._remember(question, final_state["answer"])
+        
+        print("\n" + "="*60)
+        print("[SUCCESS] Workflow Complete")
+        print("="*60 + "\n")
+        
+        return self._result(question, final_state)
+
+    def ask_stream(self, question: str, filters: Optional[RetrievalFilter] = None) -> Iterator[Dict]:
+        """
+        ask() with the answer streamed as it is generated: yields
+        {"type": "route", ...} once routing and retrieval are done, then
+        {"type": "delta", "text"} pieces and finally {"type": "result", **ask result}.
+        Walks the workflow's nodes directly so the generator chain can stream.
+        """
+        print("\n" + "="*60)
+        print("Starting Enhanced Agentic RAG Workflow (streaming)")
+        print("="*60)
+        
+        state = self.my_ai_assistant_node(self._initial_state(question, filters))
+        route = self.route_after_assistant(state)
+        if route == "retriever":
+            state = self.vector_retriever_node(state)
+            state = self.query_rewriter_node(state)
+        yield {
+            "type": "route",
+            "needed_retrieval": state["needs_retrieval"],
+            "content_type": state["content_type"],
+            "documents": len(state["summaries"]) if route == "summary" else len(state["documents"]),
+        }
+        
+        chain, inputs = self._summary_chain(state) if route == "summary" else self._generator_chain(state)
+        pieces = []
+        for piece in chain.stream(inputs):
+            pieces.append(piece)
+            yield {"type": "delta", "text": piece}
+        state["answer"] = "".join(pieces).strip()
+        self._remember(question, state["answer"])
+        
+        print("[SUCCESS] Streaming workflow complete")
+        yield {"type": "result", **self._result(question, state)}
+
+    def _initial_state(self, question: str, filters: Optional[RetrievalFilter]) -> GraphState:
+        return GraphState(
             question=question,
             chat_history="",
             needs_retrieval=False,
@@ -807,18 +2228,23 @@ Answer:"""
             documents=[],
             rewritten_query=question,
             answer="",
-            session_id=self.session_id
+            session_id=self.session_id,
+            snapshot=self.snapshot,
+            filters=filters,
+            summaries=[],
+            history_tokens={},
+            pending_image_documents=0
         )
-        
-        final_state = self.workflow.invoke(initial_state)
-        
+
+    def _remember(self, question: str, answer: str):
         self.memory.add_message(self.session_id, "human", question)
-        self.memory.add_message(self.session_id, "ai", final_state["answer"])
-        
-        print("\n" + "="*60)
-        print("[SUCCESS] Workflow Complete")
-        print("="*60 + "\n")
-        
+        self.memory.add_message(self.session_id, "ai", answer)
+        self._update_counters(messages_added=2)
+        # Older turns are folded into the rolling summary off the request path
+        self.memory.schedule_refresh(self.session_id, self.summary_llm)
+
+    @staticmethod
+    def _result(question: str, final_state: GraphState) -> Dict:
         return {
             "answer": final_state["answer"],
             "documents": final_state["documents"],
@@ -826,23 +2252,218 @@ Answer:"""
             "content_type": final_state.get("content_type"),
             "text_docs_count": len(final_state.get("text_documents", [])),
             "image_docs_count": len(final_state.get("image_documents", [])),
-            "rewritten_query": final_state.get("rewritten_query") if final_state.get("rewritten_query") != question else None
+            "rewritten_query": final_state.get("rewritten_query") if final_state.get("rewritten_query") != question else None,
+            "history_tokens": final_state.get("history_tokens") or None,
+            "pending_image_documents": final_state.get("pending_image_documents", 0)
         }
 
+    # ========== BATCH EVALUATION ==========
+
+    def ask_batch(
+        self,
+        questions: List[str],
+        filters: Optional[RetrievalFilter] = None,
+        max_concurrency: Optional[int] = None,
+    ) -> Iterator[Dict]:
+        """
+        Answer a list of independent questions against one snapshot, yielding
+        results as they finish (in completion order, tagged with their index).
+        Routing is one LLM call for the whole batch, all questions are
+        embedded together and each segment is searched once per batch; only
+        the generator calls run per question, max_concurrency at a time.
+        Every question is assumed to need the documents (no DIRECT route or
+        rewrite), and chat memory is neither read nor written.
+        """
+        snapshot = self.snapshot
+        states = [self._initial_state(question, filters) for question in questions]
+        for state in states:
+            # One snapshot for the whole batch; every question goes to retrieval
+            state["snapshot"] = snapshot
+            state["needs_retrieval"] = True
+            state["content_type"] = "both"
+        print(f"\n[Batch] {len(states)} questions (snapshot v{snapshot.version})")
+        self._update_counters()
+
+        pending = []
+        for state in states:
+            state["summaries"] = self._ready_summaries(state)
+            if state["summaries"]:
+                state["content_type"] = "summary"
+            else:
+                pending.append(state)
+
+        if pending:
+            routes = self._route_batch([state["question"] for state in pending])
+            for state, content_type in zip(pending, routes):
+                state["content_type"] = self._filtered_content_type(content_type, filters)
+            if any(state["content_type"] in ("image", "both") for state in pending):
+                if self.trigger_lazy_images(wait=self.lazy_image_wait):
+                    snapshot = self.snapshot
+                    for state in pending:
+                        state["snapshot"] = snapshot
+                images_pending = self.pending_image_documents()
+                for state in pending:
+                    state["pending_image_documents"] = images_pending
+            self._retrieve_batch(snapshot, pending, filters)
+
+        workers = max(1, min(max_concurrency or self.batch_concurrency, len(states) or 1))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch-generate") as pool:
+            futures = {}
+            for index, state in enumerate(states):
+                node = self.summary_answer_node if state["summaries"] else self.output_generator_node
+                futures[pool.submit(self._timed, node, state)] = index
+            try:
+                for future in as_completed(futures):
+                    index = futures[future]
+                    state = states[index]
+                    result = {
+                        "index": index,
+                        "question": state["question"],
+                        "content_type": state["content_type"],
+                        "pending_image_documents": state["pending_image_documents"],
+                    }
+                    try:
+                        state, elapsed = future.result()
+                        result["answer"] = state["answer"]
+                        result["documents"] = state["documents"]
+                        result["generation_ms"] = round(elapsed * 1000, 1)
+                    except Exception as e:
+                        result["error"] = str(e)
+                    yield result
+            finally:
+                # The consumer went away: drop generator calls that have not started
+                for future in futures:
+                    future.cancel()
+
+    @staticmethod
+    def _timed(node, state: GraphState) -> Tuple[GraphState, float]:
+        started = time.perf_counter()
+        return node(state), time.perf_counter() - started
+
+    def _route_batch(self, questions: List[str]) -> List[str]:
+        """Content type of every question from one router call; unparsed lines fall back to both"""
+        prompt = PromptTemplate(
+            input_variables=["questions"],
+            template="""For each numbered question, determine what type of content is needed.
+
+{questions}
+
+- TEXT: written content, explanations, definitions, text-based information
+- IMAGE: visual content, diagrams, charts, pictures, screenshots
+- BOTH: the answer could come from either text or images
+
+Reply with one line per question in the form "<number>: TEXT", "<number>: IMAGE" or "<number>: BOTH" and nothing else.
+
+Decisions:"""
+        )
+        numbered = "\n".join(f"{i}. {question}" for i, question in enumerate(questions, start=1))
+        chain = prompt | self.content_router_llm | StrOutputParser()
+        try:
+            reply = chain.invoke({"questions": numbered})
+        except Exception as e:
+            print(f"[WARNING] Batch routing failed, searching both stores: {e}")
+            return ["both"] * len(questions)
+
+        routes = ["both"] * len(questions)
+        for number, decision in re.findall(r"(\d+)\s*[:.)-]\s*(TEXT|IMAGE|BOTH)", reply.upper()):
+            if 1 <= int(number) <= len(questions):
+                routes[int(number) - 1] = decision.lower()
+        print(f"   -> Routed {len(questions)} questions: "
+              f"{ {t: routes.count(t) for t in ('text', 'image', 'both')} }")
+        return routes
+
+    def _retrieve_batch(
+        self,
+        snapshot: IndexSnapshot,
+        states: List[GraphState],
+        filters: Optional[RetrievalFilter],
+    ):
+        """vector_retriever_node for many states: one embedding batch, one search per store"""
+        found = []
+        to_embed = []
+        for i, state in enumerate(states):
+            stores = self._stores_for(snapshot, state["content_type"])
+            lexical = self._lexical_fast_path(snapshot, stores, state["question"], filters)
+            found.append(lexical or {})
+            if lexical is None and stores:
+                to_embed.append(i)
+
+        if to_embed:
+            vectors = self.embed_texts([states[i]["question"] for i in to_embed])
+            print(f"   -> Embedded {len(to_embed)} questions in one batch")
+            for store_type in ("text", "image"):
+                members = [
+                    (i, vector) for i, vector in zip(to_embed, vectors)
+                    if store_type in self._stores_for(snapshot, states[i]["content_type"])
+                ]
+                if not members:
+                    continue
+                print(f"   -> Searching {store_type.upper()} store for {len(members)} questions"
+                      f"{self._search_scope(snapshot, store_type)}...")
+                queries = np.vstack([vector for _, vector in members])
+                terms = (
+                    [tokenize(states[i]["question"]) for i, _ in members]
+                    if self.lexical_enabled else None
+                )
+                results = snapshot.search_batch(
+                    store_type, queries, terms, filters=filters, rrf_k=self.rrf_k,
+                    **self._search_kwargs(snapshot, store_type)
+                )
+                if store_type == "image" and snapshot.has("visual"):
+                    norms = np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+                    visual = snapshot.search_batch(
+                        "visual", queries / norms, filters=filters,
+                        **self._search_kwargs(snapshot, "visual")
+                    )
+                    results = [
+                        self._fuse_image_rankings(caption_docs, visual_docs)
+                        for caption_docs, visual_docs in zip(results, visual)
+                    ]
+                for (i, _), docs in zip(members, results):
+                    found[i][store_type] = docs
+
+        for state, docs in zip(states, found):
+            state["text_documents"] = docs.get("text", [])
+            state["image_documents"] = docs.get("image", [])
+            state["documents"] = self._combine_documents(
+                state["content_type"], state["text_documents"], state["image_documents"]
+            )
+        print(f"   -> Retrieved context for {len(states)} questions")
+
     def clear_memory(self):
         """Clear chat history from SQLite"""
         self.memory.clear_session(self.session_id)
+        self._update_counters(messages=0)
         print(f"[SUCCESS] Memory cleared for session: {self.session_id}")
     
     def get_session_info(self) -> Dict:
         """Get information about current session"""
         history = self.memory.get_history(self.session_id)
+        snapshot = self.snapshot
         return {
             "session_id": self.session_id,
             "processed_files": self.processed_files,
             "message_count": len(history),
-            "has_text_retriever": self.text_retriever is not None,
-            "has_image_retriever": self.image_retriever is not None
+            "has_text_retriever": snapshot.has("text"),
+            "has_image_retriever": snapshot.has("image"),
+            "text_chunks": snapshot.count("text"),
+            "image_chunks": snapshot.count("image"),
+            "index_version": snapshot.version,
+            "collapsed_duplicates": sum(
+                d.collapsed_chunks for d in list(self.attached_documents.values())
+            ),
+            "suppressed_duplicates": snapshot.suppressed_count(),
+            "pending_image_documents": self.pending_image_documents(),
+            "missing_documents": [
+                d for d in self.missing_documents if d["doc_hash"] not in self.attached_documents
+            ],
+            "image_status": {
+                d.filename: d.image_status for d in list(self.attached_documents.values())
+            },
+            "summary_status": {
+                self.document_names.get(h, h): (self.summary_store.lookup(h) or {}).get("status", "none")
+                for h in list(self.attached_documents)
+            }
         }
 
 
@@ -0,0 +1,231 @@
+"""
+Near-duplicate chunk suppression with 64-bit SimHash.
+
+Pitch decks and reports repeat headers, footers, disclaimers and page
+numbers on every page. Chunks are normalized (case, whitespace, digits),
+fingerprinted over word shingles, and collapsed when their fingerprints are
+within a small Hamming distance. Lookups use banded exact matching, so
+candidate search stays near O(1) per chunk instead of comparing all pairs.
+"""
+import hashlib
+import re
+from typing import Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+SIMHASH_BITS = 64
+DEFAULT_MAX_DISTANCE = 3
+
+_NON_WORD = re.compile(r"[^\w\s]+")
+_DIGITS = re.compile(r"\d+")
+_BIT_POSITIONS = np.arange(SIMHASH_BITS, dtype=np.uint64)
+
+
+def normalize_text(text: str) -> str:
+    """Lowercase, drop punctuation and fold numbers so 'Page 3' == 'Page 4'"""
+    text = _DIGITS.sub("0", text.lower())
+    text = _NON_WORD.sub(" ", text)
+    return " ".join(text.split())
+
+
+def numbers_in(text: str) -> Tuple[str, ...]:
+    return tuple(_DIGITS.findall(text))
+
+
+def numbers_compatible(a: Tuple[str, ...], b: Tuple[str, ...]) -> bool:
+    """
+    Fingerprints fold digits, so confirm that two chunks differ in at most
+    one number (a page counter), not in their figures
+    """
+    if len(a) != len(b):
+        return False
+    return sum(x != y for x, y in zip(a, b)) <= 1
+
+
+def simhash(text: str, shingle_size: int = 3) -> int:
+    """64-bit SimHash over word shingles of the normalized text"""
+    tokens = normalize_text(text).split()
+    if not tokens:
+        return 0
+    if len(tokens) < shingle_size:
+        shingles = [" ".join(tokens)]
+    else:
+        shingles = [
+            " ".join(tokens[i:i + shingle_size])
+            for i in range(len(tokens) - shingle_size + 1)
+        ]
+
+    hashes = np.array(
+        [
+            int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big")
+            for s in shingles
+        ],
+        dtype=np.uint64,
+    )
+    bits = ((hashes[:, None] >> _BIT_POSITIONS) & np.uint64(1)).astype(np.int32)
+    weights = bits.sum(axis=0) * 2 - len(shingles)
+    signature = 0
+    for position in np.nonzero(weights > 0)[0]:
+        signature |= 1 << int(position)
+    return signature
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class SimHashIndex:
+    """
+    Banded lookup table for SimHash signatures. With max_distance + 1 bands,
+    any two signatures within max_distance bits agree exactly on at least
+    one band (pigeonhole), so no near-duplicate is missed.
+    """
+
+    def __init__(self, max_distance: int = DEFAULT_MAX_DISTANCE):
+        self.max_distance = max_distance
+        self.n_bands = max_distance + 1
+        self.band_bits = SIMHASH_BITS // self.n_bands
+        self._mask = (1 << self.band_bits) - 1
+        self._bands: List[Dict[int, List[Tuple[int, Hashable]]]] = [
+            {} for _ in range(self.n_bands)
+        ]
+
+    def _band_keys(self, signature: int):
+        for band in range(self.n_bands):
+            yield band, (signature >> (band * self.band_bits)) & self._mask
+
+    def add(self, key: Hashable, signature: int):
+        for band, band_key in self._band_keys(signature):
+            self._bands[band].setdefault(band_key, []).append((signature, key))
+
+    def query(
+        self,
+        signature: int,
+        accept: Optional[Callable[[Hashable], bool]] = None,
+    ) -> Optional[Hashable]:
+        """Key of the first stored near-duplicate (passing accept, if given), or None"""
+        for band, band_key in self._band_keys(signature):
+            for stored, key in self._bands[band].get(band_key, ()):
+                if hamming_distance(stored, signature) <= self.max_distance:
+                    if accept is None or accept(key):
+                        return key
+        return None
+
+
+class NearDuplicateCollapser:
+    """
+    Streaming within-document dedup: offer chunks one at a time, embed only
+    those accepted. The first occurrence of each near-duplicate group is
+    kept and its metadata records provenance of everything collapsed into
+    it: `duplicates`, `collapsed_chunks` (chunk indices) and, when chunks
+    carry a page, `pages`.
+    """
+
+    def __init__(self, max_distance: int = DEFAULT_MAX_DISTANCE):
+        self.index = SimHashIndex(max_distance)
+        self.metadatas: List[Dict] = []
+        self.signatures: List[int] = []
+        self._numbers: List[Tuple[str, ...]] = []
+        self.collapsed = 0
+
+    def add(self, chunk: str, metadata: Dict) -> bool:
+        """True if the chunk is new and should be embedded"""
+        signature = simhash(chunk)
+        numbers = numbers_in(chunk)
+        match = self.index.query(
+            signature, lambda key: numbers_compatible(self._numbers[key], numbers)
+        )
+
+        if match is None:
+            metadata = dict(metadata)
+            if "page" in metadata:
+                metadata["pages"] = [metadata["page"]]
+            self.index.add(len(self.metadatas), signature)
+            self.metadatas.append(metadata)
+            self.signatures.append(signature)
+            self._numbers.append(numbers)
+            return True
+
+        self.collapsed += 1
+        kept = self.metadatas[match]
+        kept["duplicates"] = kept.get("duplicates", 0) + 1
+        kept.setdefault("collapsed_chunks", []).append(metadata.get("chunk_index"))
+        if "page" in metadata and metadata["page"] not in kept.get("pages", []):
+            kept.setdefault("pages", []).append(metadata["page"])
+        return False
+
+
+def find_session_duplicates(
+    segments: List,
+    max_distance: int = DEFAULT_MAX_DISTANCE,
+) -> Tuple[Dict, Dict]:
+    """
+    Cross-document pass over a session's text segments, in attach order.
+    Segments are shared between sessions and never rewritten, so later
+    near-duplicates are masked rather than removed. Returns
+    ({segment: frozenset(rows)}, {(segment, kept_row): [provenance, ...]}).
+    """
+    index = SimHashIndex(max_distance)
+    suppressed: Dict = {}
+    duplicate_sources: Dict = {}
+
+    for segment in segments:
+        if segment.signatures is None:
+            continue
+        owner = segment.documents[0].metadata.get("doc_hash") if segment.documents else None
+        rows = set()
+        for row, signature in enumerate(segment.signatures):
+            numbers = numbers_in(segment.documents[row].page_content)
+            match = index.query(
+                signature,
+                lambda key: numbers_compatible(
+                    numbers_in(key[0].documents[key[1]].page_content), numbers
+                ),
+            )
+            if match is None:
+                index.add((segment, row, owner), signature)
+                continue
+            kept_segment, kept_row, kept_owner = match
+            if kept_owner == owner:
+                continue
+            rows.add(row)
+            metadata = segment.documents[row].metadata
+            duplicate_sources.setdefault((kept_segment, kept_row), []).append({
+                key: metadata[key]
+                for key in ("source", "doc_hash", "pages", "chunk_index")
+                if key in metadata
+            })
+        if rows:
+            suppressed[segment] = frozenset(rows)
+
+    return suppressed, duplicate_sources
+
+
+def prune_session_duplicates(
+    suppressed: Dict,
+    duplicate_sources: Dict,
+    removed_segments: Iterable,
+) -> Optional[Tuple[Dict, Dict]]:
+    """
+    Session mask after segments are detached, without a new pass. Valid only
+    if none of their rows is the kept copy of a suppressed chunk; otherwise
+    that chunk has to become visible again and None is returned (recompute).
+    """
+    removed = set(removed_segments)
+    if any(segment in removed for segment, _ in duplicate_sources):
+        return None
+
+    owners = {
+        segment.documents[0].metadata.get("doc_hash")
+        for segment in removed
+        if segment.documents
+    }
+    pruned_sources = {}
+    for key, sources in duplicate_sources.items():
+        sources = [source for source in sources if source.get("doc_hash") not in owners]
+        if sources:
+            pruned_sources[key] = sources
+    pruned = {
+        segment: rows for segment, rows in suppressed.items() if segment not in removed
+    }
+    return pruned, pruned_sources
@@ -0,0 +1,294 @@
+"""
+Process-wide content-addressed document corpus shared across sessions.
+
+Documents are keyed by the SHA-256 of the uploaded file. The first session
+to upload a file ingests it (chunks, embeddings, extracted images, OCR text
+and captions) into immutable IndexSegments; every later session uploading
+the same bytes just attaches to the existing entry. Shared artifacts are
+removed only when the last attached session detaches.
+"""
+import hashlib
+import os
+import shutil
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from image_store import ImageStore
+from vector_index import IndexSegment
+
+# Copies of uploads whose image phase outlives the request's temp file
+SPOOL_DIR = "ingest_spool"
+
+# Image enrichment states; "none" means the document has no image phase (e.g. TXT)
+IMAGE_PENDING_STATES = ("lazy", "pending", "running")
+
+
+def file_content_hash(file_path: str, block_size: int = 1024 * 1024) -> str:
+    """SHA-256 of a file's bytes, read in blocks"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class SharedDocument:
+    """One ingested document: its index segments and image store references"""
+
+    def __init__(
+        self,
+        doc_hash: str,
+        filename: str,
+        segments: List[IndexSegment],
+        images: Optional[List[Dict]] = None,
+        collapsed_chunks: int = 0,
+        resumed: Optional[Dict[str, int]] = None,
+    ):
+        self.doc_hash = doc_hash
+        self.filename = filename
+        self.segments = [segment for segment in segments if len(segment)]
+        # Image manifest, filled at extraction time: listing and serving never scan the disk
+        self.images: Dict[str, Dict] = {}
+        self.add_images(images or [])
+        # Near-duplicate chunks folded into a kept chunk before embedding
+        self.collapsed_chunks = collapsed_chunks
+        # Journaled units replayed instead of recomputed while ingesting this document
+        self.resumed: Dict[str, int] = resumed if resumed is not None else {}
+        self.sessions: Set[str] = set()
+
+        # -------- Deferred image phase --------
+        self.image_status = "none"
+        self.image_future: Optional[Future] = None
+        self._image_job: Optional[Callable[[], Tuple[List[IndexSegment], List[Dict]]]] = None
+        self._spool_path: Optional[str] = None
+        self._listeners: Dict[str, Callable[["SharedDocument"], None]] = {}
+        self._lock = threading.Lock()
+
+    def set_image_job(
+        self,
+        job: Callable[[], Tuple[List[IndexSegment], List[Dict]]],
+        status: str = "pending",
+        spool_path: Optional[str] = None,
+    ):
+        """Register the image phase; it runs inline, in the background or lazily"""
+        self._image_job = job
+        self._spool_path = spool_path
+        self.image_status = status
+
+    def run_image_job(self):
+        """Run the image phase once, append its segments and notify attached sessions"""
+        with self._lock:
+            job, self._image_job = self._image_job, None
+            if job is None:
+                return
+            self.image_status = "running"
+
+        try:
+            segments, images = job()
+            self.add_images(images)
+            self.segments.extend(segment for segment in segments if len(segment))
+            self.image_status = "ready"
+        except Exception as e:
+            self.image_status = "failed"
+            print(f"[WARNING] Image enrichment failed for {self.filename}: {e}")
+        finally:
+            if self._spool_path and os.path.exists(self._spool_path):
+                os.unlink(self._spool_path)
+            self._spool_path = None
+
+        for listener in list(self._listeners.values()):
+            try:
+                listener(self)
+            except Exception as e:
+                print(f"[WARNING] Document update listener failed: {e}")
+
+    def discard_image_job(self):
+        """Drop an image phase that has not started (document freed before enrichment)"""
+        with self._lock:
+            if self._image_job is None or self.image_status == "running":
+                return
+            self._image_job = None
+            self.image_status = "none"
+        if self._spool_path and os.path.exists(self._spool_path):
+            os.unlink(self._spool_path)
+        self._spool_path = None
+
+    def add_listener(self, session_id: str, listener: Callable[["SharedDocument"], None]):
+        self._listeners[session_id] = listener
+
+    def remove_listener(self, session_id: str):
+        self._listeners.pop(session_id, None)
+
+    @property
+    def images_pending(self) -> bool:
+        return self.image_status in IMAGE_PENDING_STATES
+
+    def add_images(self, images: List[Dict]):
+        """Manifest entries: image_hash, ext, path, bytes, page, width, height"""
+        for entry in images:
+            self.images.setdefault(entry["image_hash"], entry)
+
+    @property
+    def image_paths(self) -> List[str]:
+        return [entry["path"] for entry in list(self.images.values())]
+
+    @property
+    def image_hashes(self) -> List[str]:
+        return list(self.images)
+
+    @property
+    def refcount(self) -> int:
+        return len(self.sessions)
+
+    def count(self, store_type: str) -> int:
+        return sum(len(s) for s in self.segments if s.store_type == store_type)
+
+
+class SharedDocumentStore:
+    """Reference-counted registry of SharedDocuments keyed by content hash"""
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def get(cls) -> "SharedDocumentStore":
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
+
+    def __init__(self):
+        self._documents: Dict[str, SharedDocument] = {}
+        self._lock = threading.Lock()
+        self._ingest_locks: Dict[str, threading.Lock] = {}
+        self._image_executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv("RAG_IMAGE_WORKERS", "1")),
+            thread_name_prefix="image-enrichment",
+        )
+
+    @staticmethod
+    def spool_file(file_path: str, doc_hash: str) -> str:
+        """Keep a private copy of an upload for a deferred image phase"""
+        os.makedirs(SPOOL_DIR, exist_ok=True)
+        spool_path = os.path.join(SPOOL_DIR, f"{doc_hash}{Path(file_path).suffix.lower()}")
+        if not os.path.exists(spool_path):
+            shutil.copyfile(file_path, spool_path)
+        return spool_path
+
+    def schedule_images(self, document: SharedDocument) -> Optional[Future]:
+        """Queue a document's pending or lazy image phase (idempotent)"""
+        with document._lock:
+            if document._image_job is None:
+                return document.image_future
+            if document.image_future is None:
+                document.image_status = "pending"
+                document.image_future = self._image_executor.submit(
+                    self._run_image_job, document
+                )
+            return document.image_future
+
+    def _run_image_job(self, document: SharedDocument):
+        document.run_image_job()
+        # Every session detached while we were enriching: free what we just produced
+        if document.refcount == 0:
+            self._delete_artifacts(document)
+
+    def pending_image_work(self) -> Dict[str, int]:
+        with self._lock:
+            documents = list(self._documents.values())
+        counts = {state: 0 for state in IMAGE_PENDING_STATES}
+        for document in documents:
+            if document.image_status in counts:
+                counts[document.image_status] += 1
+        return counts
+
+    def lookup(self, doc_hash: str) -> Optional[SharedDocument]:
+        with self._lock:
+            return self._documents.get(doc_hash)
+
+    def attach(
+        self,
+        doc_hash: str,
+        session_id: str,
+        ingest_fn: Callable[[], SharedDocument],
+    ) -> Tuple[SharedDocument, bool]:
+        """
+        Attach session_id to the document, ingesting it first if nobody has.
+        Returns (document, reused). Concurrent uploads of the same bytes
+        ingest once; the others wait and then attach.
+        """
+        with self._lock:
+            document = self._documents.get(doc_hash)
+            if document is not None:
+                document.sessions.add(session_id)
+                return document, True
+            ingest_lock = self._ingest_locks.setdefault(doc_hash, threading.Lock())
+
+        with ingest_lock:
+            with self._lock:
+                document = self._documents.get(doc_hash)
+                if document is not None:
+                    document.sessions.add(session_id)
+                    return document, True
+
+            try:
+                document = ingest_fn()
+                with self._lock:
+                    document.sessions.add(session_id)
+                    self._documents[doc_hash] = document
+            finally:
+                # Also on failure, so failed ingests don't accumulate locks
+                with self._lock:
+                    if self._ingest_locks.get(doc_hash) is ingest_lock:
+                        del self._ingest_locks[doc_hash]
+            return document, False
+
+    def detach(self, doc_hash: str, session_id: str) -> bool:
+        """Drop one session's reference; returns True if the document was freed"""
+        with self._lock:
+            document = self._documents.get(doc_hash)
+            if document is None:
+                return False
+            document.sessions.discard(session_id)
+            document.remove_listener(session_id)
+            if document.sessions:
+                return False
+            del self._documents[doc_hash]
+
+        document.discard_image_job()
+        self._delete_artifacts(document)
+        return True
+
+    def _delete_artifacts(self, document: SharedDocument):
+        if not document.image_paths:
+            return
+        try:
+            deleted = ImageStore.get().release(document.doc_hash, document.image_hashes)
+            print(f"[INFO] Released images for document {document.doc_hash[:12]} "
+                  f"({deleted} no longer referenced)")
+        except Exception as e:
+            print(f"[WARNING] Failed to release document images: {e}")
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            documents = list(self._documents.values())
+        return {
+            "documents": len(documents),
+            "references": sum(d.refcount for d in documents),
+            "text_chunks": sum(d.count("text") for d in documents),
+            "image_chunks": sum(d.count("image") for d in documents),
+            "collapsed_duplicates": sum(d.collapsed_chunks for d in documents),
+            "pending_image_work": self.pending_image_work(),
+            "shared_documents": [
+                {
+                    "doc_hash": d.doc_hash,
+                    "filename": d.filename,
+                    "refcount": d.refcount,
+                }
+                for d in documents
+                if d.refcount > 1
+            ],
+        }
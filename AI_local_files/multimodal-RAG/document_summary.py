@@ -0,0 +1,229 @@
+"""
+Precomputed per-document summaries for whole-document questions.
+
+After a document is attached, a background worker summarizes it map-reduce
+style: chunk texts are packed into groups that fit one small prompt, each
+group is summarized (map), and the partial summaries are merged level by
+level (reduce) until one summary is left. Results are stored in SQLite by
+content hash, so every session that attaches the same document, and every
+restart, reuses them.
+
+"Summarize this deck" / "what is this document about" are then answered
+from the stored summary with one small prompt instead of retrieval.
+"""
+import json
+import os
+import re
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional
+
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import PromptTemplate
+
+SUMMARY_DB = "document_summaries.db"
+
+_DOCUMENT_NOUN = (
+    r"(?:(?:this|these|that|the|my|our)\s+"
+    r"(?:(?:whole|entire|full|uploaded|attached|pitch|annual|research)\s+)?"
+    r"(?:documents?|decks?|files?|pdfs?|reports?|papers?|presentations?|slides|docs?|uploads?)"
+    r"|\S+\.(?:pdf|txt))"
+)
+_WHOLE_DOCUMENT_RE = re.compile(
+    r"^\s*(?:(?:please|can\s+you|could\s+you|would\s+you)\s+)?(?:"
+    # Imperative: "summarize this deck", "give me an overview of the report"
+    r"(?:summari[sz]e|tl;?dr|(?:give|write)\s+(?:me\s+|us\s+)?(?:an?\s+)?"
+    r"(?:(?:brief|short|quick|high[-\s]level)\s+)?(?:summary|overview|tl;?dr|gist))"
+    r"(?:\s+(?:of\s+)?(?:it|this|everything|" + _DOCUMENT_NOUN + r"))?"
+    # Question: "what is this document about"
+    r"|what(?:'s|\s+is|\s+are)\s+" + _DOCUMENT_NOUN + r"\s+about"
+    r")\s*(?:please\s*)?[?.!]*\s*$",
+    re.IGNORECASE,
+)
+
+# Questions naming a part of a document are detail questions for retrieval
+_DOCUMENT_PART_RE = re.compile(
+    r"\b(?:page|slide|section|table|chart|figure|graph|appendix|chapter|paragraph)\b"
+    r"|\b(?:pages|slides|sections|p\.)\s*\d",
+    re.IGNORECASE,
+)
+
+MAP_PROMPT = PromptTemplate(
+    input_variables=["filename", "text"],
+    template="""Summarize this part of the document "{filename}" in 3-6 bullet points.
+Keep names, figures and dates exactly as written.
+
+{text}
+
+Summary:""",
+)
+
+REDUCE_PROMPT = PromptTemplate(
+    input_variables=["filename", "text"],
+    template="""Combine these partial summaries of the document "{filename}" into one
+coherent summary of at most 200 words. Keep the most important facts and figures.
+
+{text}
+
+Summary:""",
+)
+
+
+def is_whole_document_question(question: str, names: Iterable[str] = ()) -> bool:
+    """
+    Questions about a document as a whole rather than a specific detail.
+    `names` are document names that may stand in for "this document"
+    ("summarize the financial model").
+    """
+    if _DOCUMENT_PART_RE.search(question):
+        return False
+    for name in sorted(names, key=len, reverse=True):
+        question = re.sub(
+            r"(?:\b(?:the|this|that|my|our)\s+)?" + re.escape(name) + r"\b",
+            "this document", question, flags=re.IGNORECASE,
+        )
+    return bool(_WHOLE_DOCUMENT_RE.match(question))
+
+
+def pack_texts(texts: List[str], max_chars: int) -> List[str]:
+    """Greedy packing of consecutive texts into groups of at most max_chars"""
+    groups, current, size = [], [], 0
+    for text in texts:
+        text = text[:max_chars]
+        if current and size + len(text) > max_chars:
+            groups.append("\n\n".join(current))
+            current, size = [], 0
+        current.append(text)
+        size += len(text) + 2
+    if current:
+        groups.append("\n\n".join(current))
+    return groups
+
+
+def map_reduce_summary(llm, filename: str, texts: List[str], max_chars: int = 6000) -> Dict:
+    """Summary of a document's chunk texts; the map level is kept as section summaries"""
+    map_chain = MAP_PROMPT | llm | StrOutputParser()
+    reduce_chain = REDUCE_PROMPT | llm | StrOutputParser()
+
+    sections = [
+        map_chain.invoke({"filename": filename, "text": group}).strip()
+        for group in pack_texts(texts, max_chars)
+    ]
+    level = sections
+    while len(level) > 1:
+        groups = pack_texts(level, max_chars)
+        if len(groups) == len(level):
+            # Partial summaries too long to pair up: merge them in twos
+            groups = ["\n\n".join(level[i:i + 2]) for i in range(0, len(level), 2)]
+        level = [
+            reduce_chain.invoke({"filename": filename, "text": group}).strip()
+            for group in groups
+        ]
+    return {"summary": level[0] if level else "", "sections": sections}
+
+
+class DocumentSummaryStore:
+    """Summaries by doc_hash in SQLite, produced by a background worker pool"""
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def get(cls) -> "DocumentSummaryStore":
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
+
+    def __init__(self, db_path: str = SUMMARY_DB):
+        self.db_path = db_path
+        self.max_chars = int(os.getenv("RAG_SUMMARY_CHUNK_CHARS", "6000"))
+        self._lock = threading.Lock()
+        self._in_flight = set()
+        self._executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv("RAG_SUMMARY_WORKERS", "1")),
+            thread_name_prefix="doc-summary",
+        )
+        self.init_db()
+
+    def init_db(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS document_summaries (
+                doc_hash TEXT PRIMARY KEY,
+                filename TEXT,
+                status TEXT,
+                summary TEXT,
+                sections TEXT,
+                error TEXT,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        conn.commit()
+        conn.close()
+
+    def schedule(self, doc_hash: str, filename: str, texts_fn: Callable[[], List[str]], llm) -> bool:
+        """Queue a summary unless one is stored or in progress; returns True if queued"""
+        with self._lock:
+            if doc_hash in self._in_flight:
+                return False
+            existing = self.lookup(doc_hash)
+            if existing is not None and existing["status"] == "ready":
+                return False
+            self._in_flight.add(doc_hash)
+        self._save(doc_hash, filename, "pending")
+        self._executor.submit(self._run, doc_hash, filename, texts_fn, llm)
+        return True
+
+    def _run(self, doc_hash: str, filename: str, texts_fn: Callable[[], List[str]], llm):
+        try:
+            texts = texts_fn()
+            if not texts:
+                self._save(doc_hash, filename, "empty")
+                return
+            self._save(doc_hash, filename, "running")
+            result = map_reduce_summary(llm, filename, texts, self.max_chars)
+            self._save(doc_hash, filename, "ready", result["summary"], result["sections"])
+            print(f"[SUCCESS] Summary ready for {filename} "
+                  f"({len(result['sections'])} section summaries)")
+        except Exception as e:
+            self._save(doc_hash, filename, "failed", error=str(e))
+            print(f"[WARNING] Summary failed for {filename}: {e}")
+        finally:
+            with self._lock:
+                self._in_flight.discard(doc_hash)
+
+    def _save(self, doc_hash: str, filename: str, status: str, summary: Optional[str] = None,
+              sections: Optional[List[str]] = None, error: Optional[str] = None):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("""
+            INSERT OR REPLACE INTO document_summaries
+                (doc_hash, filename, status, summary, sections, error, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+        """, (doc_hash, filename, status, summary,
+              json.dumps(sections) if sections is not None else None, error))
+        conn.commit()
+        conn.close()
+
+    def lookup(self, doc_hash: str) -> Optional[Dict]:
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT filename, status, summary, sections, error, updated_at
+            FROM document_summaries WHERE doc_hash = ?
+        """, (doc_hash,))
+        row = cursor.fetchone()
+        conn.close()
+        if row is None:
+            return None
+        return {
+            "doc_hash": doc_hash,
+            "filename": row[0],
+            "status": row[1],
+            "summary": row[2],
+            "sections": json.loads(row[3]) if row[3] else [],
+            "error": row[4],
+            "updated_at": row[5],
+        }
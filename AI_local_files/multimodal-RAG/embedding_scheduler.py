@@ -0,0 +1,224 @@
+"""
+Process-wide dynamic micro-batching for embedding calls.
+
+Every session submits its embedding work to one scheduler, which coalesces
+queued requests into a single forward pass. A batch is dispatched as soon as
+it is full or the oldest request has waited `max_wait_ms`, so a lone query
+is never held back for more than a few milliseconds.
+"""
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+
+
+class _SubRequest:
+    """One slice (at most max_batch_size items) of a caller's request"""
+    __slots__ = ("items", "parent", "slot", "enqueued_at")
+
+    def __init__(self, items: List[Any], parent: "_ParentRequest", slot: int):
+        self.items = items
+        self.parent = parent
+        self.slot = slot
+        self.enqueued_at = time.perf_counter()
+
+
+class _ParentRequest:
+    """Collects slice results and resolves the caller's future once all are in"""
+
+    def __init__(self, n_slices: int):
+        self.future = Future()
+        self.results = [None] * n_slices
+        self.remaining = n_slices
+        self.lock = threading.Lock()
+
+    def set_slice(self, slot: int, result: np.ndarray):
+        with self.lock:
+            self.results[slot] = result
+            self.remaining -= 1
+            done = self.remaining == 0
+        if done and not self.future.done():
+            self.future.set_result(np.concatenate(self.results, axis=0))
+
+    def set_exception(self, exc: BaseException):
+        if not self.future.done():
+            self.future.set_exception(exc)
+
+
+class EmbeddingScheduler:
+    """
+    Queue embedding requests from all sessions and run them in batches.
+
+    `batch_fn` receives a flat list of items and must return an array with
+    one row per item (a 1-D object array works for string outputs such as
+    captions). Large requests are split into max_batch_size slices so
+    that interactive queries can interleave with bulk ingestion.
+    """
+
+    def __init__(
+        self,
+        batch_fn: Callable[[List[Any]], np.ndarray],
+        max_batch_size: int = 64,
+        max_wait_ms: float = 5.0,
+        name: str = "embeddings",
+        stats_window: int = 1024,
+    ):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self.name = name
+
+        self._queue = deque()
+        self._queued_items = 0
+        self._cond = threading.Condition()
+        self._closed = False
+
+        # -------- Metrics --------
+        self._batch_histogram = {bucket: 0 for bucket in self._histogram_buckets()}
+        self._wait_times_ms = deque(maxlen=stats_window)
+        self._batches_run = 0
+        self._items_embedded = 0
+        self._requests_submitted = 0
+        self._max_queue_depth = 0
+
+        self._worker = threading.Thread(
+            target=self._run, name=f"{name}-scheduler", daemon=True
+        )
+        self._worker.start()
+
+    def _histogram_buckets(self) -> List[int]:
+        buckets, size = [], 1
+        while size < self.max_batch_size:
+            buckets.append(size)
+            size *= 2
+        buckets.append(self.max_batch_size)
+        return buckets
+
+    # ---------- SUBMISSION ----------
+    def submit(self, items: List[Any]) -> Future:
+        """Queue items for embedding; the future resolves to an (n, dim) array"""
+        items = list(items)
+        if not items:
+            future = Future()
+            future.set_result(np.zeros((0, 0), dtype=np.float32))
+            return future
+
+        slices = [
+            items[i:i + self.max_batch_size]
+            for i in range(0, len(items), self.max_batch_size)
+        ]
+        parent = _ParentRequest(len(slices))
+
+        with self._cond:
+            if self._closed:
+                raise RuntimeError(f"Embedding scheduler '{self.name}' is shut down")
+            for slot, chunk in enumerate(slices):
+                self._queue.append(_SubRequest(chunk, parent, slot))
+                self._queued_items += len(chunk)
+            self._requests_submitted += 1
+            self._max_queue_depth = max(self._max_queue_depth, self._queued_items)
+            self._cond.notify()
+
+        return parent.future
+
+    def embed(self, items: List[Any]) -> np.ndarray:
+        """Blocking convenience wrapper around submit()"""
+        return self.submit(items).result()
+
+    # ---------- WORKER ----------
+    def _collect_batch(self) -> List[_SubRequest]:
+        """Block until a batch is ready: full, or the oldest request timed out"""
+        with self._cond:
+            while not self._queue and not self._closed:
+                self._cond.wait()
+            if not self._queue:
+                return []
+
+            deadline = self._queue[0].enqueued_at + self.max_wait
+            while self._queued_items < self.max_batch_size and not self._closed:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            batch, size = [], 0
+            while self._queue and size + len(self._queue[0].items) <= self.max_batch_size:
+                request = self._queue.popleft()
+                batch.append(request)
+                size += len(request.items)
+                self._queued_items -= len(request.items)
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            if not batch:
+                return
+
+            started = time.perf_counter()
+            flat_items = [item for request in batch for item in request.items]
+
+            try:
+                vectors = np.asarray(self.batch_fn(flat_items))
+            except Exception as e:
+                print(f"[WARNING] Embedding batch failed in '{self.name}': {e}")
+                for request in batch:
+                    request.parent.set_exception(e)
+                continue
+
+            offset = 0
+            for request in batch:
+                n = len(request.items)
+                request.parent.set_slice(request.slot, vectors[offset:offset + n])
+                offset += n
+
+            with self._cond:
+                self._batches_run += 1
+                self._items_embedded += len(flat_items)
+                bucket = next(b for b in self._batch_histogram if b >= len(flat_items))
+                self._batch_histogram[bucket] += 1
+                for request in batch:
+                    self._wait_times_ms.append((started - request.enqueued_at) * 1000.0)
+
+    # ---------- METRICS ----------
+    def get_stats(self) -> Dict:
+        """Queue depth, batch size histogram and queue wait times"""
+        with self._cond:
+            waits = np.array(self._wait_times_ms) if self._wait_times_ms else None
+            return {
+                "name": self.name,
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait * 1000.0,
+                "queue_depth": {
+                    "requests": len(self._queue),
+                    "items": self._queued_items,
+                    "max_items_seen": self._max_queue_depth,
+                },
+                "requests_submitted": self._requests_submitted,
+                "batches_run": self._batches_run,
+                "items_embedded": self._items_embedded,
+                "avg_batch_size": round(
+                    self._items_embedded / self._batches_run, 2
+                ) if self._batches_run else 0.0,
+                "batch_size_histogram": {
+                    f"<={bucket}": count
+                    for bucket, count in self._batch_histogram.items()
+                },
+                "wait_ms": {
+                    "samples": 0 if waits is None else int(waits.size),
+                    "mean": 0.0 if waits is None else round(float(waits.mean()), 3),
+                    "p50": 0.0 if waits is None else round(float(np.percentile(waits, 50)), 3),
+                    "p95": 0.0 if waits is None else round(float(np.percentile(waits, 95)), 3),
+                    "max": 0.0 if waits is None else round(float(waits.max()), 3),
+                },
+            }
+
+    def shutdown(self):
+        """Stop accepting work; queued requests are still drained"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._worker.join(timeout=5)
@@ -0,0 +1,386 @@
+"""
+Content-addressed image store with cached enrichment results.
+
+Every extracted image is stored once under the SHA-256 of its bytes:
+    extracted_images/_store/<hash[:2]>/<hash>.<ext>
+A SQLite sidecar index keyed by the same hash caches OCR text, BLIP caption
+and dimensions (and CLIP image vectors per model), so an image that has
+been seen before costs zero model time.
+Documents hold references (image hashes) only; a blob is deleted when its
+last reference is released, while its cached enrichment is kept.
+
+Thumbnails at fixed sizes are generated lazily on first request and cached
+next to the blobs:
+    extracted_images/_thumbs/<size>/<hash[:2]>/<hash>.webp
+"""
+import hashlib
+import io
+import os
+import sqlite3
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+IMAGE_STORE_DIR = os.path.join("extracted_images", "_store")
+IMAGE_INDEX_DB = os.path.join("extracted_images", "image_index.db")
+THUMBNAIL_DIR = os.path.join("extracted_images", "_thumbs")
+# Longest edge of the served thumbnails; any other size is rejected
+THUMBNAIL_SIZES = tuple(
+    int(size) for size in os.getenv("RAG_THUMBNAIL_SIZES", "128,256,512").split(",") if size.strip()
+)
+
+
+def image_content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class ImageStore:
+    """Deduplicated image blobs plus a sidecar cache of OCR/caption/dimensions"""
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def get(cls) -> "ImageStore":
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
+
+    def __init__(self, root_dir: str = IMAGE_STORE_DIR, db_path: str = IMAGE_INDEX_DB,
+                 thumbnail_dir: str = THUMBNAIL_DIR):
+        self.root_dir = root_dir
+        self.db_path = db_path
+        self.thumbnail_dir = thumbnail_dir
+        self._lock = threading.RLock()
+        self._writer = ThreadPoolExecutor(max_workers=2, thread_name_prefix="image-writer")
+        self._pending_writes: Dict[str, Future] = {}
+        os.makedirs(self.root_dir, exist_ok=True)
+        self.init_db()
+        self.sweep_dead_holders()
+
+    def init_db(self):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS image_index (
+                image_hash TEXT PRIMARY KEY,
+                ext TEXT,
+                width INTEGER,
+                height INTEGER,
+                format TEXT,
+                ocr_text TEXT,
+                caption TEXT,
+                enriched INTEGER DEFAULT 0,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS image_vectors (
+                image_hash TEXT,
+                model TEXT,
+                vector BLOB,
+                PRIMARY KEY (image_hash, model)
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS image_refs (
+                image_hash TEXT,
+                holder TEXT,
+                PRIMARY KEY (image_hash, holder)
+            )
+        """)
+        conn.commit()
+        conn.close()
+
+    # ---------- BLOBS ----------
+    def path_for(self, image_hash: str, ext: str) -> str:
+        return os.path.join(self.root_dir, image_hash[:2], f"{image_hash}.{ext}")
+
+    def put(
+        self,
+        data: bytes,
+        ext: str,
+        owner: str,
+        image_hash: Optional[str] = None,
+        write_async: bool = False,
+    ) -> str:
+        """
+        Store bytes under their content hash (no-op if present) and reference
+        them for owner; returns the blob path. With write_async the file is
+        written by a background writer, since it is only needed for serving.
+        """
+        image_hash = image_hash or image_content_hash(data)
+        path = self.path_for(image_hash, ext)
+
+        with self._lock:
+            # Reference first so a concurrent release can't delete the blob under us
+            conn = sqlite3.connect(self.db_path)
+            conn.execute(
+                "INSERT OR IGNORE INTO image_index (image_hash, ext) VALUES (?, ?)",
+                (image_hash, ext)
+            )
+            conn.execute(
+                "INSERT OR IGNORE INTO image_refs (image_hash, holder) VALUES (?, ?)",
+                (image_hash, self.holder_key(owner))
+            )
+            conn.commit()
+            conn.close()
+
+            if os.path.exists(path) or path in self._pending_writes:
+                return path
+            if not write_async:
+                self._write_blob(path, data)
+                return path
+            self._pending_writes[path] = self._writer.submit(self._write_blob, path, data)
+        return path
+
+    def _write_blob(self, path: str, data: bytes):
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"[WARNING] Failed to write image blob {os.path.basename(path)}: {e}")
+        finally:
+            with self._lock:
+                self._pending_writes.pop(path, None)
+
+    def flush(self, timeout: Optional[float] = None):
+        """Wait for pending background writes"""
+        with self._lock:
+            pending = list(self._pending_writes.values())
+        wait(pending, timeout=timeout)
+
+    def wait_for_blob(self, path: str, timeout: Optional[float] = 10.0) -> bool:
+        """True once the blob is on disk (it may still be queued for an async write)"""
+        with self._lock:
+            pending = self._pending_writes.get(path)
+        if pending is not None:
+            wait([pending], timeout=timeout)
+        return os.path.exists(path)
+
+    # ---------- THUMBNAILS ----------
+    def thumbnail_path(self, image_hash: str, size: int) -> str:
+        return os.path.join(self.thumbnail_dir, str(size), image_hash[:2], f"{image_hash}.webp")
+
+    def thumbnail(self, image_hash: str, ext: str, size: int) -> Optional[str]:
+        """Cached thumbnail (longest edge <= size), generated on first use; None if no blob"""
+        if size not in THUMBNAIL_SIZES:
+            raise ValueError(f"Unsupported thumbnail size {size}; use one of {list(THUMBNAIL_SIZES)}")
+        path = self.thumbnail_path(image_hash, size)
+        if os.path.exists(path):
+            return path
+        blob_path = self.path_for(image_hash, ext)
+        if not self.wait_for_blob(blob_path):
+            return None
+
+        from PIL import Image
+        with Image.open(blob_path) as image:
+            image.thumbnail((size, size))
+            if image.mode not in ("RGB", "RGBA"):
+                image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Concurrent requests may both render; the atomic replace keeps one
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            image.save(tmp_path, format="WEBP", quality=80, method=4)
+        os.replace(tmp_path, path)
+        return path
+
+    def _delete_thumbnails(self, image_hash: str):
+        for size in THUMBNAIL_SIZES:
+            path = self.thumbnail_path(image_hash, size)
+            if os.path.exists(path):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+    # ---------- SIDECAR CACHE ----------
+    def get_cached(self, image_hash: str) -> Optional[Dict]:
+        """Cached enrichment for an image, or None if it was never enriched"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT ext, width, height, format, ocr_text, caption
+            FROM image_index WHERE image_hash = ? AND enriched = 1
+        """, (image_hash,))
+        row = cursor.fetchone()
+        conn.close()
+
+        if row is None:
+            return None
+        return {
+            "ext": row[0],
+            "width": row[1],
+            "height": row[2],
+            "format": row[3],
+            "ocr_text": row[4] or "",
+            "caption": row[5] or "",
+        }
+
+    def save_enrichment(
+        self,
+        image_hash: str,
+        ext: str,
+        width: Optional[int],
+        height: Optional[int],
+        format_type: Optional[str],
+        ocr_text: str,
+        caption: str,
+    ):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("""
+            INSERT INTO image_index (image_hash, ext, width, height, format, ocr_text, caption, enriched)
+            VALUES (?, ?, ?, ?, ?, ?, ?, 1)
+            ON CONFLICT(image_hash) DO UPDATE SET
+                width = excluded.width,
+                height = excluded.height,
+                format = excluded.format,
+                ocr_text = excluded.ocr_text,
+                caption = excluded.caption,
+                enriched = 1
+        """, (image_hash, ext, width, height, format_type, ocr_text, caption))
+        conn.commit()
+        conn.close()
+
+    def get_vectors(self, image_hashes: List[str], model: str) -> Dict[str, np.ndarray]:
+        """Cached image embeddings of one model, by image hash"""
+        if not image_hashes:
+            return {}
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT image_hash, vector FROM image_vectors
+            WHERE model = ? AND image_hash IN ({",".join("?" * len(image_hashes))})
+        """, (model, *image_hashes))
+        rows = cursor.fetchall()
+        conn.close()
+        return {
+            image_hash: np.load(io.BytesIO(payload), allow_pickle=False)
+            for image_hash, payload in rows
+        }
+
+    def save_vectors(self, vectors: Dict[str, np.ndarray], model: str):
+        rows = []
+        for image_hash, vector in vectors.items():
+            buf = io.BytesIO()
+            np.save(buf, np.asarray(vector, dtype=np.float32), allow_pickle=False)
+            rows.append((image_hash, model, sqlite3.Binary(buf.getvalue())))
+        conn = sqlite3.connect(self.db_path)
+        conn.executemany(
+            "INSERT OR REPLACE INTO image_vectors (image_hash, model, vector) VALUES (?, ?, ?)",
+            rows
+        )
+        conn.commit()
+        conn.close()
+
+    # ---------- REFERENCES ----------
+    @staticmethod
+    def holder_key(owner: str) -> str:
+        """References are scoped per worker process so a crash can't pin blobs forever"""
+        return f"{os.getpid()}:{owner}"
+
+    def release(self, owner: str, image_hashes: Iterable[str]) -> int:
+        """Drop owner's references; returns how many blobs were deleted"""
+        holder = self.holder_key(owner)
+        image_hashes = list(set(image_hashes))
+        conn = sqlite3.connect(self.db_path)
+        conn.executemany(
+            "DELETE FROM image_refs WHERE image_hash = ? AND holder = ?",
+            [(h, holder) for h in image_hashes]
+        )
+        conn.commit()
+        conn.close()
+        return self._delete_unreferenced(image_hashes)
+
+    def _delete_unreferenced(self, image_hashes: List[str]) -> int:
+        deleted = 0
+        with self._lock:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            for image_hash in image_hashes:
+                cursor.execute(
+                    "SELECT COUNT(*) FROM image_refs WHERE image_hash = ?", (image_hash,)
+                )
+                if cursor.fetchone()[0]:
+                    continue
+                cursor.execute(
+                    "SELECT ext FROM image_index WHERE image_hash = ?", (image_hash,)
+                )
+                row = cursor.fetchone()
+                if row is None:
+                    continue
+                path = self.path_for(image_hash, row[0])
+                if path in self._pending_writes:
+                    self._pending_writes[path].add_done_callback(
+                        lambda _, h=image_hash: self._delete_unreferenced([h])
+                    )
+                    continue
+                if os.path.exists(path):
+                    try:
+                        os.unlink(path)
+                        deleted += 1
+                    except OSError as e:
+                        print(f"[WARNING] Failed to delete image blob {image_hash[:12]}: {e}")
+                self._delete_thumbnails(image_hash)
+            conn.close()
+        return deleted
+
+    def sweep_dead_holders(self) -> int:
+        """Drop references held by worker processes that no longer exist"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("SELECT DISTINCT holder FROM image_refs")
+        dead = [
+            holder for (holder,) in cursor.fetchall()
+            if not holder.split(":", 1)[0].isdigit()
+            or not pid_alive(int(holder.split(":", 1)[0]))
+        ]
+        cursor.executemany("DELETE FROM image_refs WHERE holder = ?", [(h,) for h in dead])
+        conn.commit()
+        conn.close()
+        return len(dead)
+
+    def collect_garbage(self) -> int:
+        """Delete every stored blob that has no live reference"""
+        self.sweep_dead_holders()
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT image_hash FROM image_index
+            WHERE image_hash NOT IN (SELECT image_hash FROM image_refs)
+        """)
+        orphans = [row[0] for row in cursor.fetchall()]
+        conn.close()
+        return self._delete_unreferenced(orphans)
+
+    def get_stats(self) -> Dict:
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*), SUM(enriched) FROM image_index")
+        indexed, enriched = cursor.fetchone()
+        cursor.execute("SELECT COUNT(DISTINCT image_hash), COUNT(*) FROM image_refs")
+        referenced, references = cursor.fetchone()
+        conn.close()
+        return {
+            "indexed_images": indexed or 0,
+            "cached_enrichments": enriched or 0,
+            "referenced_images": referenced or 0,
+            "references": references or 0,
+        }
@@ -0,0 +1,237 @@
+"""
+Pre-ingestion cost estimation and per-session quotas.
+
+A pre-scan opens each upload with fitz and reads only structure: page
+count, text-layer size, scanned pages, image count and image pixels (from
+the image headers, nothing is decoded). Ingestion time is then estimated
+from per-stage throughput measured on real ingestions in this process, and
+quotas are checked before any expensive work starts.
+"""
+import os
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+import fitz
+
+from document_store import SharedDocumentStore, file_content_hash
+
+# Scan fields that add up across files and count towards a session's quota
+USAGE_FIELDS = ("files", "pages", "text_bytes", "scanned_pages", "images", "image_megapixels")
+
+
+class QuotaExceededError(Exception):
+    """Upload would push a session past one of its quotas"""
+
+    def __init__(self, violations: List[str]):
+        self.violations = violations
+        super().__init__("Session quota exceeded: " + "; ".join(violations))
+
+
+def scan_file(file_path: str, min_text_chars: int = 20) -> Dict:
+    """Structural pre-scan of a PDF or TXT file; cost is independent of image sizes"""
+    scan = {field: 0 for field in USAGE_FIELDS}
+    scan["files"] = 1
+    scan["file_bytes"] = os.path.getsize(file_path)
+
+    if Path(file_path).suffix.lower() != ".pdf":
+        scan["text_bytes"] = scan["file_bytes"]
+        return scan
+
+    doc = fitz.open(file_path)
+    seen = set()
+    pixels = 0
+    try:
+        scan["pages"] = len(doc)
+        for page in doc:
+            text = page.get_text()
+            images = page.get_images(full=True)
+            scan["text_bytes"] += len(text.encode("utf-8"))
+            if len(text.strip()) < min_text_chars and images:
+                scan["scanned_pages"] += 1
+            for img in images:
+                xref, width, height = img[0], img[2], img[3]
+                if xref not in seen:
+                    seen.add(xref)
+                    pixels += width * height
+    finally:
+        doc.close()
+
+    scan["images"] = len(seen)
+    scan["image_megapixels"] = round(pixels / 1e6, 2)
+    return scan
+
+
+def sum_usage(scans: Iterable[Dict]) -> Dict:
+    usage = {field: 0 for field in USAGE_FIELDS}
+    for scan in scans:
+        for field in USAGE_FIELDS:
+            usage[field] += scan.get(field, 0)
+    usage["image_megapixels"] = round(usage["image_megapixels"], 2)
+    return usage
+
+
+class IngestThroughput:
+    """
+    Process-wide moving average of seconds per unit for each ingestion stage,
+    seeded with conservative CPU defaults until real measurements arrive
+    """
+
+    # stage -> (unit, default seconds per unit)
+    STAGES = {
+        "text": ("byte", 5e-5),
+        "page_ocr": ("page", 1.5),
+        "image": ("image", 1.0),
+    }
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def get(cls) -> "IngestThroughput":
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
+
+    def __init__(self, alpha: float = 0.3):
+        self.alpha = alpha
+        self._lock = threading.Lock()
+        self._seconds_per_unit = {stage: default for stage, (_, default) in self.STAGES.items()}
+        self._samples = {stage: 0 for stage in self.STAGES}
+
+    def record(self, stage: str, units: float, seconds: float):
+        if units <= 0 or seconds <= 0:
+            return
+        rate = seconds / units
+        with self._lock:
+            if self._samples[stage] == 0:
+                self._seconds_per_unit[stage] = rate
+            else:
+                previous = self._seconds_per_unit[stage]
+                self._seconds_per_unit[stage] = previous + self.alpha * (rate - previous)
+            self._samples[stage] += 1
+
+    def seconds_per_unit(self, stage: str) -> float:
+        with self._lock:
+            return self._seconds_per_unit[stage]
+
+    def estimate(self, usage: Dict, image_mode: str = "sync", ocr_workers: int = 1) -> Dict:
+        """Seconds per stage, total, and how long the upload request itself blocks"""
+        text = usage["text_bytes"] * self.seconds_per_unit("text")
+        ocr = usage["scanned_pages"] * self.seconds_per_unit("page_ocr") / max(ocr_workers, 1)
+        images = usage["images"] * self.seconds_per_unit("image")
+        blocking = text + ocr + (images if image_mode == "sync" else 0.0)
+        return {
+            "text_seconds": round(text, 2),
+            "page_ocr_seconds": round(ocr, 2),
+            "image_seconds": round(images, 2),
+            "total_seconds": round(text + ocr + images, 2),
+            "blocking_seconds": round(blocking, 2),
+        }
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return {
+                stage: {
+                    "unit": unit,
+                    "seconds_per_unit": self._seconds_per_unit[stage],
+                    "samples": self._samples[stage],
+                    "measured": self._samples[stage] > 0,
+                }
+                for stage, (unit, _) in self.STAGES.items()
+            }
+
+
+class SessionQuota:
+    """Per-session limits from RAG_QUOTA_* env vars; unset or 0 means unlimited"""
+
+    ENV_LIMITS = {
+        "files": "RAG_QUOTA_MAX_FILES",
+        "pages": "RAG_QUOTA_MAX_PAGES",
+        "images": "RAG_QUOTA_MAX_IMAGES",
+        "image_megapixels": "RAG_QUOTA_MAX_IMAGE_MEGAPIXELS",
+        "estimated_seconds": "RAG_QUOTA_MAX_SECONDS",
+    }
+
+    def __init__(self, limits: Optional[Dict[str, float]] = None):
+        if limits is None:
+            limits = {
+                field: float(os.getenv(env, "0") or 0)
+                for field, env in self.ENV_LIMITS.items()
+            }
+        self.limits = {field: limit for field, limit in limits.items() if limit > 0}
+
+    def check(self, current: Dict, incoming: Dict, estimated_seconds: float) -> List[str]:
+        """Violations if incoming were added to current usage; empty when allowed"""
+        violations = []
+        for field, limit in self.limits.items():
+            if field == "estimated_seconds":
+                if estimated_seconds > limit:
+                    violations.append(
+                        f"estimated ingestion time {estimated_seconds:.0f}s exceeds {limit:.0f}s"
+                    )
+                continue
+            total = current.get(field, 0) + incoming.get(field, 0)
+            if total > limit:
+                violations.append(
+                    f"{field} would reach {total:g} (limit {limit:g}, "
+                    f"already used {current.get(field, 0):g})"
+                )
+        return violations
+
+
+def plan_ingestion(
+    file_paths: List[str],
+    image_mode: str = "sync",
+    attached: Optional[Dict[str, Dict]] = None,
+    quota: Optional[SessionQuota] = None,
+    ocr_workers: int = 1,
+) -> Dict:
+    """
+    Pre-scan uploads against a session (attached: doc_hash -> scan of its
+    documents). Files already in the session are free and not counted;
+    files ingested by another session cost no time but count towards the
+    quota; only new files are estimated.
+    """
+    attached = attached or {}
+    quota = quota or SessionQuota()
+    throughput = IngestThroughput.get()
+    store = SharedDocumentStore.get()
+
+    files = []
+    for file_path in file_paths:
+        doc_hash = file_content_hash(file_path)
+        scan = scan_file(file_path)
+        if doc_hash in attached:
+            status = "attached"
+        elif store.lookup(doc_hash) is not None:
+            status = "shared"
+        else:
+            status = "new"
+        files.append({
+            "path": file_path,
+            "doc_hash": doc_hash,
+            "status": status,
+            "scan": scan,
+            "estimate": throughput.estimate(scan, image_mode, ocr_workers)
+            if status == "new" else None,
+        })
+
+    incoming = sum_usage(f["scan"] for f in files if f["status"] != "attached")
+    estimate = throughput.estimate(
+        sum_usage(f["scan"] for f in files if f["status"] == "new"), image_mode, ocr_workers
+    )
+    current = sum_usage(attached.values())
+    violations = quota.check(current, incoming, estimate["total_seconds"])
+    return {
+        "image_mode": image_mode,
+        "files": files,
+        "incoming": incoming,
+        "estimate": estimate,
+        "session_usage": current,
+        "quota": quota.limits,
+        "violations": violations,
+        "allowed": not violations,
+    }
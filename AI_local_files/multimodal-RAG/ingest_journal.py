@@ -0,0 +1,314 @@
+"""
+Checkpoint journal for resumable ingestion.
+
+Every upload runs as a job recorded in a SQLite journal together with a
+private spooled copy of its files. While a document is ingested, completed
+units of work are checkpointed under an ingest key (document hash plus
+chunking configuration):
+    ocr_page     -> OCR text of one scanned page
+    text_batch   -> vectors of one embedded chunk batch
+    image_batch  -> vectors of one enriched image batch
+(OCR text and captions of images are already cached by the image store.)
+
+If the worker dies, a restarted worker claims the unfinished job, replays
+the checkpoints and only computes what is missing. Checkpoints are keyed by
+a digest of the batch contents, so a changed chunker never reuses stale
+vectors.
+"""
+import hashlib
+import io
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import uuid
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from image_store import pid_alive
+
+INGEST_JOURNAL_DB = "ingest_journal.db"
+JOB_SPOOL_DIR = os.path.join("ingest_spool", "jobs")
+
+JOB_ACTIVE_STATES = ("queued", "running")
+
+# Job owner is "<pid>:<token>": a restarted container often reuses the same pid
+_PROCESS_TOKEN = uuid.uuid4().hex[:8]
+
+
+def owner_key() -> str:
+    return f"{os.getpid()}:{_PROCESS_TOKEN}"
+
+
+def _owner_alive(owner: Optional[str]) -> bool:
+    pid, _, token = (owner or "").partition(":")
+    if not pid.isdigit():
+        return False
+    if int(pid) == os.getpid():
+        return token == _PROCESS_TOKEN
+    return pid_alive(int(pid))
+
+
+def batch_digest(texts: List[str]) -> str:
+    digest = hashlib.sha1()
+    for text in texts:
+        digest.update(text.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def _pack_vectors(vectors: np.ndarray) -> bytes:
+    buf = io.BytesIO()
+    np.save(buf, np.ascontiguousarray(vectors, dtype=np.float32), allow_pickle=False)
+    return buf.getvalue()
+
+
+def _unpack_vectors(payload: bytes) -> np.ndarray:
+    return np.load(io.BytesIO(payload), allow_pickle=False)
+
+
+class IngestJournal:
+    """Jobs and per-document checkpoints, one SQLite connection per operation"""
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def get(cls) -> "IngestJournal":
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
+
+    def __init__(self, db_path: str = INGEST_JOURNAL_DB):
+        self.db_path = db_path
+        self.enabled = os.getenv("RAG_JOURNAL", "1") != "0"
+        self.init_db()
+
+    def init_db(self):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS ingest_jobs (
+                job_id TEXT PRIMARY KEY,
+                session_id TEXT,
+                files TEXT,
+                image_mode TEXT,
+                status TEXT,
+                owner TEXT,
+                resumed INTEGER DEFAULT 0,
+                result TEXT,
+                error TEXT,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                session_documents TEXT
+            )
+        """)
+        cursor.execute("PRAGMA table_info(ingest_jobs)")
+        if "session_documents" not in {row[1] for row in cursor.fetchall()}:
+            cursor.execute("ALTER TABLE ingest_jobs ADD COLUMN session_documents TEXT")
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS ingest_checkpoints (
+                ingest_key TEXT,
+                kind TEXT,
+                item INTEGER,
+                digest TEXT,
+                payload BLOB,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (ingest_key, kind, item)
+            )
+        """)
+        conn.commit()
+        conn.close()
+
+    # ---------- JOBS ----------
+    def create_job(
+        self,
+        session_id: str,
+        files: List[Tuple[str, str]],
+        image_mode: Optional[str] = None,
+        session_documents: Optional[List[Dict]] = None,
+    ) -> Dict:
+        """
+        Record a job for (file_path, original_filename) pairs; the files are
+        moved to the job spool so a restarted worker can still read them.
+        session_documents ({doc_hash, filename}) are the documents the session
+        already held, so a resumed job can tell what a restart lost.
+        """
+        job_id = uuid.uuid4().hex
+        os.makedirs(JOB_SPOOL_DIR, exist_ok=True)
+        spooled = []
+        for index, (file_path, filename) in enumerate(files):
+            spool_path = os.path.join(
+                JOB_SPOOL_DIR, f"{job_id}_{index}{Path(filename).suffix.lower()}"
+            )
+            shutil.move(file_path, spool_path)
+            spooled.append({"filename": filename, "path": spool_path})
+
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("""
+            INSERT INTO ingest_jobs (job_id, session_id, files, image_mode, status, owner,
+                                     session_documents)
+            VALUES (?, ?, ?, ?, 'queued', ?, ?)
+        """, (job_id, session_id, json.dumps(spooled), image_mode, owner_key(),
+              json.dumps(session_documents or [])))
+        conn.commit()
+        conn.close()
+        return self.get_job(job_id)
+
+    def update_job(self, job_id: str, status: str, result: Optional[Dict] = None,
+                   error: Optional[str] = None):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("""
+            UPDATE ingest_jobs
+            SET status = ?, result = COALESCE(?, result), error = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE job_id = ?
+        """, (status, json.dumps(result) if result is not None else None, error, job_id))
+        conn.commit()
+        conn.close()
+
+    def finish_job(self, job_id: str, status: str, result: Optional[Dict] = None,
+                   error: Optional[str] = None):
+        """Final state; the job's spooled files are no longer needed"""
+        self.update_job(job_id, status, result, error)
+        job = self.get_job(job_id)
+        for entry in (job or {}).get("files", []):
+            if os.path.exists(entry["path"]):
+                os.unlink(entry["path"])
+
+    def claim_orphaned_jobs(self) -> List[Dict]:
+        """
+        Take over unfinished jobs whose worker process is gone; they are
+        marked resumed and owned by this process
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT job_id, owner FROM ingest_jobs WHERE status IN (?, ?)", JOB_ACTIVE_STATES
+        )
+        orphaned = [
+            (job_id, owner) for job_id, owner in cursor.fetchall()
+            if not _owner_alive(owner)
+        ]
+        claimed = []
+        for job_id, owner in orphaned:
+            # Conditional on the dead owner, so two restarting workers can't both claim a job
+            cursor.execute("""
+                UPDATE ingest_jobs
+                SET owner = ?, status = 'queued', resumed = resumed + 1, updated_at = CURRENT_TIMESTAMP
+                WHERE job_id = ? AND owner IS ? AND status IN (?, ?)
+            """, (owner_key(), job_id, owner, *JOB_ACTIVE_STATES))
+            if cursor.rowcount:
+                claimed.append(job_id)
+        conn.commit()
+        conn.close()
+        return [self.get_job(job_id) for job_id in claimed]
+
+    def get_job(self, job_id: str) -> Optional[Dict]:
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT job_id, session_id, files, image_mode, status, resumed, result, error,
+                   created_at, updated_at, session_documents
+            FROM ingest_jobs WHERE job_id = ?
+        """, (job_id,))
+        row = cursor.fetchone()
+        conn.close()
+        return self._job_row(row) if row else None
+
+    def list_jobs(self, session_id: Optional[str] = None, limit: int = 50) -> List[Dict]:
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        query = """
+            SELECT job_id, session_id, files, image_mode, status, resumed, result, error,
+                   created_at, updated_at, session_documents
+            FROM ingest_jobs
+        """
+        params: tuple = ()
+        if session_id:
+            query += " WHERE session_id = ?"
+            params = (session_id,)
+        cursor.execute(query + " ORDER BY created_at DESC LIMIT ?", params + (limit,))
+        rows = cursor.fetchall()
+        conn.close()
+        return [self._job_row(row) for row in rows]
+
+    @staticmethod
+    def _job_row(row) -> Dict:
+        return {
+            "job_id": row[0],
+            "session_id": row[1],
+            "files": json.loads(row[2] or "[]"),
+            "image_mode": row[3],
+            "status": row[4],
+            "resumed": bool(row[5]),
+            "resume_count": row[5],
+            "result": json.loads(row[6]) if row[6] else None,
+            "error": row[7],
+            "created_at": row[8],
+            "updated_at": row[9],
+            "session_documents": json.loads(row[10] or "[]"),
+        }
+
+    # ---------- CHECKPOINTS ----------
+    def save_checkpoint(self, ingest_key: str, kind: str, item: int, digest: str,
+                        payload: bytes):
+        if not self.enabled:
+            return
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("""
+            INSERT OR REPLACE INTO ingest_checkpoints (ingest_key, kind, item, digest, payload)
+            VALUES (?, ?, ?, ?, ?)
+        """, (ingest_key, kind, item, digest, sqlite3.Binary(payload)))
+        conn.commit()
+        conn.close()
+
+    def load_checkpoints(self, ingest_key: str, kind: str) -> Dict[int, Tuple[str, bytes]]:
+        """item -> (digest, payload) for one ingest key and kind"""
+        if not self.enabled:
+            return {}
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT item, digest, payload FROM ingest_checkpoints
+            WHERE ingest_key = ? AND kind = ?
+        """, (ingest_key, kind))
+        rows = cursor.fetchall()
+        conn.close()
+        return {item: (digest, bytes(payload)) for item, digest, payload in rows}
+
+    def save_vectors(self, ingest_key: str, kind: str, item: int, texts: List[str],
+                     vectors: np.ndarray):
+        self.save_checkpoint(ingest_key, kind, item, batch_digest(texts), _pack_vectors(vectors))
+
+    def load_vectors(self, ingest_key: str, kind: str) -> Dict[int, Tuple[str, np.ndarray]]:
+        return {
+            item: (digest, _unpack_vectors(payload))
+            for item, (digest, payload) in self.load_checkpoints(ingest_key, kind).items()
+        }
+
+    def clear_checkpoints(self, ingest_key: str, kinds: Optional[Tuple[str, ...]] = None):
+        conn = sqlite3.connect(self.db_path)
+        if kinds:
+            conn.executemany(
+                "DELETE FROM ingest_checkpoints WHERE ingest_key = ? AND kind = ?",
+                [(ingest_key, kind) for kind in kinds]
+            )
+        else:
+            conn.execute("DELETE FROM ingest_checkpoints WHERE ingest_key = ?", (ingest_key,))
+        conn.commit()
+        conn.close()
+
+    def checkpoint_counts(self, ingest_key: str) -> Dict[str, int]:
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT kind, COUNT(*) FROM ingest_checkpoints WHERE ingest_key = ? GROUP BY kind
+        """, (ingest_key,))
+        counts = dict(cursor.fetchall())
+        conn.close()
+        return counts
@@ -0,0 +1,150 @@
+"""
+Lexical (BM25) retrieval next to the vector stores.
+
+Every IndexSegment carries a compact inverted index of its rows, built once
+at ingestion: term -> (row ids as int32, term frequencies as uint16). A new
+upload only adds segments, so nothing is rebuilt; the corpus statistics BM25
+needs (document count, average length, document frequency of the query
+terms) are summed over a snapshot's segments at query time.
+
+Exact tokens such as figures, acronyms and OCR'd numbers are where CLIP
+text embeddings (truncated at 77 tokens) are weakest, so keyword-dominant
+questions can be answered from this index alone, and all others fuse both
+rankings with reciprocal-rank fusion.
+"""
+import math
+import re
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Sequence, Set, Tuple
+
+import numpy as np
+
+_TOKEN_RE = re.compile(r"[A-Za-z0-9]+(?:[.,'][A-Za-z0-9]+)*")
+_NUMBER_GROUP_RE = re.compile(r"^\d{1,3}(?:,\d{3})+(?:\.\d+)?$")
+_QUOTED_RE = re.compile(r"\"([^\"]+)\"")
+
+STOPWORDS = frozenset("""
+a about after all also an and any are as at be been but by can could did do does
+for from had has have how i if in into is it its me my no not of on or our so
+such than that the their them then there these they this those to was we were
+what when where which who whom why will with would you your
+""".split())
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased word/number tokens; thousands separators are dropped (1,200 -> 1200)"""
+    tokens = []
+    for match in _TOKEN_RE.finditer(text):
+        token = match.group()
+        if _NUMBER_GROUP_RE.match(token):
+            token = token.replace(",", "")
+        token = token.lower().strip(".,'")
+        if token and token not in STOPWORDS:
+            tokens.append(token)
+    return tokens
+
+
+def anchor_terms(question: str) -> Set[str]:
+    """
+    Terms a keyword question hinges on: anything with a digit, acronyms
+    (CAC, EBITDA) and quoted phrases
+    """
+    anchors = set()
+    for phrase in _QUOTED_RE.findall(question):
+        anchors.update(tokenize(phrase))
+    for match in _TOKEN_RE.finditer(question):
+        token = match.group()
+        if any(c.isdigit() for c in token) or (len(token) >= 2 and token.isupper()):
+            anchors.update(tokenize(token))
+    return anchors
+
+
+def is_keyword_query(question: str, max_terms: int = 8, min_anchor_ratio: float = 0.5) -> bool:
+    """
+    Short questions built around exact tokens, where lexical matching should
+    win: anchor terms must make up at least min_anchor_ratio of the terms, so
+    "how did revenue grow in 2023" still goes through the embeddings
+    """
+    terms = set(tokenize(question))
+    if not terms or len(terms) > max_terms:
+        return False
+    anchors = anchor_terms(question) & terms
+    return len(anchors) / len(terms) >= min_anchor_ratio
+
+
+class LexicalPostings:
+    """Inverted index of one segment's rows"""
+
+    def __init__(self, texts: Iterable[str]):
+        rows: Dict[str, List[int]] = defaultdict(list)
+        freqs: Dict[str, List[int]] = defaultdict(list)
+        lengths = []
+        for row, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            lengths.append(sum(counts.values()))
+            for term, tf in counts.items():
+                rows[term].append(row)
+                freqs[term].append(tf)
+
+        self.postings: Dict[str, Tuple[np.ndarray, np.ndarray]] = {
+            term: (
+                np.array(rows[term], dtype=np.int32),
+                np.minimum(np.array(freqs[term]), np.iinfo(np.uint16).max).astype(np.uint16),
+            )
+            for term in rows
+        }
+        self.lengths = np.array(lengths, dtype=np.int32)
+        self.total_length = int(self.lengths.sum())
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    def df(self, term: str) -> int:
+        posting = self.postings.get(term)
+        return len(posting[0]) if posting is not None else 0
+
+    def score(
+        self,
+        terms: Sequence[str],
+        idf: Dict[str, float],
+        avgdl: float,
+        required: Set[str] = frozenset(),
+        k1: float = 1.2,
+        b: float = 0.75,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        BM25 over the rows containing any query term (work is proportional to
+        the postings touched). Returns (rows, scores, covers_required).
+        """
+        row_parts, score_parts, required_parts = [], [], []
+        for term in terms:
+            posting = self.postings.get(term)
+            if posting is None:
+                continue
+            rows, tfs = posting
+            tf = tfs.astype(np.float32)
+            norm = k1 * (1 - b + b * self.lengths[rows] / max(avgdl, 1e-9))
+            row_parts.append(rows)
+            score_parts.append(idf[term] * tf * (k1 + 1) / (tf + norm))
+            required_parts.append(np.full(len(rows), term in required, dtype=np.int32))
+        if not row_parts:
+            empty = np.empty(0, dtype=np.int32)
+            return empty, np.empty(0, dtype=np.float32), np.empty(0, dtype=bool)
+
+        matched, inverse = np.unique(np.concatenate(row_parts), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(score_parts))
+        required_hits = np.bincount(inverse, weights=np.concatenate(required_parts))
+        return matched, scores, required_hits >= len(required)
+
+
+def bm25_idf(n_rows: int, df: int) -> float:
+    return math.log(1 + (n_rows - df + 0.5) / (df + 0.5))
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence], k: int = 60) -> List:
+    """Fuse ranked lists of hashable keys; a key's score is the sum of 1 / (k + rank)"""
+    scores: Dict = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
@@ -1,17 +1,31 @@
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, BackgroundTasks, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from fastapi.concurrency import iterate_in_threadpool, run_in_threadpool
 from pydantic import BaseModel
-from typing import Optional, List
+from typing import Optional, List, Tuple
+import asyncio
+import base64
+import json
+import mimetypes
+import time
 import tempfile
 import os
 import shutil
+from datetime import datetime
+from email.utils import parsedate_to_datetime
 from pathlib import Path
 from groq import Groq
 from dotenv import load_dotenv
 
 # Import your UPDATED RAG pipeline
-from chattingh import AgenticRAGPipeline
+from chattingh import IMAGE_MODES, AgenticRAGPipeline, SharedModelHub, get_model_hub
+from document_store import SharedDocumentStore
+from image_store import IMAGE_STORE_DIR, THUMBNAIL_DIR, THUMBNAIL_SIZES, ImageStore
+from ingest_estimator import IngestThroughput, QuotaExceededError, SessionQuota, plan_ingestion
+from ingest_journal import IngestJournal
+from vector_index import RetrievalFilter
+from voice_transcription import PCMSegmenter, TranscriptionCache, create_transcriber
 
 load_dotenv()
 
@@ -35,9 +49,25 @@ app.add_middleware(
 groq_client = Groq(api_key=os.getenv("GROQ_API_KEY"))
 print("[SUCCESS] Groq Whisper API initialized")
 
+# Segment transcriber of the streaming voice endpoint (RAG_TRANSCRIBER: whisper or local)
+VOICE_SEGMENT_SECONDS = float(os.getenv("RAG_VOICE_SEGMENT_SECONDS", "4"))
+VOICE_MAX_SECONDS = float(os.getenv("RAG_VOICE_MAX_SECONDS", "120"))
+# Cap for "file" recordings, which cannot be measured in seconds until decoded (Groq accepts 25 MB)
+VOICE_MAX_BYTES = int(os.getenv("RAG_VOICE_MAX_BYTES", str(25 * 1024 * 1024)))
+
 # Store active RAG sessions (in production, use Redis or database)
 active_sessions = {}
 
+# Upper bound on questions per /ask-batch request
+MAX_BATCH_QUESTIONS = int(os.getenv("RAG_BATCH_MAX_QUESTIONS", "100"))
+
+# GET /sessions ordering and page size
+SESSION_SORT_KEYS = (
+    "last_active_at", "created_at", "messages", "documents",
+    "text_chunks", "image_chunks", "images", "session_id"
+)
+MAX_SESSIONS_PAGE = 200
+
 # Request/Response models
 class TextQueryRequest(BaseModel):
     session_id: str
@@ -53,6 +83,20 @@ class QueryResponse(BaseModel):
     rewritten_query: Optional[str] = None
     sources: List[str] = []
     transcribed_text: Optional[str] = None  # For voice queries
+    transcription_cached: Optional[bool] = None  # Same audio was transcribed before
+    history_tokens: Optional[dict] = None  # Prompt history tokens vs. the last 4 raw messages
+    pending_image_documents: int = 0  # Images still being enriched; ask again to include them
+
+class RetrievalFilterSpec(BaseModel):
+    sources: Optional[List[str]] = None  # Filenames or doc hashes of attached documents
+    types: Optional[List[str]] = None  # "text" and/or "image"
+    page_from: Optional[int] = None  # 1-based, inclusive
+    page_to: Optional[int] = None
+
+class BatchQuestionRequest(BaseModel):
+    questions: List[str]
+    filters: Optional[RetrievalFilterSpec] = None
+    max_concurrency: Optional[int] = None  # Parallel generator calls (RAG_BATCH_CONCURRENCY)
 
 class SessionInfo(BaseModel):
     session_id: str
@@ -62,6 +106,11 @@ class SessionInfo(BaseModel):
     has_image_retriever: bool  # UPDATED
     text_chunks_total: int  # NEW
     image_chunks_total: int  # NEW
+    index_version: int = 0  # Committed snapshot version
+    pending_image_documents: int = 0
+    collapsed_duplicates: int = 0  # Near-duplicate chunks folded at ingest
+    suppressed_duplicates: int = 0  # Chunks masked as duplicates of another document
+    missing_documents: List[dict] = []  # Held before a restart and not restored; re-upload them
 
 class DocumentStats(BaseModel):  # NEW
     session_id: str
@@ -69,6 +118,12 @@ class DocumentStats(BaseModel):  # NEW
     image_chunks: int
     total_chunks: int
     files_processed: List[str]
+    reused_documents: int = 0  # Attached from the shared corpus, not reprocessed
+    pending_image_documents: int = 0  # Image enrichment still queued or lazy
+    image_mode: Optional[str] = None
+    estimated_seconds: Optional[float] = None  # Pre-scan estimate for the new files
+    job_id: Optional[str] = None  # Ingestion job in the journal (see /jobs/{job_id})
+    resumed_from_checkpoint: Optional[dict] = None
 
 
 # ========== HELPER FUNCTIONS ==========
@@ -83,53 +138,110 @@ def get_or_create_session(session_id: Optional[str] = None) -> AgenticRAGPipelin
     active_sessions[rag.session_id] = rag
     return rag
 
-def transcribe_audio_groq(audio_file_path: str) -> str:
-    """Transcribe audio file using Groq's Whisper API"""
+def discard_session(session_id: str):
+    """Drop a session that was created for an upload rejected before ingesting anything"""
+    rag = active_sessions.pop(session_id, None)
+    if rag is not None:
+        cleanup_session_data(session_id, rag)
+        print(f"[INFO] Discarded empty session {session_id} after rejected upload")
+
+def transcribe_audio_groq(audio_file_path: str) -> Tuple[str, bool]:
+    """
+    Transcribe audio file using Groq's Whisper API; (text, from_cache).
+    Audio is compressed to 16 kHz mono first and transcripts are cached by content hash.
+    """
     try:
-        with open(audio_file_path, "rb") as audio_file:
-            transcription = groq_client.audio.transcriptions.create(
-                file=audio_file,
-                model="whisper-large-v3-turbo",
-                response_format="text",
-                language="en",
-                temperature=0.0
-            )
-        return transcription.strip()
+        return TranscriptionCache.get().transcribe(groq_client, audio_file_path)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Transcription failed: {str(e)}")
 
-def count_session_images(session_id: str) -> int:
-    """Count extracted images for a session"""
-    image_dir = f"extracted_images/{session_id}"
-    if not os.path.exists(image_dir):
-        return 0
-    return len([f for f in os.listdir(image_dir) if os.path.isfile(os.path.join(image_dir, f))])
+def save_audio_upload(audio: UploadFile, suffix: str) -> str:
+    """Blocking copy of the upload to a temp file (run in the threadpool)"""
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp_audio:
+        shutil.copyfileobj(audio.file, tmp_audio)
+        return tmp_audio.name
+
+def save_recording(data: bytes, suffix: str) -> str:
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp_audio:
+        tmp_audio.write(data)
+        return tmp_audio.name
+
+def is_not_modified(request: Request, etag: str, mtime: float) -> bool:
+    """Conditional GET: If-None-Match wins over If-Modified-Since (RFC 9110)"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def encode_session_cursor(sort: str, order: str, position: tuple) -> str:
+    """Opaque /sessions cursor: the sort key of the last row of the page"""
+    payload = json.dumps([sort, order, *position]).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+def decode_session_cursor(cursor: str, sort: str, order: str) -> tuple:
+    try:
+        payload = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        cursor_sort, cursor_order, value, session_id = json.loads(payload)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if (cursor_sort, cursor_order) != (sort, order):
+        raise HTTPException(status_code=400, detail="Cursor was issued for a different sort or order")
+    # Comparing against rows of another type would raise TypeError mid-listing
+    if not (session_cursor_value_ok(sort, value) and isinstance(session_id, str)):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return (value, session_id)
+
+def session_cursor_value_ok(sort: str, value) -> bool:
+    """Cursor value has the type of the sort field: str id, float timestamp or int counter"""
+    if sort == "session_id":
+        return isinstance(value, str)
+    if isinstance(value, bool):
+        return False
+    if sort.endswith("_at"):
+        return isinstance(value, (int, float))
+    return isinstance(value, int)
+
+def count_session_images(rag: AgenticRAGPipeline) -> int:
+    """Count extracted images across the documents attached to a session"""
+    return rag.count_images()
 
 def get_vector_store_stats(rag: AgenticRAGPipeline) -> dict:
     """Get statistics about text and image vector stores"""
     stats = {
         "text_chunks": 0,
         "image_chunks": 0,
+        "visual_vectors": 0,
         "total_chunks": 0
     }
     
     try:
-        if rag.text_vector_store:
-            stats["text_chunks"] = len(rag.text_vector_store.docstore._dict)
-        if rag.image_vector_store:
-            stats["image_chunks"] = len(rag.image_vector_store.docstore._dict)
+        snapshot = rag.snapshot
+        stats["text_chunks"] = snapshot.count("text")
+        stats["image_chunks"] = snapshot.count("image")
+        stats["visual_vectors"] = snapshot.count("visual")
         stats["total_chunks"] = stats["text_chunks"] + stats["image_chunks"]
     except Exception as e:
         print(f"[WARNING] Could not get vector store stats: {e}")
     
     return stats
 
-def cleanup_session_data(session_id: str):
+def cleanup_session_data(session_id: str, rag: Optional[AgenticRAGPipeline] = None):
     """
     Cleanup all session data including:
+    - Shared document references (artifacts freed when no session uses them)
     - Extracted images directory
     - Chat history from database
     """
+    if rag is not None:
+        rag.release_documents()
+    
     image_dir = f"extracted_images/{session_id}"
     if os.path.exists(image_dir):
         try:
@@ -138,6 +250,130 @@ def cleanup_session_data(session_id: str):
         except Exception as e:
             print(f"[WARNING] Failed to delete image directory: {e}")
 
+def parse_filters(rag: AgenticRAGPipeline, raw: Optional[str]) -> Optional[RetrievalFilter]:
+    """`filters` form field, JSON such as {"sources": ["model.pdf"], "page_from": 3, "page_to": 8}"""
+    if not raw:
+        return None
+    try:
+        spec = RetrievalFilterSpec.model_validate_json(raw)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid filters: {e}")
+    return build_retrieval_filter(rag, spec)
+
+def build_retrieval_filter(rag: AgenticRAGPipeline, spec: Optional[RetrievalFilterSpec]) -> Optional[RetrievalFilter]:
+    if spec is None:
+        return None
+    try:
+        return rag.build_filter(**spec.model_dump())
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e.args[0]))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid filters: {e}")
+
+def restore_session(job: dict) -> AgenticRAGPipeline:
+    """
+    Session for a job; recreated under its original id after a restart. Only
+    the job's own files are re-ingested, so documents the session held
+    before the restart are recorded as missing (partially restored session).
+    """
+    session_id = job["session_id"]
+    if session_id not in active_sessions:
+        active_sessions[session_id] = AgenticRAGPipeline(session_id=session_id)
+    rag = active_sessions[session_id]
+    if job["resumed"]:
+        known = {d["doc_hash"] for d in rag.missing_documents}
+        missing = [
+            d for d in job["session_documents"]
+            if d["doc_hash"] not in rag.attached_documents and d["doc_hash"] not in known
+        ]
+        if missing:
+            rag.missing_documents.extend(missing)
+            print(f"[WARNING] Session {session_id} partially restored; re-upload: "
+                  f"{', '.join(d['filename'] for d in missing)}")
+    return rag
+
+def run_ingest_job(job_id: str, new_session: bool = False) -> dict:
+    """
+    Run (or resume) a journaled ingestion job; blocking, call from a worker
+    thread. Checkpointed work from an interrupted run is replayed, not redone.
+    new_session: the session was created for this job and is dropped if the
+    quota rejects it.
+    """
+    journal = IngestJournal.get()
+    job = journal.get_job(job_id)
+    rag = restore_session(job)
+    journal.update_job(job_id, "running")
+    if job["resumed"]:
+        print(f"[INFO] Resuming ingestion job {job_id} for session {job['session_id']} "
+              f"(attempt {job['resume_count'] + 1})")
+
+    file_paths = [f["path"] for f in job["files"]]
+    try:
+        stats = rag.process_files(file_paths, job["image_mode"], [f["filename"] for f in job["files"]])
+    except QuotaExceededError as e:
+        # The job will not be retried, so its checkpoints are dead weight
+        rag.discard_checkpoints(file_paths)
+        journal.finish_job(job_id, "rejected", error=str(e))
+        if new_session:
+            discard_session(rag.session_id)
+        raise
+    except Exception as e:
+        rag.discard_checkpoints(file_paths)
+        journal.finish_job(job_id, "failed", error=str(e))
+        raise
+
+    stats["resumed"] = job["resumed"]
+    if job["resumed"]:
+        stats["missing_documents"] = rag.get_session_info()["missing_documents"]
+    journal.finish_job(job_id, "done", result=stats)
+    return stats
+
+def validate_upload(files: List[UploadFile], image_mode: Optional[str]):
+    """Reject unknown image modes and unsupported file types"""
+    if image_mode is not None and image_mode not in IMAGE_MODES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"image_mode must be one of {', '.join(IMAGE_MODES)}"
+        )
+    allowed_extensions = [".pdf", ".txt"]
+    for file in files:
+        file_ext = Path(file.filename).suffix.lower()
+        if file_ext not in allowed_extensions:
+            raise HTTPException(
+                status_code=400,
+                detail=f"File '{file.filename}' type {file_ext} not supported. Use PDF or TXT."
+            )
+
+def save_upload_files(files: List[UploadFile]) -> List[str]:
+    """Copy uploads to temp files (keeping the extension); caller deletes them"""
+    temp_file_paths = []
+    for file in files:
+        file_ext = Path(file.filename).suffix.lower()
+        with tempfile.NamedTemporaryFile(delete=False, suffix=file_ext) as tmp_file:
+            shutil.copyfileobj(file.file, tmp_file)
+            temp_file_paths.append(tmp_file.name)
+    return temp_file_paths
+
+async def estimate_upload(
+    temp_file_paths: List[str],
+    filenames: List[str],
+    session_id: Optional[str],
+    image_mode: Optional[str]
+) -> dict:
+    """Pre-scan without creating a session; an existing session's usage and quota apply"""
+    rag = active_sessions.get(session_id) if session_id else None
+    if rag is not None:
+        plan = await run_in_threadpool(rag.estimate_files, temp_file_paths, image_mode)
+    else:
+        plan = await run_in_threadpool(
+            plan_ingestion, temp_file_paths, image_mode or os.getenv("RAG_IMAGE_MODE", "sync")
+        )
+    for entry, filename in zip(plan["files"], filenames):
+        entry["filename"] = filename
+        entry.pop("path", None)
+    plan["session_id"] = rag.session_id if rag is not None else None
+    return plan
+
 
 # ========== API ENDPOINTS ==========
 
@@ -154,7 +390,10 @@ async def root():
             "separate_text_image_stores",
             "ocr_extraction",
             "image_captioning",
-            "session_based_storage"
+            "session_based_storage",
+            "embedding_micro_batching",
+            "batch_question_evaluation",
+            "streaming_voice_websocket"
         ],
         "whisper_model": "groq/whisper-large-v3-turbo",
         "vision_models": {
@@ -174,7 +413,11 @@ async def root():
 @app.post("/upload-document", response_model=DocumentStats)
 async def upload_document(
     files: List[UploadFile] = File(...),
-    session_id: Optional[str] = Form(None)
+    session_id: Optional[str] = Form(None),
+    image_mode: Optional[str] = Form(None),
+    dry_run: bool = Form(False),
+    background: bool = Form(False),
+    background_tasks: BackgroundTasks = None
 ):
     """
     Upload one or multiple PDF/TXT documents for processing
@@ -185,60 +428,159 @@ async def upload_document(
     - Guaranteed text extraction (never overshadowed by images)
     - Smart content routing
     - Better retrieval accuracy
-    """
-    # Validate file types
-    allowed_extensions = [".pdf", ".txt"]
-    uploaded_files = []
     
-    for file in files:
-        file_ext = Path(file.filename).suffix.lower()
-        if file_ext not in allowed_extensions:
-            raise HTTPException(
-                status_code=400,
-                detail=f"File '{file.filename}' type {file_ext} not supported. Use PDF or TXT."
-            )
-        uploaded_files.append(file)
+    image_mode (optional):
+    - "sync" (default): respond after all images are OCR'd and captioned
+    - "background": respond once text is searchable; images enriched in a queue
+    - "lazy": enrich images only when a question first needs them
+
+    dry_run: only pre-scan the files and return the estimate (same as /estimate-upload).
+    Uploads that would exceed the session quota are rejected with 413 before processing.
+
+    background: return 202 with a job_id right away and ingest in the background;
+    poll /jobs/{job_id}. Every upload is journaled, so an interrupted job resumes
+    from its checkpoints when the API restarts.
+    """
+    validate_upload(files, image_mode)
+    temp_file_paths = []
     
     try:
+        # Save all files temporarily
+        temp_file_paths = save_upload_files(files)
+
+        if dry_run:
+            plan = await estimate_upload(
+                temp_file_paths, [f.filename for f in files], session_id, image_mode
+            )
+            return JSONResponse(content=plan)
+
         # Get or create session
+        new_session = not (session_id and session_id in active_sessions)
         rag = get_or_create_session(session_id)
+
+        # Journal the upload as a job so a restarted worker can resume it
+        job = IngestJournal.get().create_job(
+            rag.session_id,
+            [(path, file.filename) for path, file in zip(temp_file_paths, files)],
+            image_mode,
+            session_documents=rag.document_list()
+        )
+        if background:
+            background_tasks.add_task(run_ingest_job, job["job_id"], new_session)
+            return JSONResponse(
+                status_code=202,
+                content={"job_id": job["job_id"], "session_id": rag.session_id, "status": "queued"}
+            )
         
-        temp_file_paths = []
-        
-        # Save all files temporarily
-        for file in uploaded_files:
-            file_ext = Path(file.filename).suffix.lower()
-            with tempfile.NamedTemporaryFile(delete=False, suffix=file_ext) as tmp_file:
-                shutil.copyfileobj(file.file, tmp_file)
-                temp_file_paths.append(tmp_file.name)
-        
-        # Process all files (returns dict with stats)
-        stats = rag.process_files(temp_file_paths)
-        
-        # Cleanup temp files
-        for tmp_path in temp_file_paths:
-            os.unlink(tmp_path)
+        # Process all files in a worker thread so queries on this session keep
+        # being served from the last committed snapshot meanwhile
+        stats = await run_in_threadpool(run_ingest_job, job["job_id"], new_session)
         
         return DocumentStats(
             session_id=rag.session_id,
             text_chunks=stats["text_chunks"],
             image_chunks=stats["image_chunks"],
             total_chunks=stats["total"],
-            files_processed=[file.filename for file in uploaded_files]
+            files_processed=[file.filename for file in files],
+            reused_documents=stats.get("reused_documents", 0),
+            pending_image_documents=stats.get("pending_image_documents", 0),
+            image_mode=stats.get("image_mode"),
+            estimated_seconds=stats.get("estimated_seconds"),
+            job_id=job["job_id"],
+            resumed_from_checkpoint=stats.get("resumed_from_checkpoint")
         )
         
+    except QuotaExceededError as e:
+        raise HTTPException(
+            status_code=413,
+            detail={"message": "Session quota exceeded", "violations": e.violations}
+        )
+    except HTTPException:
+        raise
     except Exception as e:
-        # Cleanup on error
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        # Cleanup temp files (journaled uploads were moved to the job spool)
         for tmp_path in temp_file_paths:
             if os.path.exists(tmp_path):
                 os.unlink(tmp_path)
+
+
+@app.post("/estimate-upload")
+async def estimate_upload_endpoint(
+    files: List[UploadFile] = File(...),
+    session_id: Optional[str] = Form(None),
+    image_mode: Optional[str] = Form(None)
+):
+    """
+    Fast pre-scan: pages, text bytes, scanned pages, images and image pixels
+    per file, estimated ingestion time per stage, and the session quota check.
+    Nothing is embedded, OCR'd or captioned.
+    """
+    validate_upload(files, image_mode)
+    temp_file_paths = []
+    try:
+        temp_file_paths = save_upload_files(files)
+        return await estimate_upload(
+            temp_file_paths, [f.filename for f in files], session_id, image_mode
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        for tmp_path in temp_file_paths:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+
+@app.get("/jobs/{job_id}")
+async def get_ingest_job(job_id: str):
+    """Status of an ingestion job; `resumed` is true if it was picked up after a restart"""
+    job = IngestJournal.get().get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    for entry in job["files"]:
+        entry.pop("path", None)
+    return job
+
+
+@app.get("/jobs")
+async def list_ingest_jobs(session_id: Optional[str] = None, limit: int = 50):
+    """Most recent ingestion jobs, optionally for one session"""
+    jobs = IngestJournal.get().list_jobs(session_id, limit)
+    for job in jobs:
+        for entry in job["files"]:
+            entry.pop("path", None)
+    return {"total": len(jobs), "jobs": jobs}
+
+
+@app.get("/ingestion/throughput")
+async def get_ingestion_throughput():
+    """Measured per-stage ingestion throughput used for estimates, and the quota limits"""
+    return {
+        "stages": IngestThroughput.get().get_stats(),
+        "quota": SessionQuota().limits,
+    }
+
+
+@app.get("/transcriptions/stats")
+async def get_transcription_stats():
+    """Voice transcription cache hits/misses and audio bytes received vs. uploaded to Whisper"""
+    cache = TranscriptionCache.get()
+    return {
+        "codec": cache.codec,
+        "sample_rate": cache.sample_rate,
+        "ffmpeg_available": shutil.which("ffmpeg") is not None,
+        **cache.get_stats(),
+    }
 
 
 @app.post("/ask-text", response_model=QueryResponse)
 async def ask_text_question(
     question: str = Form(...),
-    session_id: Optional[str] = Form(None)
+    session_id: Optional[str] = Form(None),
+    filters: Optional[str] = Form(None)
 ):
     """
     Ask a question using text input
@@ -248,11 +590,15 @@ async def ask_text_question(
     - Separate retrieval from text and image stores
     - Returns content_type to show what was used
     - Better answer quality with guaranteed text retrieval
+
+    filters: optional JSON restricting retrieval to source documents, types
+    ("text"/"image") and a page range, e.g. {"sources": ["model.pdf"], "page_to": 4}
     """
     try:
         # Get or create session
         rag = get_or_create_session(session_id)
-        result = rag.ask(question)
+        retrieval_filter = parse_filters(rag, filters)
+        result = await run_in_threadpool(rag.ask, question, retrieval_filter)
         
         # Extract source files
         sources = list(set([
@@ -268,17 +614,73 @@ async def ask_text_question(
             text_docs_count=result.get("text_docs_count", 0),
             image_docs_count=result.get("image_docs_count", 0),
             rewritten_query=result.get("rewritten_query"),
+            history_tokens=result.get("history_tokens"),
+            pending_image_documents=result.get("pending_image_documents", 0),
             sources=sources
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/session/{session_id}/ask-batch")
+async def ask_batch_questions(session_id: str, request: BatchQuestionRequest):
+    """
+    Answer a list of questions against a session's documents, e.g. the same
+    due-diligence checklist for every founder.
+    
+    Streams NDJSON: one line per question as soon as its answer is ready
+    ({"index", "question", "answer", "content_type", "sources", ...} or
+    {"index", "question", "error"}), then {"done": true, ...}. Routing,
+    embedding and retrieval are shared by the batch; chat memory is untouched.
+    """
+    if session_id not in active_sessions:
+        raise HTTPException(status_code=404, detail="Session not found")
+    questions = [q.strip() for q in request.questions if q.strip()]
+    if not questions:
+        raise HTTPException(status_code=400, detail="No questions provided")
+    if len(questions) > MAX_BATCH_QUESTIONS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {MAX_BATCH_QUESTIONS} questions per batch, got {len(questions)}"
+        )
+    if request.max_concurrency is not None and request.max_concurrency < 1:
+        raise HTTPException(status_code=400, detail="max_concurrency must be at least 1")
+    
+    rag = active_sessions[session_id]
+    retrieval_filter = build_retrieval_filter(rag, request.filters)
+    
+    def stream_results():
+        # Sync generator: StreamingResponse iterates it in the threadpool
+        started = time.perf_counter()
+        errors = 0
+        for result in rag.ask_batch(questions, retrieval_filter, request.max_concurrency):
+            documents = result.pop("documents", [])
+            if "error" in result:
+                errors += 1
+            else:
+                result["sources"] = sorted({
+                    doc.metadata.get("source", "unknown") for doc in documents
+                })
+            yield json.dumps(result) + "\n"
+        yield json.dumps({
+            "done": True,
+            "session_id": session_id,
+            "count": len(questions),
+            "errors": errors,
+            "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)
+        }) + "\n"
+    
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+
 @app.post("/ask-voice", response_model=QueryResponse)
 async def ask_voice_question(
     audio: UploadFile = File(...),
-    session_id: Optional[str] = Form(None)
+    session_id: Optional[str] = Form(None),
+    filters: Optional[str] = Form(None)
 ):
     """
     Ask a question using voice input
@@ -288,6 +690,8 @@ async def ask_voice_question(
     2. Transcribe with Whisper (Groq)
     3. Smart routing to text/image stores
     4. Return answer with transcription and content type
+
+    filters: same JSON retrieval filter as /ask-text
     """
     # Validate audio file
     allowed_audio_formats = [".mp3", ".wav", ".m4a", ".ogg", ".flac", ".webm"]
@@ -300,22 +704,22 @@ async def ask_voice_question(
         )
     
     try:
-        # Save audio file temporarily
-        with tempfile.NamedTemporaryFile(delete=False, suffix=audio_ext) as tmp_audio:
-            shutil.copyfileobj(audio.file, tmp_audio)
-            tmp_audio_path = tmp_audio.name
+        # Save audio file temporarily (file I/O, compression and the API call stay off the event loop)
+        tmp_audio_path = await run_in_threadpool(save_audio_upload, audio, audio_ext)
         
         # Transcribe audio using Groq Whisper
         print(f"[INFO] Transcribing audio: {audio.filename}")
-        transcribed_text = transcribe_audio_groq(tmp_audio_path)
-        print(f"[INFO] Transcribed: {transcribed_text}")
-        
-        # Cleanup temp audio file
-        os.unlink(tmp_audio_path)
+        try:
+            transcribed_text, from_cache = await run_in_threadpool(transcribe_audio_groq, tmp_audio_path)
+        finally:
+            # Cleanup temp audio file
+            os.unlink(tmp_audio_path)
+        print(f"[INFO] Transcribed{' (cached)' if from_cache else ''}: {transcribed_text}")
         
         # Get or create session
         rag = get_or_create_session(session_id)
-        result = rag.ask(transcribed_text)
+        retrieval_filter = parse_filters(rag, filters)
+        result = await run_in_threadpool(rag.ask, transcribed_text, retrieval_filter)
         
         # Extract source files
         sources = list(set([
@@ -331,14 +735,133 @@ async def ask_voice_question(
             text_docs_count=result.get("text_docs_count", 0),
             image_docs_count=result.get("image_docs_count", 0),
             rewritten_query=result.get("rewritten_query"),
+            history_tokens=result.get("history_tokens"),
+            pending_image_documents=result.get("pending_image_documents", 0),
             sources=sources,
-            transcribed_text=transcribed_text
+            transcribed_text=transcribed_text,
+            transcription_cached=from_cache
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.websocket("/ws/ask-voice")
+async def ask_voice_stream(websocket: WebSocket):
+    """
+    Streaming voice question: audio is transcribed segment by segment while
+    the user speaks, and the answer is streamed as soon as they stop.
+    
+    Protocol (JSON text frames, binary frames for audio):
+    1. client: {"type": "start", "session_id"?, "filters"?, "format": "pcm_s16le" | "file",
+                "sample_rate"?: 16000, "extension"?: ".webm"}
+       server: {"type": "ready", "session_id", "transcriber"}
+    2. client: audio chunks as binary frames
+       - pcm_s16le (16-bit mono PCM): cut into ~RAG_VOICE_SEGMENT_SECONDS
+         segments, each transcribed immediately -> {"type": "partial", "segment", "text"}
+       - file (e.g. MediaRecorder webm): chunks are not decodable on their
+         own, so the whole recording is transcribed (cached) after "stop";
+         capped at RAG_VOICE_MAX_BYTES
+    3. client: {"type": "stop"}
+       server: {"type": "transcript", "text"}, {"type": "route", ...},
+               {"type": "delta", "text"}..., {"type": "answer", ...QueryResponse fields}
+    Errors are sent as {"type": "error", "detail"} before the socket closes.
+    """
+    await websocket.accept()
+    pending: List[asyncio.Task] = []
+    try:
+        start = await websocket.receive_json()
+        if start.get("type") != "start":
+            raise ValueError("First message must be {\"type\": \"start\", ...}")
+        audio_format = start.get("format", "pcm_s16le")
+        if audio_format not in ("pcm_s16le", "file"):
+            raise ValueError(f"Unsupported format '{audio_format}'; use pcm_s16le or file")
+        sample_rate = int(start.get("sample_rate", 16000))
+        extension = start.get("extension", ".webm")
+        
+        rag = get_or_create_session(start.get("session_id"))
+        retrieval_filter = parse_filters(rag, json.dumps(start["filters"])) if start.get("filters") else None
+        # One transcriber per recording: stateful transcribers must not leak between sockets
+        transcriber = create_transcriber(client=groq_client)
+        await websocket.send_json({
+            "type": "ready", "session_id": rag.session_id, "transcriber": transcriber.name
+        })
+        
+        segmenter = PCMSegmenter(sample_rate, VOICE_SEGMENT_SECONDS) if audio_format == "pcm_s16le" else None
+        recording = bytearray()
+        
+        async def transcribe_segment(index: int, pcm: bytes) -> str:
+            text = await run_in_threadpool(transcriber.transcribe_pcm, pcm, sample_rate)
+            await websocket.send_json({"type": "partial", "segment": index, "text": text})
+            return text
+        
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            if message.get("bytes") is not None:
+                if segmenter is not None:
+                    for pcm in segmenter.feed(message["bytes"]):
+                        pending.append(asyncio.create_task(transcribe_segment(len(pending), pcm)))
+                    if segmenter.seconds_received > VOICE_MAX_SECONDS:
+                        raise ValueError(f"Recording longer than {VOICE_MAX_SECONDS:.0f}s")
+                else:
+                    if len(recording) + len(message["bytes"]) > VOICE_MAX_BYTES:
+                        raise ValueError(f"Recording larger than {VOICE_MAX_BYTES} bytes")
+                    recording.extend(message["bytes"])
+            elif message.get("text") and json.loads(message["text"]).get("type") == "stop":
+                break
+        
+        if segmenter is not None:
+            rest = segmenter.flush()
+            if rest is not None:
+                pending.append(asyncio.create_task(transcribe_segment(len(pending), rest)))
+            texts = await asyncio.gather(*pending)
+        else:
+            if not recording:
+                raise ValueError("No audio received")
+            tmp_audio_path = await run_in_threadpool(save_recording, bytes(recording), extension)
+            try:
+                texts = [await run_in_threadpool(transcriber.transcribe_file, tmp_audio_path)]
+            finally:
+                os.unlink(tmp_audio_path)
+        
+        transcript = " ".join(text.strip() for text in texts if text and text.strip())
+        await websocket.send_json({"type": "transcript", "text": transcript})
+        if not transcript:
+            raise ValueError("No speech recognized")
+        
+        async for event in iterate_in_threadpool(rag.ask_stream(transcript, retrieval_filter)):
+            if event["type"] != "result":
+                await websocket.send_json(event)
+                continue
+            documents = event.pop("documents")
+            event.pop("type")
+            response = QueryResponse(
+                session_id=rag.session_id,
+                sources=sorted({doc.metadata.get("source", "unknown") for doc in documents}),
+                transcribed_text=transcript,
+                **event
+            )
+            await websocket.send_json({"type": "answer", **response.model_dump()})
+        await websocket.close()
+    
+    except WebSocketDisconnect:
+        print("[INFO] Voice stream client disconnected")
+    except Exception as e:
+        detail = e.detail if isinstance(e, HTTPException) else str(e)
+        try:
+            await websocket.send_json({"type": "error", "detail": detail})
+            await websocket.close(code=1011 if not isinstance(e, (ValueError, HTTPException)) else 1008)
+        except Exception:
+            pass
+    finally:
+        for task in pending:
+            task.cancel()
+
+
 @app.get("/session/{session_id}", response_model=SessionInfo)
 async def get_session_info(session_id: str):
     """
@@ -360,7 +883,12 @@ async def get_session_info(session_id: str):
         has_text_retriever=info["has_text_retriever"],
         has_image_retriever=info["has_image_retriever"],
         text_chunks_total=stats["text_chunks"],
-        image_chunks_total=stats["image_chunks"]
+        image_chunks_total=stats["image_chunks"],
+        index_version=info["index_version"],
+        pending_image_documents=info["pending_image_documents"],
+        collapsed_duplicates=info["collapsed_duplicates"],
+        suppressed_duplicates=info["suppressed_duplicates"],
+        missing_documents=info["missing_documents"]
     )
 
 
@@ -374,14 +902,14 @@ async def delete_session(session_id: str):
     
     try:
         rag = active_sessions[session_id]
-        image_count = count_session_images(session_id)
+        image_count = count_session_images(rag)
         stats = get_vector_store_stats(rag)
         
         # Clear memory (chat history)
         rag.clear_memory()
         
         # Cleanup session data (images, etc.)
-        cleanup_session_data(session_id)
+        cleanup_session_data(session_id, rag)
         
         # Remove from active sessions
         del active_sessions[session_id]
@@ -403,35 +931,178 @@ async def delete_session(session_id: str):
 
 
 @app.get("/sessions")
-async def list_active_sessions():
+async def list_active_sessions(
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    sort: str = "last_active_at",
+    order: str = "desc"
+):
     """
-    List all active sessions with details
+    List active sessions, one page at a time
     
-    UPDATED: Shows text/image chunk counts
+    Reads only per-session counters maintained at write time (no history,
+    image directory or vector store access). sort: one of SESSION_SORT_KEYS;
+    order: asc or desc; pass next_cursor back as cursor for the next page.
     """
-    sessions = []
-    for session_id, rag in active_sessions.items():
-        info = rag.get_session_info()
-        image_count = count_session_images(session_id)
-        stats = get_vector_store_stats(rag)
-        
-        sessions.append({
-            "session_id": session_id,
-            "files": info["processed_files"],
-            "messages": info["message_count"],
-            "images_extracted": image_count,
-            "text_chunks": stats["text_chunks"],
-            "image_chunks": stats["image_chunks"],
-            "has_text_retriever": info["has_text_retriever"],
-            "has_image_retriever": info["has_image_retriever"]
-        })
+    if sort not in SESSION_SORT_KEYS:
+        raise HTTPException(status_code=400, detail=f"sort must be one of {list(SESSION_SORT_KEYS)}")
+    if order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail="order must be 'asc' or 'desc'")
+    if not 1 <= limit <= MAX_SESSIONS_PAGE:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {MAX_SESSIONS_PAGE}")
+    
+    rows = [
+        {"session_id": session_id, **rag.listing_info()}
+        for session_id, rag in list(active_sessions.items())
+    ]
+    # session_id breaks ties, so every row has a unique position for the cursor
+    key = lambda row: (row[sort], row["session_id"])
+    rows.sort(key=key, reverse=order == "desc")
+    if cursor:
+        after = decode_session_cursor(cursor, sort, order)
+        rows = [row for row in rows if (key(row) < after if order == "desc" else key(row) > after)]
+    
+    page = rows[:limit]
+    next_cursor = encode_session_cursor(sort, order, key(page[-1])) if len(rows) > limit else None
     
     return {
-        "total_sessions": len(sessions),
-        "sessions": sessions
+        "total_sessions": len(active_sessions),
+        "count": len(page),
+        "sort": sort,
+        "order": order,
+        "next_cursor": next_cursor,
+        "sessions": [
+            {
+                "session_id": row["session_id"],
+                "files": row["files"],
+                "documents": row["documents"],
+                "messages": row["messages"],
+                "images_extracted": row["images"],
+                "text_chunks": row["text_chunks"],
+                "image_chunks": row["image_chunks"],
+                "has_text_retriever": row["text_chunks"] > 0,
+                "has_image_retriever": row["image_chunks"] > 0,
+                "created_at": datetime.fromtimestamp(row["created_at"]).isoformat(),
+                "last_active_at": datetime.fromtimestamp(row["last_active_at"]).isoformat()
+            }
+            for row in page
+        ]
     }
 
 
+@app.get("/session/{session_id}/documents")
+async def list_session_documents(session_id: str):
+    """Documents attached to a session, addressable by doc_hash or filename"""
+    if session_id not in active_sessions:
+        raise HTTPException(status_code=404, detail="Session not found")
+    
+    rag = active_sessions[session_id]
+    documents = [
+        {
+            "doc_hash": doc_hash,
+            "filename": rag.document_names.get(doc_hash, document.filename),
+            "text_chunks": document.count("text"),
+            "image_chunks": document.count("image"),
+            "image_status": document.image_status,
+            "shared_with_other_sessions": document.refcount > 1
+        }
+        for doc_hash, document in list(rag.attached_documents.items())
+    ]
+    
+    return {
+        "session_id": session_id,
+        "count": len(documents),
+        "documents": documents
+    }
+
+
+@app.get("/session/{session_id}/summaries")
+async def get_session_summaries(session_id: str):
+    """Precomputed summaries of a session's documents (used for whole-document questions)"""
+    if session_id not in active_sessions:
+        raise HTTPException(status_code=404, detail="Session not found")
+    
+    rag = active_sessions[session_id]
+    summaries = []
+    for doc_hash in list(rag.attached_documents):
+        summary = rag.summary_store.lookup(doc_hash) or {"doc_hash": doc_hash, "status": "none"}
+        summary["filename"] = rag.document_names.get(doc_hash, summary.get("filename"))
+        summaries.append(summary)
+    
+    return {
+        "session_id": session_id,
+        "count": len(summaries),
+        "summaries": summaries
+    }
+
+
+@app.delete("/session/{session_id}/documents/{document}")
+async def remove_session_document(session_id: str, document: str):
+    """
+    Remove a single document (by doc_hash or original filename) from a session.
+    Only that document's segments leave the index; the rest is untouched.
+    """
+    if session_id not in active_sessions:
+        raise HTTPException(status_code=404, detail="Session not found")
+    
+    rag = active_sessions[session_id]
+    try:
+        removed = await run_in_threadpool(rag.remove_document, document)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e.args[0]))
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    
+    return {
+        "status": "success",
+        "session_id": session_id,
+        "removed": removed
+    }
+
+
+@app.put("/session/{session_id}/documents/{document}")
+async def replace_session_document(
+    session_id: str,
+    document: str,
+    file: UploadFile = File(...),
+    image_mode: Optional[str] = Form(None)
+):
+    """
+    Replace a single document (by doc_hash or original filename) with a
+    revised file. Only the new file is ingested; other documents are kept.
+    """
+    if session_id not in active_sessions:
+        raise HTTPException(status_code=404, detail="Session not found")
+    validate_upload([file], image_mode)
+    
+    rag = active_sessions[session_id]
+    temp_file_paths = []
+    try:
+        temp_file_paths = save_upload_files([file])
+        result = await run_in_threadpool(
+            rag.replace_document, document, temp_file_paths[0], file.filename, image_mode
+        )
+        result["session_id"] = session_id
+        return result
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e.args[0]))
+    except QuotaExceededError as e:
+        raise HTTPException(
+            status_code=413,
+            detail={"message": "Session quota exceeded", "violations": e.violations}
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        for tmp_path in temp_file_paths:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+
 @app.post("/clear-memory/{session_id}")
 async def clear_session_memory(session_id: str):
     """
@@ -457,38 +1128,77 @@ async def clear_session_memory(session_id: str):
 @app.get("/session/{session_id}/images")
 async def get_session_images(session_id: str):
     """
-    Get list of all extracted images for a session
+    Get list of all extracted images for a session (from the in-memory
+    manifest kept at extraction time; url/thumbnail_url serve the image)
     """
     if session_id not in active_sessions:
         raise HTTPException(status_code=404, detail="Session not found")
     
-    image_dir = f"extracted_images/{session_id}"
-    
-    if not os.path.exists(image_dir):
-        return {
-            "session_id": session_id,
-            "image_count": 0,
-            "images": []
-        }
+    rag = active_sessions[session_id]
     
+    # Images live with their (possibly shared) documents, not in a session directory
     images = [
         {
-            "filename": f,
-            "path": os.path.join(image_dir, f),
-            "size_kb": round(os.path.getsize(os.path.join(image_dir, f)) / 1024, 2)
+            "filename": os.path.basename(entry["path"]),
+            "image_hash": entry["image_hash"],
+            "path": entry["path"],
+            "doc_hash": entry["doc_hash"],
+            "source": entry["source"],
+            "page": entry.get("page"),
+            "width": entry.get("width"),
+            "height": entry.get("height"),
+            "size_kb": round(entry["bytes"] / 1024, 2),
+            "url": f"/session/{session_id}/images/{entry['image_hash']}",
+            "thumbnail_url": f"/session/{session_id}/images/{entry['image_hash']}?size={THUMBNAIL_SIZES[0]}"
         }
-        for f in os.listdir(image_dir)
-        if os.path.isfile(os.path.join(image_dir, f))
+        for entry in rag.image_manifest()
     ]
     
     return {
         "session_id": session_id,
         "image_count": len(images),
-        "directory": image_dir,
+        "thumbnail_sizes": list(THUMBNAIL_SIZES),
         "images": images
     }
 
 
+@app.get("/session/{session_id}/images/{image_hash}")
+async def serve_session_image(session_id: str, image_hash: str, request: Request, size: Optional[int] = None):
+    """
+    Serve an extracted image of the session, or its thumbnail with size=
+    one of THUMBNAIL_SIZES (longest edge, WebP, generated once and cached).
+    Images are content-addressed, so the hash is a strong ETag and responses
+    are immutable; conditional requests get 304 and Range requests 206.
+    """
+    if session_id not in active_sessions:
+        raise HTTPException(status_code=404, detail="Session not found")
+    
+    entry = active_sessions[session_id].find_image(image_hash)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Image not found in this session")
+    
+    store = ImageStore.get()
+    if size is not None:
+        try:
+            path = await run_in_threadpool(store.thumbnail, image_hash, entry["ext"], size)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        etag = f'"{image_hash}-{size}"'
+        media_type = "image/webp"
+    else:
+        path = entry["path"] if await run_in_threadpool(store.wait_for_blob, entry["path"]) else None
+        etag = f'"{image_hash}"'
+        media_type = mimetypes.guess_type(f"image.{entry['ext']}")[0] or "application/octet-stream"
+    if path is None:
+        raise HTTPException(status_code=404, detail="Image file is no longer available")
+    
+    stat_result = os.stat(path)
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=31536000, immutable"}
+    if is_not_modified(request, etag, stat_result.st_mtime):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type=media_type, headers=headers, stat_result=stat_result)
+
+
 @app.get("/session/{session_id}/stats")
 async def get_session_statistics(session_id: str):
     """
@@ -500,7 +1210,7 @@ async def get_session_statistics(session_id: str):
     rag = active_sessions[session_id]
     stats = get_vector_store_stats(rag)
     info = rag.get_session_info()
-    image_count = count_session_images(session_id)
+    image_count = count_session_images(rag)
     
     return {
         "session_id": session_id,
@@ -513,6 +1223,10 @@ async def get_session_statistics(session_id: str):
                 "enabled": info["has_image_retriever"],
                 "chunks": stats["image_chunks"]
             },
+            "visual": {
+                "enabled": stats["visual_vectors"] > 0,
+                "vectors": stats["visual_vectors"]
+            },
             "total_chunks": stats["total_chunks"]
         },
         "files": {
@@ -521,7 +1235,18 @@ async def get_session_statistics(session_id: str):
         },
         "images": {
             "extracted": image_count,
-            "directory": f"extracted_images/{session_id}"
+            "pending_documents": info["pending_image_documents"],
+            "enrichment_status": info["image_status"]
+        },
+        "documents": {
+            "attached": len(rag.attached_documents),
+            "shared_with_other_sessions": sum(
+                1 for d in list(rag.attached_documents.values()) if d.refcount > 1
+            )
+        },
+        "quota": {
+            "usage": rag.usage(),
+            "limits": rag.quota.limits
         },
         "chat": {
             "messages": info["message_count"]
@@ -529,6 +1254,39 @@ async def get_session_statistics(session_id: str):
     }
 
 
+@app.get("/embedding-scheduler/stats")
+async def get_embedding_scheduler_stats():
+    """
+    Process-wide embedding scheduler metrics:
+    queue depth, batch size histogram and queue wait times
+    (fetched from the model server when RAG_MODEL_SERVER_SOCKET is set)
+    """
+    if os.getenv("RAG_MODEL_SERVER_SOCKET"):
+        try:
+            return {"status": "active", "schedulers": get_model_hub().get_stats()}
+        except Exception as e:
+            raise HTTPException(status_code=503, detail=f"Model server unavailable: {e}")
+    
+    if SharedModelHub._instance is None:
+        return {"status": "idle", "message": "Models not loaded yet (no session created)"}
+    
+    return {
+        "status": "active",
+        "schedulers": SharedModelHub.get().get_stats()
+    }
+
+
+@app.get("/shared-documents")
+async def get_shared_documents():
+    """
+    Cross-session document corpus: documents held, references and
+    which documents are currently shared by more than one session
+    """
+    stats = SharedDocumentStore.get().get_stats()
+    stats["image_store"] = ImageStore.get().get_stats()
+    return stats
+
+
 @app.delete("/cleanup-all-sessions")
 async def cleanup_all_sessions():
     """
@@ -543,8 +1301,8 @@ async def cleanup_all_sessions():
         
         for session_id in list(active_sessions.keys()):
             try:
-                image_count = count_session_images(session_id)
                 rag = active_sessions[session_id]
+                image_count = count_session_images(rag)
                 stats = get_vector_store_stats(rag)
                 
                 total_images += image_count
@@ -552,21 +1310,24 @@ async def cleanup_all_sessions():
                 total_image_chunks += stats["image_chunks"]
                 
                 rag.clear_memory()
-                cleanup_session_data(session_id)
+                cleanup_session_data(session_id, rag)
                 del active_sessions[session_id]
                 deleted_count += 1
             except Exception as e:
                 print(f"[WARNING] Failed to cleanup session {session_id}: {e}")
         
-        # Cleanup orphaned image directories
+        # Cleanup orphaned image directories (the content-addressed store keeps
+        # its OCR/caption cache; only unreferenced blobs and their thumbnails are deleted)
+        kept_dirs = {os.path.abspath(IMAGE_STORE_DIR), os.path.abspath(THUMBNAIL_DIR)}
         if os.path.exists("extracted_images"):
             for item in os.listdir("extracted_images"):
                 item_path = os.path.join("extracted_images", item)
-                if os.path.isdir(item_path):
+                if os.path.isdir(item_path) and os.path.abspath(item_path) not in kept_dirs:
                     try:
                         shutil.rmtree(item_path)
                     except:
                         pass
+        ImageStore.get().collect_garbage()
         
         return {
             "status": "success",
@@ -600,6 +1361,8 @@ async def startup_event():
     print("   [OK] Image Captioning (BLIP)")
     print("   [OK] OCR (PyTesseract)")
     print("   [OK] Session-based Storage")
+    if os.getenv("RAG_MODEL_SERVER_SOCKET"):
+        print(f"   [OK] Shared Model Server ({os.getenv('RAG_MODEL_SERVER_SOCKET')})")
     print("="*60)
     print("[INFO] Models:")
     print("   - Whisper: groq/whisper-large-v3-turbo")
@@ -607,10 +1370,24 @@ async def startup_event():
     print("   - BLIP: Salesforce/blip-image-captioning-base")
     print("   - LLM: llama-3.3-70b-versatile (Groq)")
     print("="*60)
+
+    # Resume ingestion jobs left unfinished by a crashed or redeployed worker
+    resumed = IngestJournal.get().claim_orphaned_jobs()
+    for job in resumed:
+        print(f"[INFO] Queued interrupted ingestion job {job['job_id']} for resumption")
+        asyncio.create_task(resume_ingest_job(job["job_id"]))
+
     print("[SUCCESS] API is ready!")
     print("="*60)
 
 
+async def resume_ingest_job(job_id: str):
+    try:
+        await run_in_threadpool(run_ingest_job, job_id)
+    except Exception as e:
+        print(f"[WARNING] Resumed ingestion job {job_id} failed: {e}")
+
+
 @app.on_event("shutdown")
 async def shutdown_event():
     """Cleanup on shutdown"""
@@ -623,7 +1400,7 @@ async def shutdown_event():
         try:
             rag = active_sessions[session_id]
             rag.clear_memory()
-            cleanup_session_data(session_id)
+            cleanup_session_data(session_id, rag)
             cleanup_count += 1
         except:
             pass
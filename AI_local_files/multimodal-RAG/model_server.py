@@ -0,0 +1,339 @@
+"""
+Machine-wide model server for multi-worker deployments.
+
+Hosts CLIP text/image encoding, BLIP captioning and OCR in ONE process and
+serves them over a Unix domain socket, so model memory is paid once per
+machine no matter how many uvicorn workers run the RAG API. Requests from all
+workers go through the same batching schedulers as the in-process hub.
+
+Run:
+    python model_server.py --socket /tmp/rag-models.sock
+Then start the API workers with:
+    RAG_MODEL_SERVER_SOCKET=/tmp/rag-models.sock uvicorn main:app --workers 4
+
+Wire protocol (all integers big-endian):
+    frame   = header + payload
+    header  = magic "RM" | version u8 | op u8 | request_id u32 | payload_len u32
+    strings = count u32 | (len u32 | utf-8 bytes)*
+    images  = count u32 | (width u32 | height u32 | raw RGB bytes)*
+    tokens  = count u32 | (len u32 | u32 token ids)*
+    matrix  = rows u32 | dim u32 | little-endian float32 bytes
+Responses echo the request id with op | 0x80, or OP_ERROR with a utf-8 message.
+"""
+import argparse
+import json
+import os
+import socket
+import socketserver
+import struct
+import threading
+from typing import Dict, List, Tuple
+
+import numpy as np
+from PIL import Image
+
+MAGIC = b"RM"
+VERSION = 1
+HEADER = struct.Struct("!2sBBII")
+U32 = struct.Struct("!I")
+MATRIX_HEADER = struct.Struct("!II")
+
+OP_PING = 0x01
+OP_EMBED_TEXT = 0x02
+OP_EMBED_IMAGE = 0x03
+OP_CAPTION = 0x04
+OP_OCR = 0x05
+OP_STATS = 0x06
+OP_EMBED_TOKENS = 0x07
+OP_REPLY = 0x80
+OP_ERROR = 0xFF
+
+MAX_PAYLOAD = 512 * 1024 * 1024
+
+
+# ============ ENCODING HELPERS ============
+def encode_strings(values: List[str]) -> bytes:
+    parts = [U32.pack(len(values))]
+    for value in values:
+        raw = value.encode("utf-8")
+        parts.append(U32.pack(len(raw)))
+        parts.append(raw)
+    return b"".join(parts)
+
+
+def decode_strings(payload: bytes) -> List[str]:
+    view = memoryview(payload)
+    (count,), offset = U32.unpack_from(view, 0), U32.size
+    values = []
+    for _ in range(count):
+        (length,) = U32.unpack_from(view, offset)
+        offset += U32.size
+        values.append(bytes(view[offset:offset + length]).decode("utf-8"))
+        offset += length
+    return values
+
+
+def encode_token_ids(sequences: List[List[int]]) -> bytes:
+    parts = [U32.pack(len(sequences))]
+    for ids in sequences:
+        parts.append(U32.pack(len(ids)))
+        parts.append(np.asarray(ids, dtype=">u4").tobytes())
+    return b"".join(parts)
+
+
+def decode_token_ids(payload: bytes) -> List[List[int]]:
+    view = memoryview(payload)
+    (count,), offset = U32.unpack_from(view, 0), U32.size
+    sequences = []
+    for _ in range(count):
+        (length,) = U32.unpack_from(view, offset)
+        offset += U32.size
+        sequences.append(np.frombuffer(payload, dtype=">u4", count=length, offset=offset).tolist())
+        offset += length * U32.size
+    return sequences
+
+
+def encode_images(images: List[Image.Image]) -> bytes:
+    parts = [U32.pack(len(images))]
+    for image in images:
+        rgb = image if image.mode == "RGB" else image.convert("RGB")
+        parts.append(MATRIX_HEADER.pack(*rgb.size))
+        parts.append(rgb.tobytes())
+    return b"".join(parts)
+
+
+def decode_images(payload: bytes) -> List[Image.Image]:
+    view = memoryview(payload)
+    (count,), offset = U32.unpack_from(view, 0), U32.size
+    images = []
+    for _ in range(count):
+        width, height = MATRIX_HEADER.unpack_from(view, offset)
+        offset += MATRIX_HEADER.size
+        size = width * height * 3
+        images.append(Image.frombytes("RGB", (width, height), bytes(view[offset:offset + size])))
+        offset += size
+    return images
+
+
+def encode_matrix(matrix: np.ndarray) -> bytes:
+    matrix = np.ascontiguousarray(matrix, dtype="<f4")
+    rows, dim = matrix.shape if matrix.ndim == 2 else (0, 0)
+    return MATRIX_HEADER.pack(rows, dim) + matrix.tobytes()
+
+
+def decode_matrix(payload: bytes) -> np.ndarray:
+    rows, dim = MATRIX_HEADER.unpack_from(payload, 0)
+    return np.frombuffer(
+        payload, dtype="<f4", count=rows * dim, offset=MATRIX_HEADER.size
+    ).reshape(rows, dim).astype(np.float32)
+
+
+def _recv_exact(sock: socket.socket, n: int) -> bytes:
+    buf = bytearray(n)
+    view = memoryview(buf)
+    received = 0
+    while received < n:
+        got = sock.recv_into(view[received:], n - received)
+        if got == 0:
+            raise ConnectionError("Model server connection closed")
+        received += got
+    return bytes(buf)
+
+
+def send_frame(sock: socket.socket, op: int, request_id: int, payload: bytes = b""):
+    sock.sendall(HEADER.pack(MAGIC, VERSION, op, request_id, len(payload)) + payload)
+
+
+def recv_frame(sock: socket.socket) -> Tuple[int, int, bytes]:
+    magic, version, op, request_id, length = HEADER.unpack(_recv_exact(sock, HEADER.size))
+    if magic != MAGIC or version != VERSION:
+        raise ConnectionError(f"Bad frame (magic={magic!r}, version={version})")
+    if length > MAX_PAYLOAD:
+        raise ConnectionError(f"Frame too large: {length} bytes")
+    return op, request_id, _recv_exact(sock, length) if length else b""
+
+
+# ============ SERVER ============
+class _ModelRequestHandler(socketserver.BaseRequestHandler):
+    """One thread per worker connection; batching happens in the hub schedulers"""
+
+    def handle(self):
+        hub = self.server.hub
+        while True:
+            try:
+                op, request_id, payload = recv_frame(self.request)
+            except (ConnectionError, OSError):
+                return
+
+            try:
+                if op == OP_PING:
+                    reply = b""
+                elif op == OP_EMBED_TEXT:
+                    reply = encode_matrix(hub.embed_texts(decode_strings(payload)))
+                elif op == OP_EMBED_TOKENS:
+                    reply = encode_matrix(hub.embed_token_ids(decode_token_ids(payload)))
+                elif op == OP_EMBED_IMAGE:
+                    reply = encode_matrix(hub.embed_images(decode_images(payload)))
+                elif op == OP_CAPTION:
+                    reply = encode_strings(hub.caption_images(decode_images(payload)))
+                elif op == OP_OCR:
+                    reply = encode_strings(hub.ocr_images(decode_images(payload)))
+                elif op == OP_STATS:
+                    reply = json.dumps(hub.get_stats()).encode("utf-8")
+                else:
+                    raise ValueError(f"Unknown op 0x{op:02x}")
+                send_frame(self.request, op | OP_REPLY, request_id, reply)
+            except (ConnectionError, OSError):
+                return
+            except Exception as e:
+                print(f"[WARNING] Model server request 0x{op:02x} failed: {e}")
+                send_frame(self.request, OP_ERROR, request_id, str(e).encode("utf-8"))
+
+
+def socket_in_use(socket_path: str) -> bool:
+    """True if a server accepts connections on the socket (a leftover file does not)"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(1.0)
+    try:
+        sock.connect(socket_path)
+        return True
+    except (FileNotFoundError, ConnectionRefusedError):
+        return False
+    finally:
+        sock.close()
+
+
+class ModelServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, hub):
+        if os.path.exists(socket_path):
+            if socket_in_use(socket_path):
+                raise RuntimeError(f"A model server is already listening on {socket_path}")
+            # Stale socket left by a server that did not shut down cleanly
+            os.unlink(socket_path)
+        self.hub = hub
+        super().__init__(socket_path, _ModelRequestHandler)
+        os.chmod(socket_path, 0o660)
+
+
+# ============ CLIENT ============
+class ModelServerClient:
+    """
+    Drop-in replacement for SharedModelHub that forwards to the model server.
+    Each thread keeps its own connection, so concurrent requests from one API
+    worker still reach the server's batching schedulers in parallel.
+    """
+
+    _clients: Dict[str, "ModelServerClient"] = {}
+    _clients_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, socket_path: str) -> "ModelServerClient":
+        with cls._clients_lock:
+            if socket_path not in cls._clients:
+                cls._clients[socket_path] = cls(socket_path)
+            return cls._clients[socket_path]
+
+    def __init__(self, socket_path: str, timeout: float = 300.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._request_ids = iter(range(1, 2 ** 32))
+        self._ids_lock = threading.Lock()
+        self.call(OP_PING)
+        print(f"[SUCCESS] Connected to model server at {socket_path}")
+
+    def _connection(self) -> socket.socket:
+        sock = getattr(self._local, "sock", None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            self._local.sock = sock
+        return sock
+
+    def _reset(self):
+        sock = getattr(self._local, "sock", None)
+        if sock is not None:
+            try:
+                sock.close()
+            except OSError:
+                pass
+        self._local.sock = None
+
+    def call(self, op: int, payload: bytes = b"") -> bytes:
+        """Send one request and wait for its reply; reconnects once on a broken socket"""
+        with self._ids_lock:
+            request_id = next(self._request_ids)
+
+        for attempt in range(2):
+            try:
+                sock = self._connection()
+                send_frame(sock, op, request_id, payload)
+                reply_op, reply_id, reply = recv_frame(sock)
+                break
+            except (ConnectionError, OSError):
+                self._reset()
+                if attempt == 1:
+                    raise
+
+        if reply_id != request_id:
+            self._reset()
+            raise ConnectionError("Model server reply out of order")
+        if reply_op == OP_ERROR:
+            raise RuntimeError(f"Model server error: {reply.decode('utf-8', 'replace')}")
+        return reply
+
+    # ---------- Hub interface ----------
+    def embed_texts(self, texts: List[str]) -> np.ndarray:
+        return decode_matrix(self.call(OP_EMBED_TEXT, encode_strings(texts)))
+
+    def embed_token_ids(self, windows: List[List[int]]) -> np.ndarray:
+        return decode_matrix(self.call(OP_EMBED_TOKENS, encode_token_ids(windows)))
+
+    def embed_images(self, images: List[Image.Image]) -> np.ndarray:
+        return decode_matrix(self.call(OP_EMBED_IMAGE, encode_images(images)))
+
+    def caption_images(self, images: List[Image.Image]) -> List[str]:
+        return decode_strings(self.call(OP_CAPTION, encode_images(images)))
+
+    def ocr_images(self, images: List[Image.Image]) -> List[str]:
+        return decode_strings(self.call(OP_OCR, encode_images(images)))
+
+    def get_stats(self) -> Dict:
+        stats = json.loads(self.call(OP_STATS).decode("utf-8"))
+        stats["backend"] = f"model-server ({self.socket_path})"
+        return stats
+
+
+# ============ ENTRY POINT ============
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shared CLIP/BLIP/OCR model server")
+    parser.add_argument(
+        "--socket",
+        default=os.getenv("RAG_MODEL_SERVER_SOCKET", "/tmp/rag-models.sock"),
+        help="Unix domain socket path to listen on",
+    )
+    args = parser.parse_args()
+    # Check before loading the models: a second instance must not take over the socket
+    if socket_in_use(args.socket):
+        raise SystemExit(f"A model server is already listening on {args.socket}")
+
+    from chattingh import SharedModelHub
+
+    print("=" * 60)
+    print("[INFO] Loading shared models for the model server...")
+    hub = SharedModelHub.get()
+    server = ModelServer(args.socket, hub)
+    print(f"[SUCCESS] Model server listening on {args.socket}")
+    print("=" * 60)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n[INFO] Shutting down model server...")
+    finally:
+        server.server_close()
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
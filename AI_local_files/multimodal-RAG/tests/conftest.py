@@ -0,0 +1,13 @@
+"""
+Shared test setup: the modules live in the parent directory and read their
+configuration from the environment at import time, so set it up first.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("GROQ_API_KEY", "test-key")
+os.environ.setdefault("RAG_CHUNKING", "chars")
+os.environ.setdefault("HF_HUB_OFFLINE", "1")
+os.environ["RAG_TRANSCRIBER"] = "local"
@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+SAMPLE_RATE = 16000
+
+
+class FakeSession:
+    """Stands in for AgenticRAGPipeline: streams a canned answer for the transcript"""
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.questions = []
+
+    def ask_stream(self, question, filters=None):
+        self.questions.append(question)
+        yield {"type": "route", "needed_retrieval": False}
+        for piece in ("Hello", " there"):
+            yield {"type": "delta", "text": piece}
+        yield {
+            "type": "result",
+            "answer": "Hello there",
+            "needed_retrieval": False,
+            "documents": [],
+        }
+
+
+@pytest.fixture
+def session(monkeypatch):
+    fake = FakeSession("voice-test")
+    monkeypatch.setitem(main.active_sessions, fake.session_id, fake)
+    monkeypatch.setattr(main, "VOICE_SEGMENT_SECONDS", 1.0)
+    return fake
+
+
+def speech(seconds: float) -> bytes:
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    return (8000 * np.sin(2 * np.pi * 440 * t)).astype(np.int16).tobytes()
+
+
+def start(ws, session):
+    ws.send_json({
+        "type": "start", "session_id": session.session_id,
+        "format": "pcm_s16le", "sample_rate": SAMPLE_RATE,
+    })
+    return ws.receive_json()
+
+
+def test_pcm_round_trip(session, monkeypatch):
+    monkeypatch.setenv("RAG_LOCAL_TRANSCRIPT", "what does|the report say")
+    client = TestClient(main.app)
+
+    with client.websocket_connect("/ws/ask-voice") as ws:
+        ready = start(ws, session)
+        assert ready == {"type": "ready", "session_id": "voice-test", "transcriber": "local"}
+
+        # 1.5s at 1s segments: one segment while streaming, the rest on stop
+        ws.send_bytes(speech(1.5))
+        partial = ws.receive_json()
+        assert partial == {"type": "partial", "segment": 0, "text": "what does"}
+
+        ws.send_json({"type": "stop"})
+        events = []
+        while not events or events[-1]["type"] != "answer":
+            events.append(ws.receive_json())
+
+    types = [event["type"] for event in events]
+    assert types == ["partial", "transcript", "route", "delta", "delta", "answer"]
+    assert events[1]["text"] == "what does the report say"
+    assert session.questions == ["what does the report say"]
+    answer = events[-1]
+    assert answer["answer"] == "Hello there"
+    assert answer["session_id"] == "voice-test"
+    assert answer["transcribed_text"] == "what does the report say"
+
+
+def test_recording_longer_than_cap_is_rejected(session, monkeypatch):
+    monkeypatch.setenv("RAG_LOCAL_TRANSCRIPT", "too long")
+    monkeypatch.setattr(main, "VOICE_MAX_SECONDS", 2.0)
+    client = TestClient(main.app)
+
+    with client.websocket_connect("/ws/ask-voice") as ws:
+        start(ws, session)
+        ws.send_bytes(speech(2.5))
+        events = []
+        while not events or events[-1]["type"] != "error":
+            events.append(ws.receive_json())
+
+    assert "longer than 2s" in events[-1]["detail"]
+    assert session.questions == []
+
+
+def test_first_message_must_be_start(session):
+    client = TestClient(main.app)
+
+    with client.websocket_connect("/ws/ask-voice") as ws:
+        ws.send_json({"type": "stop"})
+        error = ws.receive_json()
+
+    assert error["type"] == "error"
+    assert "start" in error["detail"]
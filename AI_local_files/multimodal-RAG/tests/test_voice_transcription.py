@@ -0,0 +1,73 @@
+import numpy as np
+
+from voice_transcription import LocalTranscriber, PCMSegmenter, create_transcriber
+
+SAMPLE_RATE = 16000
+
+
+def tone(seconds: float, amplitude: int = 8000) -> np.ndarray:
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    return (amplitude * np.sin(2 * np.pi * 440 * t)).astype(np.int16)
+
+
+# ---------- PCMSegmenter ----------
+def test_segment_ends_at_quiet_gap():
+    # 3.5s of tone, 0.3s of silence, then more tone: the 4s segment should cut in the gap
+    audio = np.concatenate([tone(3.5), np.zeros(int(0.3 * SAMPLE_RATE), np.int16), tone(2.0)])
+    segmenter = PCMSegmenter(SAMPLE_RATE, segment_seconds=4.0)
+
+    segments = segmenter.feed(audio.tobytes())
+
+    assert len(segments) == 1
+    cut_seconds = len(segments[0]) / 2 / SAMPLE_RATE
+    assert 3.5 <= cut_seconds <= 3.8
+
+
+def test_segments_never_exceed_segment_length():
+    segmenter = PCMSegmenter(SAMPLE_RATE, segment_seconds=1.0)
+    audio = tone(5.0).tobytes()
+
+    segments = []
+    for i in range(0, len(audio), 3200):
+        segments.extend(segmenter.feed(audio[i:i + 3200]))
+    rest = segmenter.flush()
+
+    assert segments
+    assert all(len(s) <= segmenter.segment_bytes for s in segments)
+    assert all(len(s) % 2 == 0 for s in segments)
+    assert sum(map(len, segments)) + len(rest or b"") == len(audio)
+    assert segmenter.seconds_received == 5.0
+
+
+def test_flush_drops_audio_too_short_for_a_word():
+    segmenter = PCMSegmenter(SAMPLE_RATE, segment_seconds=4.0, min_seconds=0.25)
+    segmenter.feed(tone(0.1).tobytes())
+    assert segmenter.flush() is None
+
+    segmenter.feed(tone(0.5).tobytes())
+    assert len(segmenter.flush()) == int(0.5 * SAMPLE_RATE) * 2
+
+
+# ---------- LocalTranscriber ----------
+def test_local_transcriber_follows_script_in_order():
+    transcriber = LocalTranscriber(script=["what is", "in the report"])
+    pcm = tone(0.5).tobytes()
+
+    texts = [transcriber.transcribe_pcm(pcm, SAMPLE_RATE) for _ in range(3)]
+
+    assert texts == ["what is", "in the report", ""]
+
+
+def test_local_transcriber_reads_script_from_env(monkeypatch):
+    monkeypatch.setenv("RAG_LOCAL_TRANSCRIPT", " first | | second ")
+    transcriber = create_transcriber()
+
+    assert transcriber.name == "local"
+    assert transcriber.script == ["first", "second"]
+
+
+def test_local_transcriber_without_script_reports_duration(monkeypatch):
+    monkeypatch.delenv("RAG_LOCAL_TRANSCRIPT", raising=False)
+    transcriber = LocalTranscriber()
+
+    assert transcriber.transcribe_pcm(tone(1.5).tobytes(), SAMPLE_RATE) == "[1.5s of audio]"
@@ -0,0 +1,113 @@
+"""
+Tokenizer-aware chunking aligned to the CLIP text window.
+
+CLIP encodes at most 77 tokens (75 content tokens plus BOS/EOS), so a
+500-character chunk is mostly tokenized and then truncated away. This
+chunker tokenizes each page ONCE with the model's fast tokenizer, cuts
+windows of whole tokens (preferring sentence and line boundaries), maps
+them back to character spans for the stored text, and hands the token ids
+to the embedding stage so nothing is tokenized twice.
+
+A chunk may span several windows (windows_per_chunk > 1); it is then
+embedded as the mean of its window vectors, so its tail is still
+represented in the index.
+"""
+from functools import lru_cache
+from typing import Dict, List
+
+import numpy as np
+
+CLIP_MODEL_NAME = "openai/clip-vit-base-patch32"
+CLIP_MAX_TOKENS = 77
+CLIP_EMBEDDING_DIM = 512  # Projection size of CLIP_MODEL_NAME text/image features
+
+_SENTENCE_END = (".", "!", "?", ":", ";")
+
+
+@lru_cache(maxsize=None)
+def get_clip_tokenizer(model_name: str = CLIP_MODEL_NAME):
+    """Fast tokenizer only (no weights); cheap enough to load in every worker"""
+    from transformers import CLIPTokenizerFast
+    return CLIPTokenizerFast.from_pretrained(model_name)
+
+
+class TokenWindowChunker:
+    """Split text into chunks of at most windows_per_chunk model windows"""
+
+    def __init__(
+        self,
+        tokenizer,
+        max_tokens: int = CLIP_MAX_TOKENS,
+        overlap_tokens: int = 8,
+        windows_per_chunk: int = 1,
+    ):
+        self.tokenizer = tokenizer
+        self.bos_id = tokenizer.bos_token_id
+        self.eos_id = tokenizer.eos_token_id
+        # Room for BOS/EOS inside every window
+        self.window_tokens = max_tokens - 2
+        self.windows_per_chunk = max(1, windows_per_chunk)
+        self.chunk_tokens = self.window_tokens * self.windows_per_chunk
+        self.overlap_tokens = min(overlap_tokens, self.chunk_tokens // 2)
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.tokenizer(text, add_special_tokens=False, verbose=False)["input_ids"])
+
+    def _cut(self, text: str, offsets: List, start: int, limit: int) -> int:
+        """End (exclusive) of the chunk starting at token `start`, at a boundary if possible"""
+        end = min(start + self.chunk_tokens, limit)
+        if end == limit:
+            return end
+        # Search back through the second half for a sentence or line break
+        for i in range(end, start + self.chunk_tokens // 2, -1):
+            prev_end = offsets[i - 1][1]
+            gap = text[prev_end:offsets[i][0]] if i < limit else ""
+            if "\n" in gap or text[prev_end - 1:prev_end] in _SENTENCE_END:
+                return i
+        return end
+
+    def windows(self, ids: List[int]) -> List[List[int]]:
+        """Model-ready windows (BOS + <=75 ids + EOS) covering one chunk's tokens"""
+        return [
+            [self.bos_id] + ids[i:i + self.window_tokens] + [self.eos_id]
+            for i in range(0, max(len(ids), 1), self.window_tokens)
+        ]
+
+    def split(self, text: str) -> List[Dict]:
+        """
+        Chunks as {"text", "start", "end", "n_tokens", "windows"}; start/end
+        are character offsets into text, windows are pre-tokenized model inputs
+        """
+        encoding = self.tokenizer(
+            text, add_special_tokens=False, return_offsets_mapping=True, verbose=False
+        )
+        ids = encoding["input_ids"]
+        offsets = encoding["offset_mapping"]
+        limit = len(ids)
+
+        chunks = []
+        start = 0
+        while start < limit:
+            end = self._cut(text, offsets, start, limit)
+            char_start, char_end = offsets[start][0], offsets[end - 1][1]
+            chunk_ids = ids[start:end]
+            chunks.append({
+                "text": text[char_start:char_end],
+                "start": char_start,
+                "end": char_end,
+                "n_tokens": len(chunk_ids),
+                "windows": self.windows(chunk_ids),
+            })
+            if end == limit:
+                break
+            start = max(end - self.overlap_tokens, start + 1)
+        return chunks
+
+
+def pool_windows(window_vectors: np.ndarray, window_counts: List[int]) -> np.ndarray:
+    """Mean of each chunk's window vectors, in chunk order"""
+    if all(count == 1 for count in window_counts):
+        return window_vectors
+    starts = np.concatenate([[0], np.cumsum(window_counts)[:-1]]).astype(np.int64)
+    sums = np.add.reduceat(window_vectors, starts, axis=0)
+    return (sums / np.asarray(window_counts, dtype=np.float32)[:, None]).astype(np.float32)
@@ -0,0 +1,538 @@
+"""
+Versioned, snapshot-isolated vector indexes for RAG sessions.
+
+Each ingestion builds immutable IndexSegments off to the side. A session's
+searchable state is an IndexSnapshot: a frozen tuple of committed segments
+plus a version number. Committing new work creates a NEW snapshot object and
+swaps the session's reference in one assignment, so readers always see
+either the old or the new snapshot and never a half-built store.
+
+Segments also carry a BM25 inverted index of their rows (lexical_index),
+so keyword lookups and hybrid rank fusion need no extra ingestion pass.
+
+Segments also group their rows into sections (runs of consecutive chunks,
+cut at page breaks) with a mean vector each. Large snapshots search
+coarse-to-fine: top sections first, then chunks inside those sections only.
+"""
+from typing import Dict, FrozenSet, Iterable, List, Optional, Sequence, Tuple
+
+import faiss
+import numpy as np
+from langchain_community.vectorstores.utils import maximal_marginal_relevance
+from langchain_core.documents import Document
+
+from lexical_index import LexicalPostings, bm25_idf, reciprocal_rank_fusion
+
+# "image" holds caption/OCR text vectors of images, "visual" CLIP image vectors of the same images
+STORE_TYPES = ("text", "image", "visual")
+DEFAULT_SECTION_SIZE = 32
+
+
+class IndexSegment:
+    """Immutable batch of documents and their vectors (one FAISS flat index)"""
+
+    def __init__(
+        self,
+        store_type: str,
+        documents: List[Document],
+        vectors: np.ndarray,
+        signatures: Optional[Sequence[int]] = None,
+        section_size: int = DEFAULT_SECTION_SIZE,
+    ):
+        if store_type not in STORE_TYPES:
+            raise ValueError(f"Unknown store type: {store_type}")
+        if len(documents) != len(vectors):
+            raise ValueError("Each document needs exactly one vector")
+        if signatures is not None and len(signatures) != len(documents):
+            raise ValueError("Each document needs exactly one signature")
+
+        self.store_type = store_type
+        self.documents = list(documents)
+        # SimHash fingerprints per row, used for session-level near-duplicate suppression
+        self.signatures = list(signatures) if signatures is not None else None
+        self.vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        self.index = faiss.IndexFlatL2(self.vectors.shape[1])
+        self.index.add(self.vectors)
+
+        # A segment belongs to one document; page spans per row (-1: no page) back page filters
+        self.doc_hash = self.documents[0].metadata.get("doc_hash") if self.documents else None
+        self.pages = np.array(
+            [d.metadata.get("page", -1) for d in self.documents], dtype=np.int32
+        )
+        self.page_ends = np.array(
+            [d.metadata.get("page_end", d.metadata.get("page", -1)) for d in self.documents],
+            dtype=np.int32,
+        )
+        self.section_bounds, self.section_vectors = self._build_sections(section_size)
+        # Visual rows share their documents with an "image" segment, which indexes the text
+        self.postings = LexicalPostings(
+            d.page_content for d in self.documents if store_type != "visual"
+        )
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    def _build_sections(self, section_size: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        (start, end) row ranges of ~section_size consecutive rows, preferring
+        to cut where the page changes, and the mean vector of each range
+        """
+        n = len(self.documents)
+        if n == 0:
+            return np.empty((0, 2), dtype=np.int64), np.empty((0, self.vectors.shape[1]), np.float32)
+        starts = [0]
+        for row in range(1, n):
+            size = row - starts[-1]
+            page_break = self.pages[row] != self.pages[row - 1]
+            if size >= section_size or (page_break and size >= section_size // 2):
+                starts.append(row)
+        bounds = np.array(list(zip(starts, starts[1:] + [n])), dtype=np.int64)
+        sums = np.add.reduceat(self.vectors, bounds[:, 0], axis=0)
+        means = sums / (bounds[:, 1] - bounds[:, 0])[:, None]
+        return bounds, np.ascontiguousarray(means, dtype=np.float32)
+
+    def rows_in_pages(self, page_from: Optional[int], page_to: Optional[int]) -> np.ndarray:
+        """Rows whose page span overlaps [page_from, page_to]; rows without a page never match"""
+        mask = self.pages >= 0
+        if page_from is not None:
+            mask &= self.page_ends >= page_from
+        if page_to is not None:
+            mask &= self.pages <= page_to
+        return np.flatnonzero(mask)
+
+    def search(
+        self,
+        query: np.ndarray,
+        k: int,
+        exclude: FrozenSet[int] = frozenset(),
+        rows: Optional[np.ndarray] = None,
+    ) -> List[Tuple[float, int, np.ndarray]]:
+        """
+        Nearest neighbours as (L2 distance, row, vector), skipping excluded
+        rows. With rows given, FAISS only scores those rows (ID selector), so
+        a filtered search never post-filters a global top-k.
+        """
+        return self.search_batch(query.reshape(1, -1), k, exclude, rows)[0]
+
+    def search_batch(
+        self,
+        queries: np.ndarray,
+        k: int,
+        exclude: FrozenSet[int] = frozenset(),
+        rows: Optional[np.ndarray] = None,
+    ) -> List[List[Tuple[float, int, np.ndarray]]]:
+        """search for every row of queries in one FAISS call (one scan of the segment)"""
+        if rows is None:
+            k = min(k + len(exclude), len(self.documents))
+            params = None
+        else:
+            if exclude:
+                rows = np.setdiff1d(rows, np.fromiter(exclude, dtype=np.int64))
+            k = min(k, len(rows))
+            params = faiss.SearchParameters(sel=self._selector(rows)) if k > 0 else None
+        if k <= 0:
+            return [[] for _ in range(len(queries))]
+        distances, indices = self.index.search(queries, k, params=params)
+        return [
+            [
+                (float(dist), int(i), self.vectors[i])
+                for dist, i in zip(query_distances, query_indices)
+                if i != -1 and int(i) not in exclude
+            ]
+            for query_distances, query_indices in zip(distances, indices)
+        ]
+
+    @staticmethod
+    def _selector(rows: np.ndarray):
+        rows = np.asarray(rows, dtype=np.int64)
+        # Contiguous rows (one page range of a document): flat search scans only that range
+        if rows[-1] - rows[0] + 1 == len(rows):
+            return faiss.IDSelectorRange(int(rows[0]), int(rows[-1]) + 1)
+        return faiss.IDSelectorBatch(rows)
+
+
+class RetrievalFilter:
+    """Query-time restriction of a search to documents, store types and a page range"""
+
+    def __init__(
+        self,
+        doc_hashes: Optional[Iterable[str]] = None,
+        types: Optional[Iterable[str]] = None,
+        page_from: Optional[int] = None,
+        page_to: Optional[int] = None,
+    ):
+        self.doc_hashes = frozenset(doc_hashes) if doc_hashes is not None else None
+        self.types = frozenset(types) if types else None
+        if self.types and not self.types <= {"text", "image"}:
+            raise ValueError(f"Unknown type in {sorted(self.types)}; use 'text' or 'image'")
+        if page_from is not None and page_to is not None and page_from > page_to:
+            raise ValueError(f"Empty page range {page_from}-{page_to}")
+        self.page_from = page_from
+        self.page_to = page_to
+
+    def allows_type(self, store_type: str) -> bool:
+        if store_type == "visual":
+            store_type = "image"
+        return self.types is None or store_type in self.types
+
+    def rows(self, segment: IndexSegment) -> Optional[np.ndarray]:
+        """Rows of a segment the filter admits; None means every row"""
+        if self.doc_hashes is not None and segment.doc_hash not in self.doc_hashes:
+            return np.empty(0, dtype=np.int64)
+        if self.page_from is None and self.page_to is None:
+            return None
+        return segment.rows_in_pages(self.page_from, self.page_to)
+
+    @property
+    def restricts_content(self) -> bool:
+        """True if the filter narrows within documents (pages or types), not just which ones"""
+        return self.types is not None or self.page_from is not None or self.page_to is not None
+
+    def to_dict(self) -> Dict:
+        return {
+            "doc_hashes": sorted(self.doc_hashes) if self.doc_hashes is not None else None,
+            "types": sorted(self.types) if self.types else None,
+            "page_from": self.page_from,
+            "page_to": self.page_to,
+        }
+
+
+class IndexSnapshot:
+    """Frozen view of a session's committed segments; safe to read without locks"""
+
+    def __init__(
+        self,
+        version: int = 0,
+        segments: Optional[Dict[str, Tuple[IndexSegment, ...]]] = None,
+        suppressed: Optional[Dict[IndexSegment, FrozenSet[int]]] = None,
+        duplicate_sources: Optional[Dict[Tuple[IndexSegment, int], List[Dict]]] = None,
+    ):
+        self.version = version
+        self.segments = {
+            store_type: tuple((segments or {}).get(store_type, ()))
+            for store_type in STORE_TYPES
+        }
+        # Rows hidden in this session because another attached document holds a near-duplicate
+        self.suppressed = dict(suppressed or {})
+        # (segment, row) of a kept chunk -> provenance of the chunks suppressed in its favour
+        self.duplicate_sources = dict(duplicate_sources or {})
+        # store_type -> (FAISS index over all section vectors, [(segment, start, end)]), built on first use
+        self._sections: Dict[str, Tuple[faiss.Index, List[Tuple[IndexSegment, int, int]]]] = {}
+
+    @classmethod
+    def from_segments(
+        cls,
+        version: int,
+        segments: List[IndexSegment],
+        suppressed: Optional[Dict[IndexSegment, FrozenSet[int]]] = None,
+        duplicate_sources: Optional[Dict[Tuple[IndexSegment, int], List[Dict]]] = None,
+    ) -> "IndexSnapshot":
+        """Build a snapshot version from a flat list of committed segments"""
+        grouped = {store_type: [] for store_type in STORE_TYPES}
+        for segment in segments:
+            if len(segment):
+                grouped[segment.store_type].append(segment)
+        return cls(version, grouped, suppressed, duplicate_sources)
+
+    def count(self, store_type: str) -> int:
+        """Searchable rows, i.e. excluding session-suppressed duplicates"""
+        return sum(
+            len(segment) - len(self.suppressed.get(segment, ()))
+            for segment in self.segments[store_type]
+        )
+
+    def section_count(self, store_type: str) -> int:
+        return sum(len(segment.section_bounds) for segment in self.segments[store_type])
+
+    def suppressed_count(self) -> int:
+        return sum(len(rows) for rows in self.suppressed.values())
+
+    def has(self, store_type: str) -> bool:
+        return self.count(store_type) > 0
+
+    def mmr_search(
+        self,
+        store_type: str,
+        query: np.ndarray,
+        k: int = 5,
+        fetch_k: int = 15,
+        lambda_mult: float = 0.7,
+        filters: Optional[RetrievalFilter] = None,
+        top_sections: Optional[int] = None,
+    ) -> List[Document]:
+        """
+        MMR over all segments of one store type: fetch_k nearest candidates
+        are merged across segments, then diversified as in FAISS MMR search.
+        With filters, segments of other documents are skipped entirely and
+        the rest only score the admitted rows. With top_sections, only the
+        chunks of the top_sections sections nearest the query are scored.
+        """
+        hits = self._mmr_hits(
+            store_type, query, k, fetch_k, lambda_mult, filters, top_sections
+        )
+        return [self._document(segment, row) for segment, row in hits]
+
+    def _mmr_hits(
+        self,
+        store_type: str,
+        query: np.ndarray,
+        k: int,
+        fetch_k: int,
+        lambda_mult: float,
+        filters: Optional[RetrievalFilter],
+        top_sections: Optional[int],
+    ) -> List[Tuple[IndexSegment, int]]:
+        if filters is not None and not filters.allows_type(store_type):
+            return []
+        query = np.asarray(query, dtype=np.float32)
+        if top_sections:
+            targets = self._nearest_sections(store_type, query, top_sections, filters)
+        else:
+            targets = self._flat_targets(store_type, filters)
+
+        candidates = []
+        for segment, rows in targets:
+            exclude = self.suppressed.get(segment, frozenset())
+            candidates.extend(
+                (dist, segment, row, vector)
+                for dist, row, vector in segment.search(query, fetch_k, exclude, rows)
+            )
+        return self._mmr_select(query, candidates, k, fetch_k, lambda_mult)
+
+    def _mmr_hits_batch(
+        self,
+        store_type: str,
+        queries: np.ndarray,
+        k: int,
+        fetch_k: int,
+        lambda_mult: float,
+        filters: Optional[RetrievalFilter],
+    ) -> List[List[Tuple[IndexSegment, int]]]:
+        """_mmr_hits for every row of queries, with one FAISS call per segment"""
+        if filters is not None and not filters.allows_type(store_type):
+            return [[] for _ in range(len(queries))]
+        candidates = [[] for _ in range(len(queries))]
+        for segment, rows in self._flat_targets(store_type, filters):
+            exclude = self.suppressed.get(segment, frozenset())
+            for i, found in enumerate(segment.search_batch(queries, fetch_k, exclude, rows)):
+                candidates[i].extend((dist, segment, row, vector) for dist, row, vector in found)
+        return [
+            self._mmr_select(query, query_candidates, k, fetch_k, lambda_mult)
+            for query, query_candidates in zip(queries, candidates)
+        ]
+
+    def _flat_targets(
+        self, store_type: str, filters: Optional[RetrievalFilter]
+    ) -> List[Tuple[IndexSegment, Optional[np.ndarray]]]:
+        """(segment, admitted rows or None for all) of every segment the filter leaves non-empty"""
+        targets = []
+        for segment in self.segments[store_type]:
+            rows = filters.rows(segment) if filters is not None else None
+            if rows is None or len(rows):
+                targets.append((segment, rows))
+        return targets
+
+    @staticmethod
+    def _mmr_select(
+        query: np.ndarray,
+        candidates: List[Tuple[float, IndexSegment, int, np.ndarray]],
+        k: int,
+        fetch_k: int,
+        lambda_mult: float,
+    ) -> List[Tuple[IndexSegment, int]]:
+        """Nearest fetch_k of the merged candidates, diversified as in FAISS MMR search"""
+        if not candidates:
+            return []
+        candidates = sorted(candidates, key=lambda c: c[0])[:fetch_k]
+        selected = maximal_marginal_relevance(
+            query.reshape(1, -1),
+            [vector for _, _, _, vector in candidates],
+            k=k,
+            lambda_mult=lambda_mult,
+        )
+        return [(candidates[i][1], candidates[i][2]) for i in selected]
+
+    def lexical_search(
+        self,
+        store_type: str,
+        terms: Sequence[str],
+        k: int = 5,
+        filters: Optional[RetrievalFilter] = None,
+        required: FrozenSet[str] = frozenset(),
+    ) -> List[Tuple[float, IndexSegment, int, bool]]:
+        """
+        BM25 top-k as (score, segment, row, covers_required). Corpus
+        statistics are summed over the segments, so no global index exists.
+        """
+        if filters is not None and not filters.allows_type(store_type):
+            return []
+        segments = self.segments[store_type]
+        terms = list(dict.fromkeys(terms))
+        n_rows = sum(len(segment) for segment in segments)
+        if not terms or not n_rows:
+            return []
+        avgdl = sum(segment.postings.total_length for segment in segments) / n_rows
+        idf = {
+            term: bm25_idf(n_rows, sum(segment.postings.df(term) for segment in segments))
+            for term in terms
+        }
+
+        results = []
+        for segment in segments:
+            admitted = filters.rows(segment) if filters is not None else None
+            if admitted is not None and not len(admitted):
+                continue
+            rows, scores, covers = segment.postings.score(terms, idf, avgdl, required)
+            keep = np.ones(len(rows), dtype=bool)
+            if admitted is not None:
+                keep &= np.isin(rows, admitted)
+            suppressed = self.suppressed.get(segment)
+            if suppressed:
+                keep &= ~np.isin(rows, np.fromiter(suppressed, dtype=np.int64))
+            rows, scores, covers = rows[keep], scores[keep], covers[keep]
+            for i in np.argsort(-scores)[:k]:
+                results.append((float(scores[i]), segment, int(rows[i]), bool(covers[i])))
+
+        results.sort(key=lambda r: r[0], reverse=True)
+        return results[:k]
+
+    def lexical_documents(self, hits: List[Tuple[float, IndexSegment, int, bool]]) -> List[Document]:
+        return [self._document(segment, row) for _, segment, row, _ in hits]
+
+    def hybrid_search(
+        self,
+        store_type: str,
+        query: np.ndarray,
+        terms: Sequence[str],
+        k: int = 5,
+        fetch_k: int = 15,
+        lambda_mult: float = 0.7,
+        filters: Optional[RetrievalFilter] = None,
+        top_sections: Optional[int] = None,
+        rrf_k: int = 60,
+    ) -> List[Document]:
+        """MMR vector results and BM25 results fused with reciprocal-rank fusion"""
+        vector_hits = self._mmr_hits(
+            store_type, np.asarray(query, dtype=np.float32), k, fetch_k, lambda_mult,
+            filters, top_sections,
+        )
+        fused = self._fuse_lexical(store_type, vector_hits, terms, k, filters, rrf_k)
+        return [self._document(segment, row) for segment, row in fused]
+
+    def search_batch(
+        self,
+        store_type: str,
+        queries: np.ndarray,
+        terms: Optional[Sequence[Sequence[str]]] = None,
+        k: int = 5,
+        fetch_k: int = 15,
+        lambda_mult: float = 0.7,
+        filters: Optional[RetrievalFilter] = None,
+        top_sections: Optional[int] = None,
+        rrf_k: int = 60,
+    ) -> List[List[Document]]:
+        """
+        mmr_search for a batch of queries (hybrid_search for those with
+        terms): each segment is scanned once for the whole batch. With
+        top_sections the search stays per query, as each coarse pass
+        selects different rows.
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(len(queries), -1)
+        if top_sections:
+            hit_lists = [
+                self._mmr_hits(store_type, query, k, fetch_k, lambda_mult, filters, top_sections)
+                for query in queries
+            ]
+        else:
+            hit_lists = self._mmr_hits_batch(store_type, queries, k, fetch_k, lambda_mult, filters)
+        results = []
+        for i, hits in enumerate(hit_lists):
+            if terms is not None and terms[i]:
+                hits = self._fuse_lexical(store_type, hits, terms[i], k, filters, rrf_k)
+            results.append([self._document(segment, row) for segment, row in hits])
+        return results
+
+    def _fuse_lexical(
+        self,
+        store_type: str,
+        vector_hits: List[Tuple[IndexSegment, int]],
+        terms: Sequence[str],
+        k: int,
+        filters: Optional[RetrievalFilter],
+        rrf_k: int,
+    ) -> List[Tuple[IndexSegment, int]]:
+        lexical_hits = [
+            (segment, row) for _, segment, row, _ in self.lexical_search(store_type, terms, k, filters)
+        ]
+        return reciprocal_rank_fusion([vector_hits, lexical_hits], rrf_k)[:k]
+
+    def _section_table(self, store_type: str):
+        """Section vectors of every segment in one flat index; snapshots are immutable, so cached"""
+        table = self._sections.get(store_type)
+        if table is None:
+            owners = [
+                (segment, int(start), int(end))
+                for segment in self.segments[store_type]
+                for start, end in segment.section_bounds
+            ]
+            vectors = [s.section_vectors for s in self.segments[store_type] if len(s.section_vectors)]
+            index = None
+            if vectors:
+                stacked = np.vstack(vectors)
+                index = faiss.IndexFlatL2(stacked.shape[1])
+                index.add(stacked)
+            table = (index, owners)
+            self._sections[store_type] = table
+        return table
+
+    def _nearest_sections(
+        self,
+        store_type: str,
+        query: np.ndarray,
+        top_sections: int,
+        filters: Optional[RetrievalFilter] = None,
+    ) -> List[Tuple[IndexSegment, np.ndarray]]:
+        """Coarse pass: (segment, rows) of the nearest admitted sections"""
+        index, owners = self._section_table(store_type)
+        if index is None:
+            return []
+
+        admitted_rows = {}
+        params = None
+        if filters is not None:
+            admitted = []
+            for section_id, (segment, start, end) in enumerate(owners):
+                if segment not in admitted_rows:
+                    admitted_rows[segment] = filters.rows(segment)
+                rows = admitted_rows[segment]
+                if rows is None or np.any((rows >= start) & (rows < end)):
+                    admitted.append(section_id)
+            if not admitted:
+                return []
+            params = faiss.SearchParameters(
+                sel=faiss.IDSelectorBatch(np.array(admitted, dtype=np.int64))
+            )
+
+        k = min(top_sections, len(owners))
+        _, indices = index.search(query.reshape(1, -1), k, params=params)
+        targets = []
+        for section_id in indices[0]:
+            if section_id == -1:
+                continue
+            segment, start, end = owners[section_id]
+            rows = np.arange(start, end, dtype=np.int64)
+            filtered = admitted_rows.get(segment)
+            if filtered is not None:
+                rows = np.intersect1d(rows, filtered)
+            targets.append((segment, rows))
+        return targets
+
+    def _document(self, segment: IndexSegment, row: int) -> Document:
+        """Segment documents are shared; attach session provenance to a copy"""
+        document = segment.documents[row]
+        sources = self.duplicate_sources.get((segment, row))
+        if not sources:
+            return document
+        metadata = dict(document.metadata)
+        metadata["duplicate_sources"] = sources
+        return Document(page_content=document.page_content, metadata=metadata)
@@ -0,0 +1,375 @@
+"""
+Voice transcription with local audio pre-compression and a result cache.
+
+Browsers record multi-megabyte 44.1/48 kHz WAV; Whisper resamples everything
+to 16 kHz mono anyway. Before upload, ffmpeg (when installed) converts the
+audio to 16 kHz mono Opus (or FLAC), usually 10-50x smaller, so the upload
+and the provider's decode are far cheaper.
+
+Transcriptions are cached in SQLite by a hash of the ORIGINAL audio bytes
+plus model and language, so retries and duplicate submissions never reach
+the API again. Concurrent requests for the same audio share one call.
+
+Streaming voice (/ws/ask-voice) cuts raw PCM into segments at the quietest
+point near each segment boundary (PCMSegmenter) and transcribes them while
+the user is still speaking, through a pluggable Transcriber: "whisper"
+(Groq, cached as above) or "local", an offline stand-in for tests.
+"""
+import abc
+import hashlib
+import io
+import os
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import wave
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+TRANSCRIPTION_DB = "voice_transcriptions.db"
+WHISPER_MODEL = "whisper-large-v3-turbo"
+
+# Target codec -> (ffmpeg arguments, file suffix)
+AUDIO_CODECS = {
+    "opus": (["-c:a", "libopus", "-b:a", "24k", "-application", "voip"], ".ogg"),
+    "flac": (["-c:a", "flac", "-compression_level", "5"], ".flac"),
+}
+
+
+def audio_content_hash(file_path: str, block_size: int = 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def compress_audio(file_path: str, codec: str = "opus", sample_rate: int = 16000) -> Optional[str]:
+    """
+    16 kHz mono copy of the audio in a temp file (caller deletes it); None if
+    ffmpeg is missing or fails, in which case the original is uploaded
+    """
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None or codec not in AUDIO_CODECS:
+        return None
+    codec_args, suffix = AUDIO_CODECS[codec]
+    fd, out_path = tempfile.mkstemp(suffix=suffix)
+    os.close(fd)
+    try:
+        subprocess.run(
+            [ffmpeg, "-nostdin", "-hide_banner", "-loglevel", "error", "-y",
+             "-i", file_path, "-vn", "-ac", "1", "-ar", str(sample_rate), *codec_args, out_path],
+            check=True, capture_output=True, timeout=60,
+        )
+        return out_path
+    except (subprocess.SubprocessError, OSError) as e:
+        print(f"[WARNING] Audio compression failed, uploading original: {e}")
+        os.unlink(out_path)
+        return None
+
+
+class TranscriptionCache:
+    """
+    Transcripts by audio hash in SQLite; one API call per distinct audio at a
+    time. At most RAG_TRANSCRIPTION_CACHE_MAX rows are kept (least recently
+    used are evicted on insert; 0 means unlimited).
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def get(cls) -> "TranscriptionCache":
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
+
+    def __init__(self, db_path: str = TRANSCRIPTION_DB):
+        self.db_path = db_path
+        self.codec = os.getenv("RAG_AUDIO_CODEC", "opus")  # "opus", "flac" or "none"
+        self.sample_rate = int(os.getenv("RAG_AUDIO_SAMPLE_RATE", "16000"))
+        self._lock = threading.Lock()
+        self._in_flight: Dict[str, Future] = {}
+        self.max_entries = int(os.getenv("RAG_TRANSCRIPTION_CACHE_MAX", "10000"))
+        self.stats = {"hits": 0, "misses": 0, "bytes_in": 0, "bytes_uploaded": 0}
+        self.init_db()
+
+    def init_db(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS transcriptions (
+                cache_key TEXT PRIMARY KEY,
+                text TEXT,
+                audio_bytes INTEGER,
+                uploaded_bytes INTEGER,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                last_used_at DATETIME
+            )
+        """)
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(transcriptions)")}
+        if "last_used_at" not in columns:
+            conn.execute("ALTER TABLE transcriptions ADD COLUMN last_used_at DATETIME")
+        conn.commit()
+        conn.close()
+
+    def _count(self, **deltas: int):
+        """Stats are bumped from threadpool threads"""
+        with self._lock:
+            for key, delta in deltas.items():
+                self.stats[key] += delta
+
+    def lookup(self, cache_key: str) -> Optional[str]:
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("SELECT text FROM transcriptions WHERE cache_key = ?", (cache_key,))
+        row = cursor.fetchone()
+        if row:
+            cursor.execute(
+                "UPDATE transcriptions SET last_used_at = CURRENT_TIMESTAMP WHERE cache_key = ?",
+                (cache_key,)
+            )
+            conn.commit()
+        conn.close()
+        return row[0] if row else None
+
+    def _save(self, cache_key: str, text: str, audio_bytes: int, uploaded_bytes: int):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("""
+            INSERT OR REPLACE INTO transcriptions
+                (cache_key, text, audio_bytes, uploaded_bytes, last_used_at)
+            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+        """, (cache_key, text, audio_bytes, uploaded_bytes))
+        if self.max_entries > 0:
+            # Least recently used first; rowid breaks ties within the same second
+            conn.execute("""
+                DELETE FROM transcriptions WHERE cache_key IN (
+                    SELECT cache_key FROM transcriptions
+                    ORDER BY COALESCE(last_used_at, created_at) DESC, rowid DESC
+                    LIMIT -1 OFFSET ?
+                )
+            """, (self.max_entries,))
+        conn.commit()
+        conn.close()
+
+    def transcribe(self, client, file_path: str, model: str = WHISPER_MODEL,
+                   language: str = "en") -> Tuple[str, bool]:
+        """(transcript, from_cache); blocking, so call it off the event loop"""
+        cache_key = f"{audio_content_hash(file_path)}:{model}:{language}"
+        cached = self.lookup(cache_key)
+        if cached is not None:
+            self._count(hits=1)
+            return cached, True
+
+        with self._lock:
+            future = self._in_flight.get(cache_key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._in_flight[cache_key] = future
+        if not owner:
+            # Duplicate submission while the first is being transcribed
+            self._count(hits=1)
+            return future.result(), True
+
+        try:
+            # An earlier duplicate may have finished between the lookup and the claim
+            cached = self.lookup(cache_key)
+            if cached is not None:
+                future.set_result(cached)
+                return cached, True
+            text = self._call_api(client, file_path, model, language, cache_key)
+            future.set_result(text)
+            return text, False
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(cache_key, None)
+
+    def _call_api(self, client, file_path: str, model: str, language: str, cache_key: str) -> str:
+        self._count(misses=1)
+        compressed = compress_audio(file_path, self.codec, self.sample_rate)
+        upload_path = compressed or file_path
+        try:
+            audio_bytes = os.path.getsize(file_path)
+            uploaded_bytes = os.path.getsize(upload_path)
+            if compressed:
+                print(f"[INFO] Audio compressed {audio_bytes / 1024:.0f} KB -> "
+                      f"{uploaded_bytes / 1024:.0f} KB ({self.codec}, {self.sample_rate} Hz mono)")
+            with open(upload_path, "rb") as audio_file:
+                transcription = client.audio.transcriptions.create(
+                    file=(os.path.basename(upload_path), audio_file.read()),
+                    model=model,
+                    response_format="text",
+                    language=language,
+                    temperature=0.0
+                )
+            text = transcription.strip()
+            self._count(bytes_in=audio_bytes, bytes_uploaded=uploaded_bytes)
+            self._save(cache_key, text, audio_bytes, uploaded_bytes)
+            return text
+        finally:
+            if compressed:
+                os.unlink(compressed)
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self.stats)
+        conn = sqlite3.connect(self.db_path)
+        stats["entries"] = conn.execute("SELECT COUNT(*) FROM transcriptions").fetchone()[0]
+        conn.close()
+        stats["max_entries"] = self.max_entries
+        return stats
+
+
+# ---------- STREAMING SEGMENTS ----------
+def pcm_to_wav(pcm: bytes, sample_rate: int) -> bytes:
+    """16-bit mono PCM wrapped in a WAV container"""
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(pcm)
+    return buf.getvalue()
+
+
+class PCMSegmenter:
+    """
+    Cuts a stream of 16-bit mono PCM into segments of about segment_seconds,
+    each ending at the quietest frame of its last search_seconds so words
+    are rarely split between two transcriptions
+    """
+
+    def __init__(self, sample_rate: int = 16000, segment_seconds: float = 4.0,
+                 search_seconds: float = 1.0, frame_ms: int = 30, min_seconds: float = 0.25):
+        self.sample_rate = sample_rate
+        self.segment_bytes = int(segment_seconds * sample_rate) * 2
+        self.search_bytes = min(int(search_seconds * sample_rate) * 2, self.segment_bytes // 2)
+        self.frame_bytes = max(int(sample_rate * frame_ms / 1000) * 2, 2)
+        self.min_bytes = int(min_seconds * sample_rate) * 2
+        self.total_bytes = 0
+        self._buffer = bytearray()
+
+    @property
+    def seconds_received(self) -> float:
+        return self.total_bytes / 2 / self.sample_rate
+
+    def feed(self, data: bytes) -> List[bytes]:
+        """Append audio; returns the segments completed by it"""
+        self._buffer.extend(data)
+        self.total_bytes += len(data)
+        segments = []
+        while len(self._buffer) >= self.segment_bytes:
+            cut = self._cut_point()
+            segments.append(bytes(self._buffer[:cut]))
+            del self._buffer[:cut]
+        return segments
+
+    def flush(self) -> Optional[bytes]:
+        """The remaining audio, unless it is too short to hold a word"""
+        rest = bytes(self._buffer[:len(self._buffer) - len(self._buffer) % 2])
+        self._buffer.clear()
+        return rest if len(rest) >= self.min_bytes else None
+
+    def _cut_point(self) -> int:
+        start = self.segment_bytes - self.search_bytes
+        window = np.frombuffer(bytes(self._buffer[start:self.segment_bytes]), dtype=np.int16)
+        frame = self.frame_bytes // 2
+        n_frames = len(window) // frame
+        if n_frames == 0:
+            return self.segment_bytes
+        energy = (window[:n_frames * frame].astype(np.float32).reshape(n_frames, frame) ** 2).mean(axis=1)
+        quietest = int(np.argmin(energy))
+        return start + (quietest * frame + frame // 2) * 2
+
+
+# ---------- TRANSCRIBERS ----------
+class Transcriber(abc.ABC):
+    """Audio to text; subclasses implement transcribe_file"""
+
+    name = "base"
+
+    @abc.abstractmethod
+    def transcribe_file(self, file_path: str) -> str:
+        """Transcript of one complete audio file"""
+
+    def transcribe_pcm(self, pcm: bytes, sample_rate: int) -> str:
+        """One PCM segment, passed to transcribe_file as a temporary WAV"""
+        fd, wav_path = tempfile.mkstemp(suffix=".wav")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(pcm_to_wav(pcm, sample_rate))
+            return self.transcribe_file(wav_path)
+        finally:
+            os.unlink(wav_path)
+
+
+class WhisperTranscriber(Transcriber):
+    """Groq Whisper through the transcription cache (compressed upload, cached by content)"""
+
+    name = "whisper"
+
+    def __init__(self, client, model: str = WHISPER_MODEL, language: str = "en"):
+        self.client = client
+        self.model = model
+        self.language = language
+
+    def transcribe_file(self, file_path: str) -> str:
+        text, _ = TranscriptionCache.get().transcribe(self.client, file_path, self.model, self.language)
+        return text
+
+
+class LocalTranscriber(Transcriber):
+    """
+    Offline stand-in for development without an API key: returns the next
+    line of a script per call (RAG_LOCAL_TRANSCRIPT, "|"-separated), or a
+    placeholder with the audio duration when there is no script. The script
+    position is per instance, so create one per recording.
+    """
+
+    name = "local"
+
+    def __init__(self, script: Optional[List[str]] = None):
+        if script is None:
+            script = [t.strip() for t in os.getenv("RAG_LOCAL_TRANSCRIPT", "").split("|") if t.strip()]
+        self.script = list(script)
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def transcribe_file(self, file_path: str) -> str:
+        if self.script:
+            with self._lock:
+                index = self._next
+                self._next += 1
+            return self.script[index] if index < len(self.script) else ""
+        if file_path.endswith(".wav"):
+            with wave.open(file_path, "rb") as wav:
+                return f"[{wav.getnframes() / wav.getframerate():.1f}s of audio]"
+        return f"[{os.path.getsize(file_path)} bytes of audio]"
+
+
+# Name -> factory(**options); options include the Groq client as "client"
+TRANSCRIBERS: Dict[str, Callable[..., Transcriber]] = {
+    "whisper": lambda client=None, **options: WhisperTranscriber(client, **options),
+    "local": lambda client=None, **options: LocalTranscriber(**options),
+}
+
+
+def register_transcriber(name: str, factory: Callable[..., Transcriber]):
+    TRANSCRIBERS[name] = factory
+
+
+def create_transcriber(name: Optional[str] = None, **options) -> Transcriber:
+    """Transcriber by name (default RAG_TRANSCRIBER, else whisper)"""
+    name = name or os.getenv("RAG_TRANSCRIBER", "whisper")
+    if name not in TRANSCRIBERS:
+        raise ValueError(f"Unknown transcriber '{name}'; available: {sorted(TRANSCRIBERS)}")
+    return TRANSCRIBERS[name](**options)